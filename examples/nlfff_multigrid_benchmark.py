@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Compares the single-level NLFFF solution with the coarse-to-fine multigrid driver
+# on the potential cube of a model written by pyampp.util.compute.ampp_field.
+#
+#   python examples/nlfff_multigrid_benchmark.py model.h5 --factors 4 2 1
+
+import argparse
+
+import astropy.units as u
+import h5py
+import sunpy.sun.constants
+
+from pyampp.util.nlfff import multigrid_nlfff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single-level vs multigrid NLFFF.")
+    parser.add_argument('model', help='HDF5 model file produced by ampp_field')
+    parser.add_argument('--factors', type=int, nargs='+', default=[4, 2, 1],
+                        help='Downsampling factors of the multigrid levels, coarse to fine')
+    args = parser.parse_args()
+
+    with h5py.File(args.model, 'r') as f:
+        potential = f['potential']
+        bx, by, bz = [potential[name][...] for name in ('bx', 'by', 'bz')]
+        dr = (potential.attrs['obs_dr'] * sunpy.sun.constants.radius.to(u.cm)).value
+
+    print(f"box {bx.shape}")
+    print(f"{'levels':>16} {'time, s':>10} {'energy, erg':>14}")
+    for factors in ((1,), tuple(args.factors)):
+        res = multigrid_nlfff(bx, by, bz, dr, factors=factors)
+        for level in res['levels']:
+            print(f"{'  x' + str(level['factor']):>16} {level['time']:10.2f} {level['energy']:14.6e}")
+        print(f"{str(factors):>16} {res['time']:10.2f} {res['energy']:14.6e}")
+
+
+if __name__ == '__main__':
+    main()
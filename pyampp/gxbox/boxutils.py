@@ -1,12 +1,6 @@
-import numpy as np
-import astropy.units as u
-from astropy.coordinates import SkyCoord
-from sunpy.coordinates import HeliographicCarrington, HeliographicStonyhurst
-from sunpy.map import all_coordinates_from_map, Map
+from sunpy.map import Map
 from PyQt5.QtWidgets import  QMessageBox
-
-import numpy as np
-from astropy.io import fits
+from pyampp.util.hmi import map_b2ptr
 
 def hmi_disambig(azimuth_map, disambig_map, method=2):
     """
@@ -51,46 +45,8 @@ def hmi_disambig(azimuth_map, disambig_map, method=2):
 
 
 def hmi_b2ptr(map_field, map_inclination, map_azimuth):
-    sz = map_field.data.shape
-    ny, nx = sz
-
-    field = map_field.data
-    gamma = np.deg2rad(map_inclination.data)
-    psi = np.deg2rad(map_azimuth.data)
-
-    b_xi = -field * np.sin(gamma) * np.sin(psi)
-    b_eta = field * np.sin(gamma) * np.cos(psi)
-    b_zeta = field * np.cos(gamma)
-
-    foo = all_coordinates_from_map(map_field).transform_to(HeliographicStonyhurst)
-    phi = foo.lon
-    lambda_ = foo.lat
-
-    b = np.deg2rad(map_field.fits_header["crlt_obs"])
-    p = np.deg2rad(-map_field.fits_header["crota2"])
-
-    phi, lambda_ = np.deg2rad(phi), np.deg2rad(lambda_)
-
-    sinb, cosb = np.sin(b), np.cos(b)
-    sinp, cosp = np.sin(p), np.cos(p)
-    sinphi, cosphi = np.sin(phi), np.cos(phi)  # nx*ny
-    sinlam, coslam = np.sin(lambda_), np.cos(lambda_)  # nx*ny
-
-    k11 = coslam * (sinb * sinp * cosphi + cosp * sinphi) - sinlam * cosb * sinp
-    k12 = - coslam * (sinb * cosp * cosphi - sinp * sinphi) + sinlam * cosb * cosp
-    k13 = coslam * cosb * cosphi + sinlam * sinb
-    k21 = sinlam * (sinb * sinp * cosphi + cosp * sinphi) + coslam * cosb * sinp
-    k22 = - sinlam * (sinb * cosp * cosphi - sinp * sinphi) - coslam * cosb * cosp
-    k23 = sinlam * cosb * cosphi - coslam * sinb
-    k31 = - sinb * sinp * sinphi + cosp * cosphi
-    k32 = sinb * cosp * sinphi + sinp * cosphi
-    k33 = - cosb * sinphi
-
-    bptr = np.zeros((3, ny, nx))
-
-    bptr[0, :, :] = k31 * b_xi + k32 * b_eta + k33 * b_zeta
-    bptr[1, :, :] = k21 * b_xi + k22 * b_eta + k23 * b_zeta
-    bptr[2, :, :] = k11 * b_xi + k12 * b_eta + k13 * b_zeta
+    # (Bp, Bt, Br) in one float32 array, filled tile by tile by the fused kernel
+    bptr = map_b2ptr(map_field, map_inclination, map_azimuth)
 
     header = map_field.fits_header
     map_bp = Map(bptr[0, :, :], header)
@@ -161,4 +117,4 @@ def read_gxsim_b3d_sav(savfile):
     with open(boxfilenew, 'wb') as f:
         pickle.dump(gxboxdata, f)
     print(f'{savfile} is saved as {boxfilenew}')
-    return boxfilenew
\ No newline at end of file
+    return boxfilenew
@@ -9,6 +9,7 @@ import astropy.units as u
 import matplotlib.colors as mcolors
 import matplotlib.pyplot as plt
 import numpy as np
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication, QComboBox,QCheckBox, QFileDialog, QGroupBox, QHBoxLayout, QLabel, QLineEdit, \
     QMainWindow, \
     QPushButton, QVBoxLayout, QWidget
@@ -17,7 +18,6 @@ from astropy.time import Time
 from matplotlib import colormaps as mplcmaps
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from pyAMaFiL.mag_field_wrapper import MagFieldWrapper
 from sunpy.coordinates import Heliocentric, HeliographicStonyhurst, Helioprojective, get_earth
 from sunpy.map import Map, coordinate_is_on_solar_disk, make_fitswcs_header
 
@@ -26,7 +26,10 @@ from pyampp.data import downloader
 from pyampp.gxbox.boxutils import hmi_b2ptr, hmi_disambig
 from pyampp.gxbox.magfield_viewer import MagFieldViewer
 from pyampp.util.config import *
-from pyampp.util.lff import mf_lfff
+from pyampp.util.hmi import read_map_section
+from pyampp.util.lff import mf_lfff, PRECISION_DTYPES
+from pyampp.util.nlfff_job import NLFFFJob, preferred_wrapper_factory
+from pyampp.util.reprojection import REPROJECT_METHODS, reproject_maps
 
 os.environ['OMP_NUM_THREADS'] = '16'  # number of parallel threads
 locale.setlocale(locale.LC_ALL, "C");
@@ -339,7 +342,8 @@ class Box:
 
 class GxBox(QMainWindow):
     def __init__(self, time, observer, box_orig, box_dims=u.Quantity([100, 100, 100]) * u.Mm,
-                 box_res=1.4 * u.Mm, pad_frac=0.25, data_dir=DOWNLOAD_DIR, gxmodel_dir=GXMODEL_DIR, external_box=None):
+                 box_res=1.4 * u.Mm, pad_frac=0.25, data_dir=DOWNLOAD_DIR, gxmodel_dir=GXMODEL_DIR, external_box=None,
+                 precision='double', preview_reprojection='bilinear', reprojection='adaptive'):
         """
         Main application window for visualizing and interacting with solar data in a 3D box.
 
@@ -361,6 +365,15 @@ class GxBox(QMainWindow):
         :type gxmodel_dir: str
         :param external_box: Path to external box file (optional).
         :type external_box: str
+        :param precision: Floating point precision of the 3D field models and viewer grids, 'double' or 'single'.
+            The NLFFF solver always runs in double precision, defaults to 'double'.
+        :type precision: str
+        :param preview_reprojection: Reprojection method of the displayed bottom maps, one of REPROJECT_METHODS,
+            defaults to the fast 'bilinear'.
+        :type preview_reprojection: str
+        :param reprojection: Reprojection method of the vector bottom boundary of the 3D models, defaults to 'adaptive';
+            'exact' conserves the flux.
+        :type reprojection: str
 
         Methods
         -------
@@ -400,6 +413,9 @@ class GxBox(QMainWindow):
         self.box_dimensions = box_dims
         self.box_res = box_res
         self.pad_frac = pad_frac
+        self.precision = precision
+        self.preview_reprojection = preview_reprojection
+        self.reprojection = reprojection
         ## this is the origin of the box, i.e., the center of the box bottom
         self.box_origin = box_orig
         self.sdofitsfiles = None
@@ -420,6 +436,10 @@ class GxBox(QMainWindow):
         self.fieldlines_show_status = True  # Initial status of the fieldlines visibility
         self.map_context_im = None
         self.map_bottom_im = None
+        self.nlfff_job = None
+        self.nlfff_timer = None
+        self.bvect_bottom = None
+        self.bvect_bottom_data = None
 
         ## this is a dummy map. it should be replaced by a real map from inputs.
         self.instrument_map = self.make_dummy_map(self.box_origin.transform_to(self.frame_obs))
@@ -452,9 +472,8 @@ class GxBox(QMainWindow):
         self.sdomaps[self.init_map_bottom_name] = self.loadmap(self.init_map_bottom_name)
 
         # print(self.bottom_wcs_header)
-        self.map_bottom = self.sdomaps[self.init_map_bottom_name].reproject_to(self.bottom_wcs_header,
-                                                                               algorithm="adaptive",
-                                                                               roundtrip_coords=False)
+        self.map_bottom = reproject_maps([self.sdomaps[self.init_map_bottom_name]], self.bottom_wcs_header,
+                                         method=self.preview_reprojection)[0]
 
         self.init_ui()
 
@@ -529,14 +548,16 @@ class GxBox(QMainWindow):
         if mapname in self.sdomaps.keys():
             return self.sdomaps[mapname]
 
-        loaded_map = Map(self.sdofitsfiles[mapname])
+        # decompress only the image tiles covering the FOV instead of the full-disk segment
+        loaded_map = read_map_section(self.sdofitsfiles[mapname], *fov_coords)
         fov_coords = self.corr_fov_coords(loaded_map, fov_coords)
         loaded_map = loaded_map.submap(fov_coords[0], top_right=fov_coords[1])
         # loaded_map = loaded_map.rotate(order=3)
         if mapname in ['azimuth']:
             if 'disambig' not in self.sdomaps.keys():
-                self.sdomaps['disambig'] = Map(self.sdofitsfiles['disambig']).submap(fov_coords[0],
-                                                                                     top_right=fov_coords[1])
+                self.sdomaps['disambig'] = read_map_section(self.sdofitsfiles['disambig'],
+                                                            *fov_coords).submap(fov_coords[0],
+                                                                                top_right=fov_coords[1])
             loaded_map = hmi_disambig(loaded_map, self.sdomaps['disambig'])
 
         self.sdomaps[mapname] = loaded_map
@@ -750,30 +771,32 @@ class GxBox(QMainWindow):
     def visualize_3d_magnetic_field(self):
         """
         Launches the MagneticFieldVisualizer to visualize the 3D magnetic field data.
+        The NLFFF solution is computed in the background. Clicking the button again while it runs cancels it
+        if 'nlfff' is selected, and opens the viewer of the selected model otherwise.
         """
-        box_norm_direction = self.box_norm_direction()
-        box_view_up = self.box_view_up()
         b3dtype = self.b3d_model_selector.currentText()
+        if self.nlfff_job is not None and b3dtype == 'nlfff':
+            self.cancel_nlfff_job()
+            return
         # print(f'type of self.box.b3d is {type(self.box.b3d)}')
         # print(f'value of self.box.b3d is {self.box.b3d}')
         # if b3dtype == 'pot':
         if self.box.b3d['pot'] is None:
             if self.map_bottom_selector.currentText() != 'br':
                 self.map_bottom_selector.setCurrentIndex(self.avaliable_maps.index('br'))
-            maglib_lff = mf_lfff()
-            ## todo ask Alexey how to get rid of the nan value.
-            bnddata = self.map_bottom.data
-            bnddata[np.isnan(bnddata)] = 0.0
+            maglib_lff = mf_lfff(precision=self.precision)
+            ## the displayed bottom map uses the preview reprojection, the model gets br reprojected with self.reprojection
+            bnddata = self.load_vector_bottom()['bz']
 
             with open('bnddata.pkl', 'wb') as f:
                 pickle.dump(bnddata, f)
             maglib_lff.set_field(bnddata)
-            ## the axis order in res is y, x, z. so we need to swap the first two axes, so that the order becomes x, y, z.
-            res = maglib_lff.lfff_cube(self.box.dims_pix[-1].value, alpha=0.0)
+            ## the cube is produced C-ordered in the axis order z, x, y; the viewer gets x, y, z views of it.
+            res = maglib_lff.lfff_cube(self.box.dims_pix[-1].value, alpha=0.0, layout='zyx')
             self.box.b3d['pot'] = {}
-            self.box.b3d['pot']['bx'] = res['by'].swapaxes(0, 1)
-            self.box.b3d['pot']['by'] = res['bx'].swapaxes(0, 1)
-            self.box.b3d['pot']['bz'] = res['bz'].swapaxes(0, 1)
+            self.box.b3d['pot']['bx'] = res['by'].transpose((1, 2, 0))
+            self.box.b3d['pot']['by'] = res['bx'].transpose((1, 2, 0))
+            self.box.b3d['pot']['bz'] = res['bz'].transpose((1, 2, 0))
 
         if b3dtype == 'nlfff':
             if self.box.b3d['nlfff'] is None:
@@ -781,20 +804,7 @@ class GxBox(QMainWindow):
                 bx_lff, by_lff, bz_lff = [self.box.b3d['pot'][k].swapaxes(0, 1) for k in ("by", "bx", "bz")]
 
                 # replace bottom boundary of lff solution with initial boundary conditions
-                bvect_bottom = {}
-                bvect_bottom['bz'] = self.sdomaps['br'] if 'br' in self.sdomaps.keys() else self.loadmap('br')
-                bvect_bottom['bx'] = -self.sdomaps['bt'] if 'bt' in self.sdomaps.keys() else -self.loadmap('bt')
-                bvect_bottom['by'] = self.sdomaps['bp'] if 'bp' in self.sdomaps.keys() else self.loadmap('bp')
-
-                self.bvect_bottom = {}
-                for k in bvect_bottom.keys():
-                    self.bvect_bottom[k] = bvect_bottom[k].reproject_to(self.bottom_wcs_header, algorithm="adaptive",
-                                                                        roundtrip_coords=False)
-
-                self.bvect_bottom_data = {}
-                for k in bvect_bottom.keys():
-                    self.bvect_bottom_data[k] = self.bvect_bottom[k].data
-                    self.bvect_bottom_data[k][np.isnan(self.bvect_bottom_data[k])] = 0.0
+                self.load_vector_bottom()
                 bx_lff[:, :, 0] = self.bvect_bottom_data['bx']
                 by_lff[:, :, 0] = self.bvect_bottom_data['by']
                 bz_lff[:, :, 0] = self.bvect_bottom_data['bz']
@@ -802,28 +812,101 @@ class GxBox(QMainWindow):
                 with open('inputdata.pkl', 'wb') as f:
                     pickle.dump([bx_lff, by_lff, bz_lff], f)
 
-                # return
-                import time
-                t0 = time.time()
-                maglib = MagFieldWrapper()
-                maglib.load_cube_vars(bx_lff, by_lff, bz_lff, self.box_res.to(u.cm).value)
-                # maglib.load_cube_vars(bx_lff, by_lff, bz_lff, np.array([0.00143678, 0.00143678, 0.00143678]))
-                res_nlf = maglib.NLFFF()
-                print(f'Time taken to compute NLFFF solution: {time.time() - t0} seconds')
-
-                ## the axis order in res_nlf is y, z, x. so we need to swap the first two axes, so that the order becomes x, y, z.
-                bx_nlff, by_nlff, bz_nlff = [res_nlf[k].transpose((2, 0, 1)) for k in ("bx", "by", "bz")]
-                self.box.b3d['nlfff']['bx'] = bx_nlff
-                self.box.b3d['nlfff']['by'] = by_nlff
-                self.box.b3d['nlfff']['bz'] = bz_nlff
-
-                with open('nlfffdata.pkl', 'wb') as f:
-                    pickle.dump(self.box.b3d['nlfff'], f)
-
-        self.visualizer = MagFieldViewer(self.box, parent=self, box_norm_direction=box_norm_direction,
-                                         box_view_up=box_view_up, time=self.time, b3dtype=b3dtype)
+                # the solver runs in a worker process, the GUI keeps polling it and stays responsive
+                self.nlfff_job = NLFFFJob(bx_lff, by_lff, bz_lff, self.box_res.to(u.cm).value,
+                                          wrapper_factory=preferred_wrapper_factory).start()
+                self.nlfff_timer = QTimer(self)
+                self.nlfff_timer.timeout.connect(self.poll_nlfff_job)
+                self.nlfff_timer.start(500)
+                self.visualize_button.setToolTip("Cancel the running NLFFF solution ('nlfff' selected) "
+                                                 "or visualize the selected 3D model.")
+                return
+
+        self.show_3d_viewer(b3dtype)
+
+    def load_vector_bottom(self):
+        """
+        Reprojects the vector bottom boundary of the 3D models (bx = -bt, by = bp, bz = br) onto the box bottom
+        with the model reprojection method, once per box.
+
+        :return: dict(bx, by, bz) of bottom arrays, NaNs replaced by zeros.
+        :rtype: dict
+        """
+        if self.bvect_bottom_data is not None:
+            return self.bvect_bottom_data
+        bvect_bottom = {}
+        bvect_bottom['bz'] = self.sdomaps['br'] if 'br' in self.sdomaps.keys() else self.loadmap('br')
+        bvect_bottom['bx'] = -self.sdomaps['bt'] if 'bt' in self.sdomaps.keys() else -self.loadmap('bt')
+        bvect_bottom['by'] = self.sdomaps['bp'] if 'bp' in self.sdomaps.keys() else self.loadmap('bp')
+
+        # the three components share one grid, reproject them as one stack
+        self.bvect_bottom = dict(zip(bvect_bottom.keys(),
+                                     reproject_maps(list(bvect_bottom.values()), self.bottom_wcs_header,
+                                                    method=self.reprojection)))
+
+        self.bvect_bottom_data = {}
+        for k in bvect_bottom.keys():
+            self.bvect_bottom_data[k] = self.bvect_bottom[k].data
+            self.bvect_bottom_data[k][np.isnan(self.bvect_bottom_data[k])] = 0.0
+        return self.bvect_bottom_data
+
+    def show_3d_viewer(self, b3dtype):
+        """
+        Opens the MagFieldViewer for the given 3D magnetic model.
+
+        :param b3dtype: Type of the 3D model, 'pot' or 'nlfff'.
+        :type b3dtype: str
+        """
+        self.visualizer = MagFieldViewer(self.box, parent=self, box_norm_direction=self.box_norm_direction(),
+                                         box_view_up=self.box_view_up(), time=self.time, b3dtype=b3dtype)
         self.visualizer.show()
 
+    def cancel_nlfff_job(self):
+        """
+        Cancels the running NLFFF solution.
+        """
+        if self.nlfff_job is not None:
+            self.nlfff_job.cancel()
+            self.poll_nlfff_job()
+
+    def poll_nlfff_job(self):
+        """
+        Updates the 3D viewer button with the NLFFF progress and opens the viewer once the solution is ready.
+        """
+        job = self.nlfff_job
+        if job is None:
+            return
+        if not job.finished:
+            # the button cancels the solution only while 'nlfff' is selected
+            action = " (cancel)" if self.b3d_model_selector.currentText() == 'nlfff' else ""
+            self.visualize_button.setText(f"NLFFF {job.elapsed:.0f} s{action}")
+            return
+
+        self.nlfff_timer.stop()
+        self.nlfff_job = None
+        self.visualize_button.setText("3D viewer")
+        self.visualize_button.setToolTip("Visualize the 3D magnetic field.")
+        if job.state != 'done':
+            print(f'NLFFF solution {job.state}' + (f':\n{job.error}' if job.error else ''))
+            self.box.b3d['nlfff'] = None
+            return
+        print(f'Time taken to compute NLFFF solution: {job.elapsed} seconds')
+        res_nlf = job.result()
+
+        ## the axis order in res_nlf is y, z, x. so we need to swap the first two axes, so that the order becomes x, y, z.
+        bx_nlff, by_nlff, bz_nlff = [res_nlf[k].transpose((2, 0, 1)).astype(PRECISION_DTYPES[self.precision][0],
+                                                                            copy=False)
+                                     for k in ("bx", "by", "bz")]
+        self.box.b3d['nlfff']['bx'] = bx_nlff
+        self.box.b3d['nlfff']['by'] = by_nlff
+        self.box.b3d['nlfff']['bz'] = bz_nlff
+
+        with open('nlfffdata.pkl', 'wb') as f:
+            pickle.dump(self.box.b3d['nlfff'], f)
+
+        if self.b3d_model_selector.currentText() == 'nlfff':
+            self.show_3d_viewer('nlfff')
+
     def update_bottom_map(self, map_name):
         """
         Updates the bottom map displayed in the UI.
@@ -834,8 +917,7 @@ class GxBox(QMainWindow):
         if self.map_bottom_im is not None:
             self.map_bottom_im.remove()
         map_bottom = self.sdomaps[map_name] if map_name in self.sdomaps.keys() else self.loadmap(map_name)
-        self.map_bottom = map_bottom.reproject_to(self.bottom_wcs_header, algorithm="adaptive",
-                                                  roundtrip_coords=False)
+        self.map_bottom = reproject_maps([map_bottom], self.bottom_wcs_header, method=self.preview_reprojection)[0]
 
         self.box._dims_pix[0] = self.map_bottom.data.shape[0]
         self.box._dims_pix[1] = self.map_bottom.data.shape[1]
@@ -1112,6 +1194,12 @@ def main():
     parser.add_argument('--gxmodel_dir', default=GXMODEL_DIR, help='Directory for storing model outputs')
     parser.add_argument('--external_box', default=os.path.abspath(os.getcwd()),
                         help='Path to external box file (optional)')
+    parser.add_argument('--precision', default='double', choices=list(PRECISION_DTYPES),
+                        help='Floating point precision of the 3D field models (the NLFFF solver always uses double)')
+    parser.add_argument('--preview_reprojection', default='bilinear', choices=list(REPROJECT_METHODS),
+                        help='Reprojection method of the displayed bottom maps')
+    parser.add_argument('--reprojection', default='adaptive', choices=list(REPROJECT_METHODS),
+                        help='Reprojection method of the bottom boundary of the 3D models (exact conserves the flux)')
     parser.add_argument('--interactive', action='store_true',
                         help='Enable interactive mode with access to memory and additional tools.')
 
@@ -1152,7 +1240,8 @@ def main():
     # Running the application
     app = QApplication([])
     gxbox = GxBox(time, observer, box_origin, box_dimensions, box_res, pad_frac=pad_frac, data_dir=data_dir,
-                  gxmodel_dir=gxmodel_dir, external_box=external_box)
+                  gxmodel_dir=gxmodel_dir, external_box=external_box, precision=args.precision,
+                  preview_reprojection=args.preview_reprojection, reprojection=args.reprojection)
     gxbox.show()
 
     if args.interactive:
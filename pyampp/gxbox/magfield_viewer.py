@@ -855,6 +855,8 @@ class MagFieldViewer(BackgroundPlotter):
         bx = self.box.b3d[self.b3dtype]['bx']
         by = self.box.b3d[self.b3dtype]['by']
         bz = self.box.b3d[self.b3dtype]['bz']
+        # keep the grids in the precision of the model (float32 for single precision boxes)
+        dtype = np.result_type(bx, by, bz)
         vectors = np.c_[bx.ravel(order='F'), by.ravel(order='F'), bz.ravel(order='F')]
 
         self.grid = pv.ImageData()
@@ -872,7 +874,7 @@ class MagFieldViewer(BackgroundPlotter):
         self.grid_bottom.spacing = (x[1] - x[0], y[1] - y[0], 0)
         self.grid_bottom.origin = (x.min(), y.min(), z.min())
         self.bottom_name = self.parent.map_bottom_selector.currentText()
-        self.grid_bottom[self.bottom_name] = self.parent.map_bottom.data.T.ravel(order='F')
+        self.grid_bottom[self.bottom_name] = self.parent.map_bottom.data.T.ravel(order='F').astype(dtype, copy=False)
         self.scalar_selector_items.append(self.bottom_name)
 
 
@@ -0,0 +1,27 @@
+import numpy as np
+
+from pyampp.util.energy import magnetic_energy, standard_window
+from pyampp.util.MagFieldWrapper import MagFieldWrapper
+
+
+def _cube(shape=(12, 16, 20)):
+    rng = np.random.default_rng(0)
+    return [rng.normal(scale=100, size=shape) for _ in range(3)]
+
+
+def _loaded_wrapper(cube, dr=1.0e8):
+    # load_cube_vars and the energies do not touch the solver library
+    maglib = MagFieldWrapper.__new__(MagFieldWrapper)
+    maglib.load_cube_vars(*cube, dr)
+    return maglib
+
+
+def test_wrapper_energy_matches_energy_profile():
+    maglib = _loaded_wrapper(_cube())
+    assert maglib.energy == maglib.energy_profile()['energy']
+
+
+def test_wrapper_energy_uses_standard_window():
+    bx, by, bz = _cube()
+    ref = magnetic_energy(bx, by, bz, 1.0e8, z_axis=0, window=standard_window(bx.shape, 0))['energy']
+    np.testing.assert_allclose(_loaded_wrapper((bx, by, bz)).energy, ref, rtol=1e-12)
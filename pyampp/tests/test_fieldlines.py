@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+from pyampp.util.fieldlines import VOXEL_OUTPUTS, FieldLines, trace_lines_batched
+from pyampp.util.MagFieldWrapper import MagFieldWrapper
+
+
+class StubLinesWrapper:
+    # mimics MagFieldWrapper.lines: every seed gives a line of 1..3 points and per-voxel outputs that depend
+    # only on the seed and the field, so that batched and parallel tracing must reproduce a single call
+    def load_cube_vars(self, bx, by, bz, dr, copy=True):
+        self.bz = np.array(bz, dtype=np.float64) if copy else bz
+
+    def lines(self, seeds, max_length=0, reshape_3D=True, n_processes=0):
+        ijk = seeds.astype(int)
+        n = len(seeds)
+        length = 1 + ijk.sum(axis=1) % 3
+        start = np.concatenate([[0], np.cumsum(length)[:-1]])
+        assert max_length == 0 or length.sum() <= max_length
+        coords = np.zeros((max(max_length, 0), 4))
+        if max_length:
+            points = np.repeat(np.arange(n), length)
+            coords[:len(points), :3] = seeds[points]
+            coords[:len(points), 2] += np.arange(len(points)) - start[points]
+            coords[:len(points), 3] = points
+        n_passed = int(np.sum(length == 3))
+        return dict(n_lines=n, n_passed=n_passed, non_passed=n - n_passed,
+                    voxel_status=np.ones(n, dtype=np.int32), phys_length=length.astype(np.float64),
+                    av_field=self.bz[ijk[:, 2], ijk[:, 1], ijk[:, 0]], codes=(ijk[:, 0] % 5).astype(np.int32),
+                    max_length=np.int64(max_length), coords=coords, lines_start=start.astype(np.uint64),
+                    lines_length=length.astype(np.int32), lines_index=np.arange(n, dtype=np.int32))
+
+
+def _cube(shape=(5, 6, 7)):
+    rng = np.random.default_rng(3)
+    return [rng.normal(size=shape) for _ in range(3)]
+
+
+def _lines(n=4):
+    lengths = np.arange(1, n + 1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    coords = np.arange(4 * offsets[-1], dtype=np.float32).reshape(-1, 4)
+    return FieldLines(coords, offsets, index=np.arange(n) + 10)
+
+
+@pytest.mark.parametrize('n_workers', [0, 2])
+def test_batched_tracing_matches_single_call(n_workers):
+    bx, by, bz = _cube()
+    ref = trace_lines_batched(bx, by, bz, 1.0, batch_size=bx.size, max_coords=4 * bx.size,
+                              n_workers=0, wrapper_factory=StubLinesWrapper)
+    res = trace_lines_batched(bx, by, bz, 1.0, batch_size=37, max_coords=4 * 37,
+                              n_workers=n_workers, wrapper_factory=StubLinesWrapper)
+    for k in VOXEL_OUTPUTS:
+        assert res[k].shape == bx.shape
+        np.testing.assert_array_equal(res[k], ref[k])
+    np.testing.assert_array_equal(res['av_field'], bz)
+    for k in ('n_lines', 'n_passed', 'non_passed'):
+        assert res[k] == ref[k]
+    np.testing.assert_array_equal(res['lines'].offsets, ref['lines'].offsets)
+    np.testing.assert_array_equal(res['lines'].points, ref['lines'].points)
+    assert len(res['lines']) == bx.size
+
+
+@pytest.mark.parametrize('suffix', ['.npz', '.h5'])
+def test_fieldlines_save_load(tmp_path, suffix):
+    lines = _lines()
+    lines.save(tmp_path / f"lines{suffix}")
+    loaded = FieldLines.load(tmp_path / f"lines{suffix}")
+    np.testing.assert_array_equal(loaded.coords, lines.coords)
+    np.testing.assert_array_equal(loaded.offsets, lines.offsets)
+    np.testing.assert_array_equal(loaded.index, lines.index)
+
+
+def test_fieldlines_getitem_and_concatenate():
+    lines = _lines()
+    assert len(lines) == 4
+    np.testing.assert_array_equal(lines[1], lines.coords[1:3])
+    np.testing.assert_array_equal(lines[-1], lines.coords[6:10])
+
+    joined = FieldLines.concatenate([lines, _lines(2)])
+    assert len(joined) == 6
+    assert joined.n_points == lines.n_points + 3
+    np.testing.assert_array_equal(joined[4], _lines(2)[0])
+    np.testing.assert_array_equal(joined[5], _lines(2)[1])
+    np.testing.assert_array_equal(joined.index, [10, 11, 12, 13, 10, 11])
+    with pytest.raises(ValueError):
+        FieldLines(lines.coords, lines.offsets[:-1])
+
+
+def _fake_lines_func(N, bx, by, bz, reduce_passed, chromo_level, seeds, n_seeds, *args):
+    n_lines, voxel_status = args[4], args[6]
+    n_lines[0] = n_seeds
+    voxel_status[:] = 1
+    return 0
+
+
+@pytest.fixture
+def wrapper():
+    # the buffer management of lines() does not need the solver library
+    maglib = MagFieldWrapper.__new__(MagFieldWrapper)
+    maglib._MagFieldWrapper__buffers = None
+    maglib._MagFieldWrapper__lines_func = lambda with_seeds, with_coords: _fake_lines_func
+    maglib.load_cube_vars(*_cube(), 1.0)
+    return maglib
+
+
+def test_reuse_buffers_reallocates_when_seeds_grow(wrapper):
+    seeds = np.zeros((10, 3))
+    first = wrapper.lines(seeds=seeds[:5], max_length=20, reuse_buffers=True)
+    smaller = wrapper.lines(seeds=seeds[:3], max_length=10, reuse_buffers=True)
+    assert np.shares_memory(smaller['voxel_status'], first['voxel_status'])
+    assert smaller['voxel_status'].size == 3
+    assert smaller['coords'].shape == (10, 4)
+
+    grown = wrapper.lines(seeds=seeds, max_length=20, reuse_buffers=True)
+    assert not np.shares_memory(grown['voxel_status'], first['voxel_status'])
+    assert grown['voxel_status'].size == 10
+    np.testing.assert_array_equal(grown['voxel_status'], 1)
+    assert grown['n_lines'] == 10
+
+    longer = wrapper.lines(seeds=seeds, max_length=40, reuse_buffers=True)
+    assert not np.shares_memory(longer['coords'], grown['coords'])
+    assert longer['coords'].shape == (40, 4)
@@ -0,0 +1,99 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from sunpy.coordinates import frames, get_earth
+from sunpy.map import Map, make_fitswcs_header
+
+from pyampp.util.geometry import clear_geometry_cache, geometry_residual, stonyhurst_lonlat
+from pyampp.util.hmi import map_b2ptr, read_map_header, read_map_section
+
+CROTA2 = 179.93
+
+
+@pytest.fixture(scope='module')
+def hmi_header():
+    # full-disk TAN frame rolled by ~180 deg as in HMI, at a coarser scale so that the limb is included
+    obstime = '2024-05-10T12:00:00'
+    observer = get_earth(obstime)
+    ref = SkyCoord(3 * u.arcsec, -2 * u.arcsec, frame=frames.Helioprojective(observer=observer, obstime=obstime))
+    header = make_fitswcs_header((512, 480), ref, scale=[4.0, 4.0] * u.arcsec / u.pix,
+                                 rotation_angle=CROTA2 * u.deg, reference_pixel=[240.7, 256.2] * u.pix)
+    header['crlt_obs'] = observer.lat.deg
+    header['crota2'] = CROTA2
+    return header
+
+
+def _per_pixel_b2ptr(field, inclination, azimuth, lon, lat, b0, p):
+    # Gary & Hagyard (1990) transform with the explicit k_ij coefficients, in float64
+    field = field.astype(np.float64)
+    gamma, psi = np.deg2rad(inclination.astype(np.float64)), np.deg2rad(azimuth.astype(np.float64))
+    b_xi = -field * np.sin(gamma) * np.sin(psi)
+    b_eta = field * np.sin(gamma) * np.cos(psi)
+    b_zeta = field * np.cos(gamma)
+
+    sinb, cosb, sinp, cosp = np.sin(b0), np.cos(b0), np.sin(p), np.cos(p)
+    sinphi, cosphi, sinlam, coslam = np.sin(lon), np.cos(lon), np.sin(lat), np.cos(lat)
+    k11 = coslam * (sinb * sinp * cosphi + cosp * sinphi) - sinlam * cosb * sinp
+    k12 = - coslam * (sinb * cosp * cosphi - sinp * sinphi) + sinlam * cosb * cosp
+    k13 = coslam * cosb * cosphi + sinlam * sinb
+    k21 = sinlam * (sinb * sinp * cosphi + cosp * sinphi) + coslam * cosb * sinp
+    k22 = - sinlam * (sinb * cosp * cosphi - sinp * sinphi) - coslam * cosb * cosp
+    k23 = sinlam * cosb * cosphi - coslam * sinb
+    k31 = - sinb * sinp * sinphi + cosp * cosphi
+    k32 = sinb * cosp * sinphi + sinp * cosphi
+    k33 = - cosb * sinphi
+    return np.array([k31 * b_xi + k32 * b_eta + k33 * b_zeta,
+                     k21 * b_xi + k22 * b_eta + k23 * b_zeta,
+                     k11 * b_xi + k12 * b_eta + k13 * b_zeta])
+
+
+def test_rolled_tan_geometry_residual(hmi_header):
+    clear_geometry_cache()
+    smap = Map(np.zeros((512, 480), dtype=np.float32), hmi_header)
+    lon, lat = stonyhurst_lonlat(smap)
+    assert np.isfinite(lat).any()
+    assert np.isnan(lat).any()
+    assert geometry_residual(smap, step=4) < 1.0
+
+
+def test_map_b2ptr_matches_per_pixel_formula(hmi_header):
+    rng = np.random.default_rng(1)
+    shape = (512, 480)
+    field = rng.uniform(0, 2000, shape).astype(np.float32)
+    inclination = rng.uniform(0, 180, shape).astype(np.float32)
+    azimuth = rng.uniform(0, 360, shape).astype(np.float32)
+    map_field = Map(field.copy(), hmi_header)
+
+    bptr = map_b2ptr(map_field, Map(inclination, hmi_header), Map(azimuth, hmi_header))
+    lon, lat = stonyhurst_lonlat(map_field)
+    ref = _per_pixel_b2ptr(field, inclination, azimuth, lon, lat,
+                           np.deg2rad(hmi_header['crlt_obs']), np.deg2rad(-CROTA2))
+
+    on_disk = np.isfinite(ref)
+    np.testing.assert_array_equal(np.isfinite(bptr), on_disk)
+    np.testing.assert_allclose(bptr[on_disk], ref[on_disk], rtol=0, atol=1e-2)
+    np.testing.assert_array_equal(map_field.data, field)
+
+
+def test_read_map_section_matches_full_read(hmi_header, tmp_path):
+    path = tmp_path / 'field.fits'
+    data = np.random.default_rng(2).uniform(-2000, 2000, (512, 480)).astype(np.float32)
+    header = fits.Header({k: v for k, v in hmi_header.items() if not k.startswith('naxis')})
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, header=header, compression_type='RICE_1', tile_shape=(64, 64))]).writeto(path)
+
+    full = Map(path)
+    frame = read_map_header(path).coordinate_frame
+    bottom_left = SkyCoord(-200 * u.arcsec, -150 * u.arcsec, frame=frame)
+    top_right = SkyCoord(100 * u.arcsec, 120 * u.arcsec, frame=frame)
+    section = read_map_section(path, bottom_left, top_right)
+    assert section.data.size < full.data.size / 20
+
+    ref = full.submap(bottom_left, top_right=top_right)
+    cutout = section.submap(bottom_left, top_right=top_right)
+    np.testing.assert_array_equal(cutout.data, ref.data)
+    np.testing.assert_allclose(cutout.wcs.wcs.crpix, ref.wcs.wcs.crpix)
+    assert cutout.bottom_left_coord.separation(ref.bottom_left_coord) < 1e-6 * u.arcsec
+    np.testing.assert_array_equal(read_map_section(path).data, full.data)
@@ -0,0 +1,161 @@
+import tracemalloc
+
+import h5py
+import numpy as np
+import pytest
+
+from pyampp.util.kernelcache import KernelCache
+from pyampp.util.lff import LFFF_SLAB_BYTES, mf_lfff, stretched_heights
+
+
+def _field(shape=(48, 40)):
+    rng = np.random.default_rng(0)
+    return rng.normal(scale=300, size=shape)
+
+
+def _per_layer(maglib_lff, nz, **kwargs):
+    layers = [maglib_lff.lfff_at_z(z, **kwargs) for z in range(nz)]
+    return {k: np.stack([layer[k] for layer in layers], axis=-1) for k in ('bx', 'by', 'bz')}
+
+
+@pytest.mark.parametrize('real_fft', [False, True])
+@pytest.mark.parametrize('nz_block', [None, 1, 3, 16])
+@pytest.mark.parametrize('alpha', [0, 0.01])
+def test_cube_bit_identical_to_per_layer(real_fft, nz_block, alpha):
+    maglib_lff = mf_lfff(real_fft=real_fft, kernel_cache=False)
+    maglib_lff.set_field(_field())
+    ref = _per_layer(maglib_lff, 10, alpha=alpha)
+    cube = maglib_lff.lfff_cube(10, alpha=alpha, nz_block=nz_block)
+    for k in ('bx', 'by', 'bz'):
+        np.testing.assert_array_equal(cube[k], ref[k])
+
+
+def test_zyx_layout_matches_xyz():
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(_field())
+    xyz = maglib_lff.lfff_cube(7)
+    zyx = maglib_lff.lfff_cube(7, layout='zyx')
+    for k in ('bx', 'by', 'bz'):
+        assert zyx[k].flags['C_CONTIGUOUS']
+        np.testing.assert_array_equal(zyx[k], xyz[k].transpose((2, 1, 0)))
+
+
+def test_default_slab_memory():
+    # output cubes, the slab budget and the spectral kernels; the padded transforms of a slab must not
+    # outlive their component
+    nx, ny, nz = 128, 128, 32
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(_field((nx, ny)))
+    tracemalloc.start()
+    maglib_lff.lfff_cube(nz)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    cubes = 3 * nx * ny * nz * 8
+    plane = (2 * nx) * (2 * ny) * 16
+    assert peak < cubes + LFFF_SLAB_BYTES + 24 * plane
+
+
+@pytest.mark.parametrize('alpha', [0, 0.01])
+def test_real_fft_matches_complex_transform(alpha):
+    cubes = {}
+    for real_fft in (False, True):
+        maglib_lff = mf_lfff(real_fft=real_fft, kernel_cache=False)
+        maglib_lff.set_field(_field())
+        cubes[real_fft] = maglib_lff.lfff_cube(10, alpha=alpha)
+    scale = np.max(np.abs(_field()))
+    for k in ('bx', 'by', 'bz'):
+        np.testing.assert_allclose(cubes[True][k], cubes[False][k], rtol=0, atol=1e-12 * scale)
+
+
+def test_stream_to_hdf5_matches_cube(tmp_path):
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(_field())
+    ref = maglib_lff.lfff_cube(10, alpha=0.01)
+    with h5py.File(tmp_path / 'cube.h5', 'w') as f:
+        for k in ('bx', 'by', 'bz'):
+            f.create_dataset(k, shape=maglib_lff.cube_shape(10), dtype=np.float64, chunks=(48, 40, 3))
+        maglib_lff.lfff_stream(f, 10, alpha=0.01, nz_block=3)
+        for k in ('bx', 'by', 'bz'):
+            np.testing.assert_array_equal(f[k][...], ref[k])
+
+
+@pytest.mark.parametrize('alpha', [0, 0.01])
+def test_non_uniform_heights_match_per_layer(alpha):
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(_field())
+    z = stretched_heights(12, dz_min=0.5, ratio=1.3, z_uniform=2)
+    assert np.any(np.diff(z) != np.diff(z)[0])
+    cube = maglib_lff.lfff_cube(z, alpha=alpha, nz_block=4)
+    assert cube['bx'].shape == (48, 40, len(z))
+    for i, zi in enumerate(z):
+        layer = maglib_lff.lfff_at_z(zi, alpha=alpha)
+        for k in ('bx', 'by', 'bz'):
+            np.testing.assert_allclose(cube[k][:, :, i], layer[k], rtol=0, atol=1e-12 * np.max(np.abs(_field())))
+
+
+def test_alpha_sweep_recovers_alpha():
+    alpha = 0.02
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(_field())
+    boundary = maglib_lff.lfff_at_z(0, alpha=alpha)
+    alphas = np.linspace(-0.05, 0.05, 21)
+    res = maglib_lff.lfff_alpha_sweep(alphas, bx=boundary['bx'], by=boundary['by'], alpha_block=4, return_fields=True)
+    assert res['best_alpha'] == pytest.approx(alpha)
+    assert res['misfit'][np.argmin(np.abs(alphas - alpha))] < 1e-20
+    np.testing.assert_allclose(res['bx'][10], maglib_lff.lfff_at_z(0)['bx'], rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('shape', [(48, 40), (61, 37), (100, 83)])
+def test_auto_pad_shape_is_smooth_and_even(shape):
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(_field(shape), auto_pad=True)
+    for n, size in zip(maglib_lff.padded_shape, shape):
+        assert n % 2 == 0
+        assert n >= 2 * size
+        for p in (2, 3, 5):
+            while n % p == 0:
+                n //= p
+        assert n == 1
+
+
+def test_kernel_cache_lru():
+    cache = KernelCache(maxsize=2)
+    calls = []
+
+    def builder(key):
+        def build():
+            calls.append(key)
+            return dict(a=np.full(3, float(len(calls))))
+        return build
+
+    first = cache.get('a', builder('a'))
+    assert cache.get('a', builder('a')) is first
+    cache.get('b', builder('b'))
+    cache.get('a', builder('a'))
+    cache.get('c', builder('c'))  # evicts 'b', the least recently used one
+    assert len(cache) == 2
+    assert calls == ['a', 'b', 'c']
+    assert cache.hits == 2
+    cache.get('b', builder('b'))
+    assert calls == ['a', 'b', 'c', 'b']
+    assert not first['a'].flags.writeable
+
+
+def test_kernel_cache_disk_round_trip(tmp_path):
+    cubes = []
+    for cache in (KernelCache(cache_dir=str(tmp_path)), KernelCache(cache_dir=str(tmp_path))):
+        maglib_lff = mf_lfff(kernel_cache=cache)
+        maglib_lff.set_field(_field())
+        cubes.append(maglib_lff.lfff_cube(6, alpha=0.01))
+    assert cache.misses == 0
+    assert cache.hits > 0
+    for k in ('bx', 'by', 'bz'):
+        np.testing.assert_array_equal(cubes[1][k], cubes[0][k])
+
+    # a shared in-memory cache reuses the kernels of the same padded shape
+    cache = KernelCache()
+    for _ in range(2):
+        maglib_lff = mf_lfff(kernel_cache=cache)
+        maglib_lff.set_field(_field())
+        maglib_lff.lfff_cube(6, alpha=0.01)
+    assert cache.misses == cache.hits == 2
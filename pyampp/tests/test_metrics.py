@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from pyampp.util.lff import mf_lfff
+from pyampp.util.metrics import force_free_metrics
+
+
+@pytest.fixture(scope='module')
+def lfff_cube():
+    # linear force-free field of a smooth bipole, J = alpha B up to the discretisation
+    y, x = np.mgrid[0:48, 0:48]
+    bz = 1000 * (np.exp(-((x - 18) ** 2 + (y - 24) ** 2) / 40) - np.exp(-((x - 30) ** 2 + (y - 24) ** 2) / 40))
+    maglib_lff = mf_lfff(kernel_cache=False)
+    maglib_lff.set_field(bz)
+    return maglib_lff.lfff_cube(24, alpha=0.05)
+
+
+def test_linear_force_free_field(lfff_cube):
+    metrics = force_free_metrics(lfff_cube['bx'], lfff_cube['by'], lfff_cube['bz'], layout='xyz')
+    assert metrics['cw_sin'] < 0.1
+    assert metrics['theta_j'] < 6
+    assert metrics['mean_abs_fi'] < 1e-3
+    assert metrics['norm_div'] < 1e-2
+
+    # swapping the transverse components breaks both the force-free and the solenoidal condition
+    swapped = force_free_metrics(lfff_cube['by'], lfff_cube['bx'], lfff_cube['bz'], layout='xyz')
+    assert swapped['cw_sin'] > 0.5
+    assert swapped['norm_div'] > 10 * metrics['norm_div']
+
+
+def test_blocks_and_layout_do_not_change_metrics(lfff_cube):
+    ref = force_free_metrics(lfff_cube['bx'], lfff_cube['by'], lfff_cube['bz'], layout='xyz', nz_block=64, workers=1)
+    zyx = [np.ascontiguousarray(lfff_cube[k].transpose((2, 1, 0))) for k in ('bx', 'by', 'bz')]
+    metrics = force_free_metrics(*zyx, nz_block=3, workers=4)
+    assert metrics == pytest.approx(ref, rel=1e-12)
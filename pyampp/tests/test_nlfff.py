@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from pyampp.util.nlfff import NLFFFCheckpoint, multigrid_nlfff
+
+
+class RelaxingWrapper:
+    # stub of MagFieldWrapper: every iteration halves the distance of the cubes to a uniform field,
+    # NLFFF(max_iterations) continues from the loaded cubes; bx and by are swapped on loading
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.calls = 0
+        self.dr = []
+
+    def load_cube_vars(self, bx, by, bz, dr, copy=True):
+        if copy:
+            bx, by, bz = (np.array(b, dtype=np.float64) for b in (bx, by, bz))
+        self.by, self.bx, self.bz = bx, by, bz
+        self.dr.append(dr)
+
+    def NLFFF(self, max_iterations=None):
+        if self.fail_after is not None and self.calls >= self.fail_after:
+            raise RuntimeError("preempted")
+        self.calls += 1
+        for _ in range(40 if max_iterations is None else max_iterations):
+            for b in (self.bx, self.by, self.bz):
+                b += 0.5 * (1.0 - b)
+        return dict(bx=self.bx, by=self.by, bz=self.bz)
+
+    @property
+    def energy(self):
+        return float(sum((b ** 2).sum() for b in (self.bx, self.by, self.bz)))
+
+
+class SingleCallWrapper(RelaxingWrapper):
+    def NLFFF(self):
+        return super().NLFFF()
+
+
+def _cube(shape=(9, 9, 11)):
+    rng = np.random.default_rng(0)
+    return [rng.normal(scale=10, size=shape) for _ in range(3)]
+
+
+@pytest.mark.parametrize('factors', [(1,), (2, 1)])
+def test_resume_after_preemption(tmp_path, factors):
+    kwargs = dict(factors=factors, chunk_iterations=2, tol=1e-9)
+    reference = RelaxingWrapper()
+    ref = multigrid_nlfff(*_cube(), 1.0, maglib=reference, **kwargs)
+    assert all(level['chunks'] > 3 for level in ref['levels'])
+
+    checkpoint = NLFFFCheckpoint(tmp_path / 'checkpoint.h5')
+    preempted = RelaxingWrapper(fail_after=reference.calls - 2)
+    with pytest.raises(RuntimeError, match='preempted'):
+        multigrid_nlfff(*_cube(), 1.0, maglib=preempted, checkpoint=checkpoint, **kwargs)
+    snapshot = checkpoint.load()
+    assert snapshot is not None
+    assert not snapshot[1]['level_done']
+
+    resumed = RelaxingWrapper()
+    res = multigrid_nlfff(*_cube(), 1.0, maglib=resumed, checkpoint=checkpoint, **kwargs)
+    assert resumed.calls == 2
+    assert res['levels'][-1]['resumed']
+    for k in ('bx', 'by', 'bz'):
+        np.testing.assert_array_equal(res[k], ref[k])
+    assert res['energy'] == ref['energy']
+    assert checkpoint.load()[1]['final']
+
+
+def test_checkpoint_of_other_input_is_ignored(tmp_path):
+    checkpoint = NLFFFCheckpoint(tmp_path / 'checkpoint.h5')
+    multigrid_nlfff(*_cube(), 1.0, factors=(1,), maglib=RelaxingWrapper(), checkpoint=checkpoint, chunk_iterations=2)
+    maglib = RelaxingWrapper()
+    res = multigrid_nlfff(*_cube((8, 9, 11)), 1.0, factors=(1,), maglib=maglib, checkpoint=checkpoint,
+                          chunk_iterations=2)
+    assert maglib.calls > 1
+    assert res['bx'].shape == (8, 9, 11)
+
+
+def test_wrapper_without_iteration_limit_solves_in_one_call(tmp_path):
+    maglib = SingleCallWrapper()
+    checkpoint = NLFFFCheckpoint(tmp_path / 'checkpoint.h5')
+    res = multigrid_nlfff(*_cube(), 1.0, factors=(1,), maglib=maglib, checkpoint=checkpoint, chunk_iterations=2)
+    assert maglib.calls == 1
+    assert res['levels'][0]['chunks'] == 1
+    assert checkpoint.load()[1]['final']
+
+
+def test_zero_copy_solves_in_the_input():
+    cube = _cube()
+    res = multigrid_nlfff(*cube, 1.0, factors=(1,), maglib=RelaxingWrapper(), copy=False)
+    assert res['by'] is cube[0]
+
+
+def test_level_voxel_size_from_every_axis():
+    maglib = SingleCallWrapper()
+    res = multigrid_nlfff(*_cube((33, 25, 49)), 2.0, factors=(4, 2, 1), maglib=maglib)
+    assert [level['shape'] for level in res['levels']] == [(9, 7, 13), (17, 13, 25), (33, 25, 49)]
+    assert maglib.dr == pytest.approx([8.0, 4.0, 2.0])
+    assert [level['dr'] for level in res['levels']] == maglib.dr
+
+
+@pytest.mark.parametrize(('shape', 'factors'), [((64, 64, 6), (4, 1)), ((40, 30, 20), (8, 1))])
+def test_anisotropic_levels_are_rejected(shape, factors):
+    maglib = SingleCallWrapper()
+    with pytest.raises(ValueError, match='not isotropic'):
+        multigrid_nlfff(*_cube(shape), 1.0, factors=factors, maglib=maglib)
+    assert maglib.calls == 0
@@ -0,0 +1,94 @@
+import importlib.util
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pyampp.util import nlfff_job
+from pyampp.util.nlfff_job import (MAGFIELD_LIB_ENV, MAGFIELD_LIB_NAME, MAGFIELD_LIB_SUFFIX, NLFFFJob,
+                                   magfield_library_path, supports_zero_copy)
+
+
+class StubWrapper:
+    # mimics MagFieldWrapper: bx and by are swapped on loading, the solution is computed in place
+    def load_cube_vars(self, bx, by, bz, dr, copy=True):
+        if copy:
+            bx, by, bz = (np.array(b, dtype=np.float64) for b in (bx, by, bz))
+        self.by, self.bx, self.bz = bx, by, bz
+
+    def NLFFF(self):
+        self.bx *= 2
+        self.by *= 3
+        self.bz *= 5
+        return dict(bx=self.bx, by=self.by, bz=self.bz)
+
+    @property
+    def energy(self):
+        return 1.0
+
+
+class CopyingStubWrapper(StubWrapper):
+    def load_cube_vars(self, bx, by, bz, dr):
+        super().load_cube_vars(bx, by, bz, dr)
+
+
+@pytest.fixture
+def pyamafil_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv(MAGFIELD_LIB_ENV, raising=False)
+    spec = SimpleNamespace(submodule_search_locations=[str(tmp_path)])
+    monkeypatch.setattr(importlib.util, 'find_spec', lambda name: spec if name == 'pyAMaFiL' else None)
+    return tmp_path
+
+
+def test_library_path_globs_the_solver(pyamafil_dir):
+    (pyamafil_dir / f"aaa{MAGFIELD_LIB_SUFFIX}").touch()
+    lib = pyamafil_dir / 'lib' / f"{MAGFIELD_LIB_NAME}-1.0{MAGFIELD_LIB_SUFFIX}"
+    lib.parent.mkdir()
+    lib.touch()
+    assert magfield_library_path() == str(lib)
+
+
+def test_library_path_missing_or_ambiguous(pyamafil_dir):
+    with pytest.raises(ImportError, match='not found'):
+        magfield_library_path()
+    for version in ('1', '2'):
+        (pyamafil_dir / f"{MAGFIELD_LIB_NAME}{version}{MAGFIELD_LIB_SUFFIX}").touch()
+    with pytest.raises(ImportError, match='several'):
+        magfield_library_path()
+
+
+def test_library_path_from_environment(tmp_path, monkeypatch):
+    lib = tmp_path / 'solver.so'
+    lib.touch()
+    monkeypatch.setenv(MAGFIELD_LIB_ENV, str(lib))
+    assert magfield_library_path() == str(lib)
+    monkeypatch.setenv(MAGFIELD_LIB_ENV, str(tmp_path / 'missing.so'))
+    with pytest.raises(ImportError):
+        magfield_library_path()
+
+
+def test_preferred_wrapper_falls_back_to_pyamafil(pyamafil_dir, monkeypatch):
+    monkeypatch.setattr(nlfff_job, 'default_wrapper_factory', CopyingStubWrapper)
+    assert isinstance(nlfff_job.preferred_wrapper_factory(), CopyingStubWrapper)
+
+
+def test_supports_zero_copy():
+    assert supports_zero_copy(StubWrapper())
+    assert not supports_zero_copy(CopyingStubWrapper())
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs the fork start method')
+@pytest.mark.parametrize('wrapper', [StubWrapper, CopyingStubWrapper])
+def test_job_result_matches_direct_solve(wrapper):
+    rng = np.random.default_rng(0)
+    cube = [rng.normal(size=(6, 7, 8)) for _ in range(3)]
+    maglib = wrapper()
+    maglib.load_cube_vars(*cube, 1.0)
+    ref = maglib.NLFFF()
+
+    job = NLFFFJob(*cube, 1.0, wrapper_factory=wrapper, start_method='fork').start()
+    res = job.result(timeout=60)
+    assert job.status()['energy'] == 1.0
+    for k in ('bx', 'by', 'bz'):
+        np.testing.assert_array_equal(res[k], ref[k])
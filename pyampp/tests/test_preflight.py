@@ -0,0 +1,60 @@
+import sys
+
+import numpy as np
+import pytest
+
+from pyampp.util import preflight
+from pyampp.util.preflight import DEFAULT_CALIBRATION, estimate_resources
+
+
+@pytest.fixture
+def calibration():
+    return dict(DEFAULT_CALIBRATION, baseline_bytes=0, calibrated=False)
+
+
+def test_nlfff_peak_scales_with_voxels(calibration):
+    small = estimate_resources((40, 30, 20), calibration=calibration)
+    large = estimate_resources((40, 30, 40), calibration=calibration)
+    cube = 40 * 30 * 20 * 8
+    # input cubes, the wrapper's copies and the solver workspace
+    expected = (3 + 3 + calibration['nlfff_workspace']) * cube
+    assert large['nlfff']['peak_bytes'] - small['nlfff']['peak_bytes'] == pytest.approx(expected, abs=1)
+    assert large['nlfff']['runtime_s'] / small['nlfff']['runtime_s'] == pytest.approx(2 ** (4 / 3))
+
+    single = estimate_resources((40, 30, 40), precision='single', calibration=calibration)
+    assert large['nlfff']['peak_bytes'] - single['nlfff']['peak_bytes'] == 3 * 40 * 30 * 40 * 4
+
+
+def test_lines_peak_per_seed(calibration):
+    def lines(seeds, max_length=0):
+        return estimate_resources((40, 30, 20), seeds=seeds, max_length=max_length, calibration=calibration)['lines']
+
+    # six int32 and two float64 arrays per seed, lines_start, lines_length and lines_index with coordinates
+    assert lines(2000)['peak_bytes'] - lines(1000)['peak_bytes'] == 1000 * (6 * 4 + 2 * 8)
+    assert lines(2000, 10)['peak_bytes'] - lines(1000, 10)['peak_bytes'] == 1000 * (6 * 4 + 2 * 8 + 16)
+    assert lines(1000, 20)['peak_bytes'] - lines(1000, 10)['peak_bytes'] == 10 * 4 * 8
+    assert lines(2000)['runtime_s'] == pytest.approx(2 * lines(1000)['runtime_s'])
+
+    auto = lines(1000, -1)
+    assert auto['peak_bytes'] - lines(1000, 1)['peak_bytes'] == \
+        (int(np.ceil(np.linalg.norm((40, 30, 20)) * 1000)) - 1) * 4 * 8
+
+
+def test_only_nlfff_peak_is_calibrated(calibration):
+    res = estimate_resources((40, 30, 20), calibration=calibration)
+    assert not any(res[stage]['peak_calibrated'] for stage in preflight.STAGES)
+    res = estimate_resources((40, 30, 20), calibration=dict(calibration, calibrated=True, stages=list(preflight.STAGES)))
+    assert [res[stage]['peak_calibrated'] for stage in preflight.STAGES] == [False, True, False]
+
+
+@pytest.mark.parametrize(('limit', 'code'), [('1M', 2), ('1T', None)])
+def test_memory_limit_exit_status(monkeypatch, capsys, limit, code):
+    monkeypatch.setattr(preflight, 'load_calibration', lambda path=None: dict(DEFAULT_CALIBRATION, calibrated=False))
+    monkeypatch.setattr(sys, 'argv', ['preflight', '--dims', '100', '100', '80', '--memory-limit', limit])
+    if code is None:
+        preflight.main()
+    else:
+        with pytest.raises(SystemExit) as exc:
+            preflight.main()
+        assert exc.value.code == code
+        assert 'exceeds the limit' in capsys.readouterr().out
@@ -0,0 +1,71 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.wcs import WCS
+from sunpy.coordinates import frames, get_earth
+from sunpy.map import Map, make_fitswcs_header
+
+from pyampp.util import reprojection
+from pyampp.util.reprojection import clear_mapping_cache, pixel_mapping, reproject_maps
+
+OBSTIME = '2024-05-10T12:00:00'
+
+
+@pytest.fixture(scope='module')
+def frame():
+    return frames.Helioprojective(observer=get_earth(OBSTIME), obstime=OBSTIME)
+
+
+@pytest.fixture(scope='module')
+def vector_maps(frame):
+    header = make_fitswcs_header((96, 96), SkyCoord(0 * u.arcsec, 0 * u.arcsec, frame=frame),
+                                 scale=[2.0, 2.0] * u.arcsec / u.pix)
+    rng = np.random.default_rng(4)
+    y, x = np.mgrid[0:96, 0:96]
+    return [Map(np.sin(x / 7 + k) * np.cos(y / 9) * 100 + rng.normal(size=(96, 96)), header) for k in range(3)]
+
+
+@pytest.fixture(scope='module')
+def target_header(frame):
+    return make_fitswcs_header((40, 50), SkyCoord(10 * u.arcsec, -5 * u.arcsec, frame=frame),
+                               scale=[3.0, 3.0] * u.arcsec / u.pix, rotation_angle=20 * u.deg)
+
+
+@pytest.mark.parametrize(('method', 'kwargs'), [
+    ('bilinear', dict(algorithm='interpolation', order='bilinear')),
+    ('adaptive', dict(algorithm='adaptive', roundtrip_coords=False)),
+    ('exact', dict(algorithm='exact')),
+])
+def test_reproject_maps_matches_reproject_to(vector_maps, target_header, method, kwargs):
+    out = reproject_maps(vector_maps, target_header, method=method)
+    for smap, res in zip(vector_maps, out):
+        ref = smap.reproject_to(target_header, **kwargs)
+        assert res.data.shape == ref.data.shape
+        np.testing.assert_array_equal(np.isfinite(res.data), np.isfinite(ref.data))
+        np.testing.assert_allclose(res.data, ref.data, rtol=0, atol=1e-9, equal_nan=True)
+
+
+def test_pixel_mapping_cache(vector_maps, target_header, frame):
+    clear_mapping_cache()
+    reproject_maps(vector_maps, target_header, method='bilinear')
+    # the three maps share one grid and one mapping
+    assert len(reprojection._mapping_cache) == 1
+
+    source = vector_maps[0]
+    target_wcs = WCS(target_header)
+    mapping = pixel_mapping(source.wcs, source.data.shape, target_wcs)
+    assert pixel_mapping(source.wcs, source.data.shape, target_wcs) is mapping
+    assert not mapping[0].flags.writeable
+    assert len(reprojection._mapping_cache) == 1
+
+    uncached = pixel_mapping(source.wcs, source.data.shape, target_wcs, cache=False)
+    assert uncached is not mapping
+    np.testing.assert_array_equal(uncached[0], mapping[0])
+
+    other = WCS(make_fitswcs_header((30, 30), SkyCoord(0 * u.arcsec, 0 * u.arcsec, frame=frame),
+                                    scale=[2.0, 2.0] * u.arcsec / u.pix))
+    pixel_mapping(source.wcs, source.data.shape, other)
+    assert len(reprojection._mapping_cache) == 2
+    clear_mapping_cache()
+    assert len(reprojection._mapping_cache) == 0
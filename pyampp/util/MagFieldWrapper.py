@@ -4,6 +4,8 @@ from numpy import linalg as LA
 from scipy.io import readsav
 import astropy.units as u
 import sunpy.sun.constants as sun
+from pyampp.util.energy import magnetic_energy, standard_window
+from pyampp.util.fieldlines import FieldLines
 
 class MagFieldWrapper:
     PASSED_NONE   = 0
@@ -70,6 +72,9 @@ class MagFieldWrapper:
         self.__by = None
         self.__bz = None
         self.__N  = None
+        self.__lines_argtypes = {}
+        self.__lines_key = None
+        self.__buffers = None
 
     #-------------------------------------------------------------------------------
     def set_int(self, prop, vint):
@@ -111,10 +116,18 @@ class MagFieldWrapper:
 
         pass
 
-    def load_cube_vars(self, bx, by, bz, dr):
-        self.__by = bx.astype(np.float64, order="C")
-        self.__bx = by.astype(np.float64, order="C")
-        self.__bz = bz.astype(np.float64, order="C")
+    def load_cube_vars(self, bx, by, bz, dr, copy = True):
+        # copy = False: C-ordered float64 arrays (e.g. mf_lfff.lfff_cube(..., layout = 'zyx')) are used
+        #               as is, so NLFFF overwrites them in place with the solution; other arrays are
+        #               still converted
+        if copy:
+            self.__by = bx.astype(np.float64, order="C")
+            self.__bx = by.astype(np.float64, order="C")
+            self.__bz = bz.astype(np.float64, order="C")
+        else:
+            self.__by = np.require(bx, dtype = np.float64, requirements = ["C", "A", "W"])
+            self.__bx = np.require(by, dtype = np.float64, requirements = ["C", "A", "W"])
+            self.__bz = np.require(bz, dtype = np.float64, requirements = ["C", "A", "W"])
         Nc = self.__bx.shape
         self.__N = np.array([Nc[2], Nc[1], Nc[0]], dtype = np.int32)
         self.__step = np.array([dr, dr, dr], dtype = np.float64)
@@ -124,13 +137,18 @@ class MagFieldWrapper:
             , weight_bound_size = 0.1
             , derivative_stencil = 3
             , dense_grid_use = 1
+            , max_iterations = None
              ):
 
         # assert box is None
+        # max_iterations: stop the solver after this many iterations, the loaded cubes then hold the
+        #                 intermediate solution and NLFFF can be called again to continue from it
 
         self.set_double('weight_bound_size', weight_bound_size)
         self.set_int('derivative_stencil', derivative_stencil)
         self.set_int('dense_grid_use', dense_grid_use)
+        if max_iterations is not None:
+            self.set_int('max_iterations', int(max_iterations))
 
         rc = self.__func_set['NLFFF_func'](self.__N, self.__bx, self.__by, self.__bz, weight_bound_size)
 
@@ -141,17 +159,25 @@ class MagFieldWrapper:
     #-------------------------------------------------------------------------------
     @property
     def energy(self):
-        left = np.floor(0.1*self.__N).astype(np.int32)
-        right = np.floor(0.9*self.__N).astype(np.int32)
-        absB2 = (self.__bx[left[0]:right[0],left[1]:right[1],1:right[2]]**2 
-               + self.__by[left[0]:right[0],left[1]:right[1],1:right[2]]**2 
-               + self.__bz[left[0]:right[0],left[1]:right[1],1:right[2]]**2 
-                )
-        totalB2 = np.sum(absB2)
-        volume = np.prod(self.__step)
-
-        return totalB2 / 8 / np.pi * volume
-    
+        # same window as energy_profile: the cubes are C-ordered (z, y, x), heights on the first axis
+        window = standard_window(self.__bx.shape, 0)
+
+        return magnetic_energy(self.__bx, self.__by, self.__bz, self.__step, z_axis = 0, window = window)['energy']
+
+    #-------------------------------------------------------------------------------
+    def energy_profile(self, potential = None, z_axis = 0, window = None, mask = None, nz_block = 16):
+        # total, per-height and per-column energy of the loaded (solved) cube in one streaming pass;
+        # potential = (bx, by, bz) as passed to load_cube_vars adds the potential and free energies,
+        # window = None uses standard_window (10-90% laterally, from the first layer up to 90% in height)
+        if window is None:
+            window = standard_window(self.__bx.shape, z_axis)
+        if potential is not None:
+            potential = (potential[1], potential[0], potential[2])
+
+        return magnetic_energy(self.__bx, self.__by, self.__bz, self.__step
+                             , potential = potential, z_axis = z_axis, window = window, mask = mask, nz_block = nz_block
+                              )
+
     #-------------------------------------------------------------------------------
     def est_max_coords(self, n_total = 0):
         line_length_est = LA.norm(self.__bx.shape)
@@ -159,6 +185,74 @@ class MagFieldWrapper:
             n_total = self.__bx.size
         return np.int64(np.ceil(line_length_est*n_total))
     
+    #-------------------------------------------------------------------------------
+    def __lines_func(self, with_seeds, with_coords):
+        # argtypes depend only on whether seeds and coordinates are passed; they are built once per signature
+        # and assigned only when the signature changes
+        key = (with_seeds, with_coords)
+        lines_func = self.__func_set['lines_func']
+        if key == self.__lines_key:
+            return lines_func
+
+        if key not in self.__lines_argtypes:
+            seeds_type = self.__mptr2 if with_seeds else self.__mvoid
+            coords_type = self.__mptr2 if with_coords else self.__mvoid
+            ls_type = self.__mp64 if with_coords else self.__mvoid
+            lv_type = self.__mpint1 if with_coords else self.__mvoid
+            self.__lines_argtypes[key] = [self.__mpint1, self.__mptr3, self.__mptr3, self.__mptr3   # 1-4
+                                        , self.__mdw, self.__mreal                              #   5-6 uint32_t _cond = 0x3, REALTYPE_A chromoLevel = 0,
+                                        , seeds_type, self.__mint                               #   7-8 REALTYPE_A  *_seeds = nullptr, int _Nseeds = 0,
+                                        , self.__mint, self.__mreal, self.__mreal, self.__mreal #   9-12 int nProc = 0, REALTYPE_A step = 1.0, REALTYPE_A tolerance = 1e-3, REALTYPE_A boundAchieve = 1e-3,
+                                        , self.__mpint1, self.__mpint1                          #   13-14 int *_nLines = nullptr, int *_nPassed = nullptr,
+                                        , self.__mpint1, self.__mptr1, self.__mptr1             #   15-17 int *_voxelStatus = nullptr, REALTYPE_A *_physLength = nullptr, REALTYPE_A *_avField = nullptr,
+                                        , lv_type, self.__mpint1                                #   18-19 int *_linesLength = nullptr, int *_codes = nullptr,
+                                        , self.__mpint1, self.__mpint1, self.__mpint1           #   20-22 int *_startIdx = nullptr, int *_endIdx = nullptr, int *_apexIdx = nullptr,
+                                        , self.__m64, self.__mp64, coords_type                  #   23-25 uint64_t _maxCoordLength = 0, uint64_t *_totalLength = nullptr, REALTYPE_A *_coords = nullptr, 
+                                        , ls_type, lv_type, self.__mpint1                       #   26-28 uint64_t *_linesStart = nullptr, int *_linesIndex = nullptr, int *seedIdx = nullptr);
+                                         ]
+        lines_func.argtypes = self.__lines_argtypes[key]
+        self.__lines_key = key
+
+        return lines_func
+
+    #-------------------------------------------------------------------------------
+    def __lines_buffers(self, n_total, max_length, reuse):
+        # output arrays of lines(); with reuse the previous ones are cleared and sliced when large enough
+        buffers = self.__buffers
+        if not reuse or buffers is None or buffers['voxel_status'].size < n_total or buffers['coords'].shape[0] < max_length:
+            buffers = dict(n_lines = np.zeros([1], dtype = np.int32)
+                         , n_passed = np.zeros([1], dtype = np.int32)
+                         , total_length = np.zeros([1], dtype = np.uint64)
+                         , voxel_status = np.zeros([n_total], dtype = np.int32)
+                         , phys_length = np.zeros([n_total], dtype = np.float64)
+                         , av_field = np.zeros([n_total], dtype = np.float64)
+                         , codes = np.zeros([n_total], dtype = np.int32)
+                         , start_idx = np.zeros([n_total], dtype = np.int32)
+                         , end_idx = np.zeros([n_total], dtype = np.int32)
+                         , apex_idx = np.zeros([n_total], dtype = np.int32)
+                         , seed_idx = np.zeros([n_total], dtype = np.int32)
+                         , lines_start = np.zeros([n_total if max_length else 0], dtype = np.uint64)
+                         , lines_length = np.zeros([n_total if max_length else 0], dtype = np.int32)
+                         , lines_index = np.zeros([n_total if max_length else 0], dtype = np.int32)
+                         , coords = np.zeros([max_length, 4], dtype = np.float64, order="C")
+                          )
+            if reuse:
+                self.__buffers = buffers
+            return buffers
+
+        res = {}
+        for key, buffer in buffers.items():
+            if key == 'coords':
+                res[key] = buffer[:max_length]
+            elif key in ('n_lines', 'n_passed', 'total_length'):
+                res[key] = buffer
+            else:
+                res[key] = buffer[:n_total]
+            if key != 'coords':
+                res[key].fill(0)
+
+        return res
+
     #-------------------------------------------------------------------------------
     def lines(self
             , reduce_passed = None
@@ -170,11 +264,17 @@ class MagFieldWrapper:
             , tolerance = 1e-3
             , tolerance_bound = 1e-3
             , n_processes = 0
+            , compact = False
+            , reuse_buffers = False
              ):
 
         # assert box is None
+        # compact = True: the traced lines are returned as FieldLines (float32 points trimmed to total_length
+        #                 plus line offsets) under 'lines' instead of the padded coords/lines_* buffers
+        # reuse_buffers = True: output arrays are kept in the wrapper and reused by the next call when they are
+        #                       large enough, so the returned arrays are overwritten by it; coords beyond
+        #                       total_length are not cleared
 
-        seeds_type = self.__mvoid
         if seeds is None:
             n_seeds = 0
             arg_seeds = 0
@@ -183,9 +283,8 @@ class MagFieldWrapper:
                 reduce_passed = self.PASSED_CLOSED | self.PASSED_OPENED
         else:
             # assert seeds is not 2D
-            arg_seeds = np.array(seeds, dtype = np.float64, order = 'C')
+            arg_seeds = np.require(seeds, dtype = np.float64, requirements = "C")
             n_seeds = arg_seeds.shape[0]
-            seeds_type = self.__mptr2
             n_total = n_seeds
             if reduce_passed is None:
                 reduce_passed = self.PASSED_NONE
@@ -194,47 +293,24 @@ class MagFieldWrapper:
             max_length = self.est_max_coords(n_total)
         max_length = np.int64(max_length)
 
-        n_lines = np.array([0], dtype = np.int32)
-        n_passed = np.array([0], dtype = np.int32)
-        voxel_status = np.zeros([n_total], dtype = np.int32)
-        phys_length = np.zeros([n_total], dtype = np.float64)
-        av_field = np.zeros([n_total], dtype = np.float64)
-        codes = np.zeros([n_total], dtype = np.int32)
-        start_idx = np.zeros([n_total], dtype = np.int32)
-        end_idx = np.zeros([n_total], dtype = np.int32)
-        apex_idx = np.zeros([n_total], dtype = np.int32)
-        seed_idx = np.zeros([n_total], dtype = np.int32)
-        total_length = np.array([0], dtype = np.uint64)
-        
+        buffers = self.__lines_buffers(n_total, max_length, reuse_buffers)
+        n_lines, n_passed, total_length = buffers['n_lines'], buffers['n_passed'], buffers['total_length']
+        voxel_status, phys_length, av_field = buffers['voxel_status'], buffers['phys_length'], buffers['av_field']
+        codes, seed_idx = buffers['codes'], buffers['seed_idx']
+        start_idx, end_idx, apex_idx = buffers['start_idx'], buffers['end_idx'], buffers['apex_idx']
+
         if max_length == 0:
-            coords_type = self.__mvoid
             coords = 0
-            ls_type = self.__mvoid
             lines_start = 0
-            lv_type = self.__mvoid
             lines_length = 0
             lines_index = 0
         else:
-            coords_type = self.__mptr2
-            coords = np.zeros([max_length, 4], dtype = np.float64, order="C")
-            ls_type = self.__mp64
-            lines_start = np.zeros([n_total], dtype = np.uint64)
-            lv_type = self.__mpint1
-            lines_length = np.zeros([n_total], dtype = np.int32)
-            lines_index = np.zeros([n_total], dtype = np.int32)
+            coords = buffers['coords']
+            lines_start = buffers['lines_start']
+            lines_length = buffers['lines_length']
+            lines_index = buffers['lines_index']
 
-        lines_func = self.__func_set['lines_func']
-        lines_func.argtypes = [self.__mpint1, self.__mptr3, self.__mptr3, self.__mptr3   # 1-4
-                             , self.__mdw, self.__mreal                              #   5-6 uint32_t _cond = 0x3, REALTYPE_A chromoLevel = 0,
-                             , seeds_type, self.__mint                               #   7-8 REALTYPE_A  *_seeds = nullptr, int _Nseeds = 0,
-                             , self.__mint, self.__mreal, self.__mreal, self.__mreal #   9-12 int nProc = 0, REALTYPE_A step = 1.0, REALTYPE_A tolerance = 1e-3, REALTYPE_A boundAchieve = 1e-3,
-                             , self.__mpint1, self.__mpint1                          #   13-14 int *_nLines = nullptr, int *_nPassed = nullptr,
-                             , self.__mpint1, self.__mptr1, self.__mptr1             #   15-17 int *_voxelStatus = nullptr, REALTYPE_A *_physLength = nullptr, REALTYPE_A *_avField = nullptr,
-                             , lv_type, self.__mpint1                                #   18-19 int *_linesLength = nullptr, int *_codes = nullptr,
-                             , self.__mpint1, self.__mpint1, self.__mpint1           #   20-22 int *_startIdx = nullptr, int *_endIdx = nullptr, int *_apexIdx = nullptr,
-                             , self.__m64, self.__mp64, coords_type                  #   23-25 uint64_t _maxCoordLength = 0, uint64_t *_totalLength = nullptr, REALTYPE_A *_coords = nullptr, 
-                             , ls_type, lv_type, self.__mpint1                       #   26-28 uint64_t *_linesStart = nullptr, int *_linesIndex = nullptr, int *seedIdx = nullptr);
-                              ]
+        lines_func = self.__lines_func(seeds is not None, max_length != 0)
 
         non_passed = lines_func(self.__N, self.__bx, self.__by, self.__bz
                       , reduce_passed, chromo_level 
@@ -259,22 +335,29 @@ class MagFieldWrapper:
             voxel_status = np.reshape(voxel_status, np.flip(self.__N))
             codes = np.reshape(codes, np.flip(self.__N))
 
-        return dict(n_lines = n_lines[0]
-                  , n_passed = n_passed[0]
-                  , non_passed = non_passed
-                  , voxel_status = voxel_status
-                  , phys_length = phys_length
-                  , av_field = av_field
-                  , lines_length = lines_length
-                  , codes = codes
-                  , start_idx = start_idx
-                  , end_idx = end_idx
-                  , apex_idx = apex_idx
-                  , max_length = max_length
-                  , total_length = total_length
-                  , coords = coords
-                  , lines_start = lines_start
-                  , lines_index = lines_index
-                  , seed_idx = seed_idx
-                   )        
-             # reorder - 2do ?
\ No newline at end of file
+        res = dict(n_lines = n_lines[0]
+                 , n_passed = n_passed[0]
+                 , non_passed = non_passed
+                 , voxel_status = voxel_status
+                 , phys_length = phys_length
+                 , av_field = av_field
+                 , lines_length = lines_length
+                 , codes = codes
+                 , start_idx = start_idx
+                 , end_idx = end_idx
+                 , apex_idx = apex_idx
+                 , max_length = max_length
+                 , total_length = total_length
+                 , coords = coords
+                 , lines_start = lines_start
+                 , lines_index = lines_index
+                 , seed_idx = seed_idx
+                  )        
+             # reorder - 2do ?
+
+        if compact:
+            res['lines'] = FieldLines.from_lines(res)
+            for key in ('coords', 'lines_start', 'lines_length', 'lines_index'):
+                del res[key]
+
+        return res
\ No newline at end of file
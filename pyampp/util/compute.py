@@ -15,22 +15,29 @@ import numpy as np
 import datetime
 
 import locale
-from sunpy.map import all_coordinates_from_map
+import time
 import h5py
 
-from pyampp.util.lff import mf_lfff
+from pyampp.util.energy import magnetic_energy, standard_window
+from pyampp.util.hmi import map_b2ptr, read_map_header, read_map_section
+from pyampp.util.lff import mf_lfff, PRECISION_DTYPES
+from pyampp.util.metrics import force_free_metrics
+from pyampp.util.nlfff import (solution_as_input, cea_row_latitudes, differential_rotation_shift,
+                               carrington_lon_shift, warm_start_guess, multigrid_nlfff)
+from pyampp.util.nlfff_job import preferred_wrapper_factory
+from pyampp.util.reprojection import reproject_maps
 # from .gx_chromo.combo_model import combo_model
-from pyAMaFiL.mag_field_wrapper import MagFieldWrapper
 
-maglib = MagFieldWrapper()
+# in-repo wrapper of pyAMaFiL's solver library, which loads the (z, y, x) cubes without copying them,
+# or pyAMaFiL's wrapper if the library cannot be located
+maglib = preferred_wrapper_factory()
 
 os.environ['OMP_NUM_THREADS'] = '16'  # number of parallel threads
 locale.setlocale(locale.LC_ALL, "C");
 
 
-def cutout2box(_map, center_x, center_y, dx_km, shape):
-    hmi_wcs = _map.wcs
-    center_crd = crd = SkyCoord(center_x, center_y, unit=u.arcsec, frame=_map.coordinate_frame) \
+def cutout_box_header(_map, center_x, center_y, dx_km, shape):
+    center_crd = SkyCoord(center_x, center_y, unit=u.arcsec, frame=_map.coordinate_frame) \
         .transform_to("heliographic_carrington")
     lon = center_crd.lon
     lat = center_crd.lat
@@ -42,54 +49,55 @@ def cutout2box(_map, center_x, center_y, dx_km, shape):
 
     scale = np.arcsin(dx_km / origin.radius).to(u.deg) / u.pix
     scale = u.Quantity((scale, scale))
-    box_header = sunpy.map.make_fitswcs_header(shape, origin,
-                                               projection_code='CEA', scale=scale)
+    return sunpy.map.make_fitswcs_header(shape, origin, projection_code='CEA', scale=scale)
 
-    outmap = _map.reproject_to(box_header, algorithm="adaptive", roundtrip_coords=False)
-    return outmap
 
+def cutout2box(_map, center_x, center_y, dx_km, shape, method="adaptive"):
+    return cutout2boxes([_map], center_x, center_y, dx_km, shape, method=method)[0]
 
-def hmi_b2ptr(map_field, map_inclination, map_azimuth):
-    sz = map_field.data.shape
-    ny, nx = sz
 
-    field = map_field.data
-    gamma = np.deg2rad(map_inclination.data)
-    psi = np.deg2rad(map_azimuth.data)
+def cutout2boxes(maps, center_x, center_y, dx_km, shape, method="adaptive"):
+    """Reprojects several maps onto the same CEA box bottom
 
-    b_xi = -field * np.sin(gamma) * np.sin(psi)
-    b_eta = field * np.sin(gamma) * np.cos(psi)
-    b_zeta = field * np.cos(gamma)
+    Maps on the same grid (e.g. Bp, Bt, Br) are stacked and reprojected in one pass, see reproject_maps.
+    The box is defined by the first map, as in cutout2box.
 
-    foo = all_coordinates_from_map(map_field).transform_to("heliographic_stonyhurst")
-    phi = foo.lon
-    lambda_ = foo.lat
+    Args:
+        method (str): reprojection method, one of REPROJECT_METHODS ("bilinear", "bicubic", "adaptive", "exact")
 
-    b = np.deg2rad(map_field.fits_header["crlt_obs"])
-    p = np.deg2rad(-map_field.fits_header["crota2"])
+    Returns:
+        list of sunpy.map.GenericMap in the order of maps
+    """
+    box_header = cutout_box_header(maps[0], center_x, center_y, dx_km, shape)
+    return reproject_maps(maps, box_header, method=method)
 
-    phi, lambda_ = np.deg2rad(phi), np.deg2rad(lambda_)
 
-    sinb, cosb = np.sin(b), np.cos(b)
-    sinp, cosp = np.sin(p), np.cos(p)
-    sinphi, cosphi = np.sin(phi), np.cos(phi)  # nx*ny
-    sinlam, coslam = np.sin(lambda_), np.cos(lambda_)  # nx*ny
+def cutout_fov_coords(_map, center_x, center_y, dx_km, shape):
+    """Helioprojective bounding box of the footprint of the cutout2box box in the frame of _map
 
-    k11 = coslam * (sinb * sinp * cosphi + cosp * sinphi) - sinlam * cosb * sinp
-    k12 = - coslam * (sinb * cosp * cosphi - sinp * sinphi) + sinlam * cosb * cosp
-    k13 = coslam * cosb * cosphi + sinlam * sinb
-    k21 = sinlam * (sinb * sinp * cosphi + cosp * sinphi) + coslam * cosb * sinp
-    k22 = - sinlam * (sinb * cosp * cosphi - sinp * sinphi) - coslam * cosb * cosp
-    k23 = sinlam * cosb * cosphi - coslam * sinb
-    k31 = - sinb * sinp * sinphi + cosp * cosphi
-    k32 = sinb * cosp * sinphi + sinp * cosphi
-    k33 = - cosb * sinphi
+    Args:
+        _map (sunpy.map.GenericMap): map (or header-only map, see read_map_header) the box is cut from
+        center_x, center_y, dx_km, shape: as in cutout2box
 
-    bptr = np.zeros((3, nx, ny))
+    Returns:
+        [bottom_left, top_right] SkyCoords, for read_map_section
+    """
+    box_map = sunpy.map.Map(np.zeros(shape, dtype=np.float32), cutout_box_header(_map, center_x, center_y, dx_km, shape))
+    ny, nx = shape
+    # pixel edges of the box outline
+    edge_x = np.concatenate([np.arange(nx + 1), np.full(ny + 1, nx), np.arange(nx + 1), np.zeros(ny + 1)]) - 0.5
+    edge_y = np.concatenate([np.zeros(nx + 1), np.arange(ny + 1), np.full(nx + 1, ny), np.arange(ny + 1)]) - 0.5
+    hpc = box_map.pixel_to_world(edge_x * u.pix, edge_y * u.pix).transform_to(_map.coordinate_frame)
+    tx, ty = hpc.Tx.to_value(u.arcsec), hpc.Ty.to_value(u.arcsec)
+    if not np.isfinite(tx).any():
+        raise ValueError(f"box at ({center_x}, {center_y}) arcsec is not on the solar disk")
+    return [SkyCoord(np.nanmin(tx) * u.arcsec, np.nanmin(ty) * u.arcsec, frame=_map.coordinate_frame),
+            SkyCoord(np.nanmax(tx) * u.arcsec, np.nanmax(ty) * u.arcsec, frame=_map.coordinate_frame)]
 
-    bptr[0, :, :] = k31 * b_xi + k32 * b_eta + k33 * b_zeta
-    bptr[1, :, :] = k21 * b_xi + k22 * b_eta + k23 * b_zeta
-    bptr[2, :, :] = k11 * b_xi + k12 * b_eta + k13 * b_zeta
+
+def hmi_b2ptr(map_field, map_inclination, map_azimuth):
+    # (Bp, Bt, Br) in one float32 array, filled tile by tile by the fused kernel
+    bptr = map_b2ptr(map_field, map_inclination, map_azimuth)
 
     header = map_field.fits_header
     map_bp = sunpy.map.Map(bptr[0, :, :], header)
@@ -99,7 +107,8 @@ def hmi_b2ptr(map_field, map_inclination, map_azimuth):
     return map_bp, map_bt, map_br
 
 
-def ampp_field(dl_path, out_model, x, y, dx, dy, dz, res):
+def ampp_field(dl_path, out_model, x, y, dx, dy, dz, res, precision="double", slab_size=None, warm_start=None,
+               reprojection="adaptive", checkpoint=None, chunk_iterations=None):
     """Creates a model of coronal magnetic fields, including potential, nlfff and thermal corona model
 
     Args:
@@ -111,6 +120,18 @@ def ampp_field(dl_path, out_model, x, y, dx, dy, dz, res):
         dy (int): number of voxels in Y direction
         dz (int): number of voxels in Z (vertical, to corona) direction
         res (dimensional astropy Quantity)
+        precision (str): "double" or "single" (float32 potential extrapolation and stored cubes;
+            the NLFFF solver itself always runs in double precision)
+        slab_size (int): if set, the potential cube is streamed into chunked HDF5 datasets
+            slab_size height layers at a time, instead of being built in memory first
+        warm_start (str): path to the model file of a previous epoch of the same box; its NLFFF solution,
+            differentially rotated to this epoch and with the new boundaries injected, is the initial guess
+            of the NLFFF solver instead of the potential field
+        reprojection (str): method the HMI maps are reprojected onto the box bottom with, one of REPROJECT_METHODS;
+            "bilinear" and "bicubic" are fast, "exact" is flux-conserving, see benchmark_reprojection
+        checkpoint (str or NLFFFCheckpoint): HDF5 file the in-progress NLFFF solution is saved to; a rerun with
+            the same inputs resumes from its latest snapshot, see multigrid_nlfff
+        chunk_iterations (int): number of solver iterations between two checkpoint snapshots, None solves in one call
 
     Returns:
         None
@@ -132,80 +153,152 @@ def ampp_field(dl_path, out_model, x, y, dx, dy, dz, res):
     # wcs_rsun = 6.96e8
     res_km = res.to(u.km).value
 
-    map_field = sunpy.map.Map(field_path)
-    map_inclination = sunpy.map.Map(incli_path)
-    map_azimuth = sunpy.map.Map(azimu_path)
-    map_disambig = sunpy.map.Map(disam_path)
+    # read only the part of the full-disk segments under the box footprint, with a margin for the reprojection
+    fov = cutout_fov_coords(read_map_header(field_path), x, y, res_km * u.km, [dy, dx])
+    map_field = read_map_section(field_path, *fov, pad=8)
+    map_inclination = read_map_section(incli_path, *fov, pad=8)
+    map_azimuth = read_map_section(azimu_path, *fov, pad=8)
+    map_disambig = read_map_section(disam_path, *fov, pad=8)
 
-    map_conti = sunpy.map.Map(conti_path)
-    map_losma = sunpy.map.Map(losma_path)
+    map_conti = read_map_section(conti_path, *fov, pad=8)
+    map_losma = read_map_section(losma_path, *fov, pad=8)
 
     dis = map_disambig.data
     map_azimuth.data[:, :] = map_azimuth.data + dis * 180.
 
     map_bp, map_bt, map_br = hmi_b2ptr(map_field, map_inclination, map_azimuth)
-    box_bx = cutout2box(map_bp, x, y, res_km * u.km, [dy, dx])
-    box_by = cutout2box(map_bt, x, y, res_km * u.km, [dy, dx])
-    box_bz = cutout2box(map_br, x, y, res_km * u.km, [dy, dx])
+    # vector components and the base maps in one call, the components share one coordinate mapping
+    box_bx, box_by, box_bz, base_bz, base_ic = cutout2boxes([map_bp, map_bt, map_br, map_losma, map_conti],
+                                                            x, y, res_km * u.km, [dy, dx], method=reprojection)
     box_by.data[:, :] *= -1
 
     # earth_observer = SkyCoord(0 * u.deg, 0 * u.deg, 0 * u.km, frame=frames.GeocentricEarthEquatorial, observer="earth",
     #                           obstime=box_bx.date)
 
+    dtype = PRECISION_DTYPES[precision][0]
+
     print("opening file")
     out_file = h5py.File(out_model, "w")
     bottom = out_file.create_group("bottom_bounds")
     for name, array in zip(("bx", "by", "bz"), (box_bx.data, box_by.data, box_bz.data)):
-        bottom.create_dataset(name, data=array)
+        bottom.create_dataset(name, data=array, dtype=dtype)
     out_file.flush()
 
-    maglib_lff = mf_lfff()
+    maglib_lff = mf_lfff(precision=precision)
     maglib_lff.set_field(box_bz.data.T)
 
-    res1 = maglib_lff.lfff_cube(dz)
-
-    bx_lff, by_lff, bz_lff = [res1[k].transpose((2, 1, 0)) for k in ("bx", "by", "bz")]
-
-    bx_lff[0, :, :] = box_bx.data  # replace bottom boundary of lff solution with initial boundary conditions
-    by_lff[0, :, :] = box_by.data
-    bz_lff[0, :, :] = box_bz.data
-
     potential = out_file.create_group("potential")
-    for name, array in zip(("bx", "by", "bz"), (bx_lff, by_lff, bz_lff)):
-        potential.create_dataset(name, data=array)
+    if slab_size is None:
+        # produce the cube directly in the (z, y, x) C-order of the NLFFF input, no transposed views
+        res1 = maglib_lff.lfff_cube(dz, layout="zyx")
+
+        bx_lff, by_lff, bz_lff = [res1[k] for k in ("bx", "by", "bz")]
+        del res1
+
+        bx_lff[0, :, :] = box_bx.data  # replace bottom boundary of lff solution with initial boundary conditions
+        by_lff[0, :, :] = box_by.data
+        bz_lff[0, :, :] = box_bz.data
+
+        for name, array in zip(("bx", "by", "bz"), (bx_lff, by_lff, bz_lff)):
+            potential.create_dataset(name, data=array)
+    else:
+        # stream the cube into the file slab by slab, one chunk per height layer
+        shape = maglib_lff.cube_shape(dz, layout="zyx")
+        targets = {name: potential.create_dataset(name, shape=shape, dtype=dtype, chunks=(1,) + shape[1:])
+                   for name in ("bx", "by", "bz")}
+        maglib_lff.lfff_stream(targets, dz, nz_block=slab_size, layout="zyx")
+
+        for name, array in zip(("bx", "by", "bz"), (box_bx.data, box_by.data, box_bz.data)):
+            targets[name][0, :, :] = array  # replace bottom boundary of lff solution with initial boundary conditions
+        out_file.flush()
+
+        bx_lff, by_lff, bz_lff = [targets[name][...] for name in ("bx", "by", "bz")]
     out_file.flush()
 
     obs_dr = res.to(u.km) / (696000 * u.km)  # dimensionless
     potential.attrs["obs_dr"] = obs_dr.value
     potential.attrs["res_km"] = res_km
+    potential.attrs["precision"] = precision
 
-    maglib.load_cube_vars(bx_lff, by_lff, bz_lff, (obs_dr * sunpy.sun.constants.radius.to(u.cm)).value)
-    box = maglib.NLFFF()
-    energy_new = maglib.energy
-    print('NLFFF energy:     ' + str(energy_new) + ' erg')
+    field_frame = box_bx.center.heliographic_carrington.frame
+    lon, lat = field_frame.lon.value, field_frame.lat.value
+
+    # the potential cube is kept in the file only, the solver overwrites its in-memory copy with the solution
+    nlfff_init = (bx_lff, by_lff, bz_lff)
+    pot_shape = bx_lff.shape
+    del bx_lff, by_lff, bz_lff
+    cold_time_per_voxel = None
+    if warm_start is not None:
+        with h5py.File(warm_start, "r") as prev_file:
+            prev = solution_as_input({name: prev_file["nlfff"][name][...] for name in ("bx", "by", "bz")})
+            prev_bottom = dict(prev_file["bottom_bounds"].attrs)
+            cold_time_per_voxel = prev_file["nlfff"].attrs.get("cold_time_per_voxel_s")
+        if cold_time_per_voxel is not None and not np.isfinite(cold_time_per_voxel):
+            cold_time_per_voxel = None  # files written before the attribute was left out store NaN
+        scale = np.rad2deg(np.arcsin(res_km / 696000))
+        shift = (differential_rotation_shift((Time(map_field.date) - Time(prev_bottom["obs_time"])).to(u.s),
+                                             cea_row_latitudes(box_bz), scale)
+                 - carrington_lon_shift(lon, prev_bottom["lon"], scale))
+        nlfff_init = [warm_start_guess(p, b, shift) for p, b in zip(prev, nlfff_init)]
+
+    # single-level solve, in chunks of chunk_iterations with a snapshot after each one if checkpoint is set
+    t0 = time.perf_counter()
+    box = multigrid_nlfff(*nlfff_init, (obs_dr * sunpy.sun.constants.radius.to(u.cm)).value, factors=(1,),
+                          maglib=maglib, checkpoint=checkpoint, chunk_iterations=chunk_iterations, copy=False)
+    nlfff_time = time.perf_counter() - t0
+    del nlfff_init
+    resumed = any(level.get("resumed", False) for level in box["levels"])
+
+    n_voxels = int(np.prod(pot_shape))
+    if warm_start is None:
+        # a resumed run only timed its remaining part
+        cold_time_per_voxel = None if resumed else nlfff_time / n_voxels
+    # without a cold start reference (e.g. the previous file has none) no speedup is stored
+    speedup = None if resumed or cold_time_per_voxel is None else cold_time_per_voxel * n_voxels / nlfff_time
+    print(f"NLFFF time: {nlfff_time:.1f} s, speedup vs cold start: "
+          + ("n/a" if speedup is None else f"{speedup:.2f}"))
 
     nlfff = out_file.create_group("nlfff")
     for name, array in zip(("bx", "by", "bz"), (box["bx"], box["by"], box["bz"])):
-        nlfff.create_dataset(name, data=array)
-    nlfff.attrs["energy_erg"] = energy_new
+        nlfff.create_dataset(name, data=array, dtype=dtype)
+    # NLFFF, potential and free energies in the same standard window of the stored cubes, in one streaming pass
+    energies = magnetic_energy(box["bx"], box["by"], box["bz"], (obs_dr * sunpy.sun.constants.radius.to(u.cm)).value,
+                               potential=[potential[name] for name in ("bx", "by", "bz")], z_axis=0,
+                               window=standard_window(pot_shape, 0))
+    print(f"NLFFF energy:     {energies['energy']} erg")
+    nlfff.attrs["energy_erg"] = energies["energy"]  # kept for readers of the earlier file format
+    nlfff.attrs["nlfff_energy_erg"] = energies["energy"]
+    nlfff.attrs["potential_energy_erg"] = energies["potential_energy"]
+    nlfff.attrs["free_energy_erg"] = energies["free_energy"]
+    nlfff.create_dataset("energy_height_profile", data=energies["height_profile"])
+    nlfff.create_dataset("free_energy_height_profile", data=energies["free_height_profile"])
+    print(f"Free energy:      {energies['free_energy']} erg")
+    # force-free quality metrics; the NLFFF result has bx and by swapped with respect to the (z, y, x) input
+    metrics = force_free_metrics(box["by"], box["bx"], box["bz"], layout="zyx")
+    nlfff.attrs.update(metrics)
+    print("NLFFF metrics:    " + ", ".join(f"{k} = {v:.4g}" for k, v in metrics.items()))
+    nlfff.attrs["time_s"] = nlfff_time
+    nlfff.attrs["warm_start"] = "" if warm_start is None else str(warm_start)
+    nlfff.attrs["resumed"] = resumed
+    if cold_time_per_voxel is not None:
+        nlfff.attrs["cold_time_per_voxel_s"] = cold_time_per_voxel
+    if speedup is not None:
+        nlfff.attrs["speedup"] = speedup
     out_file.flush()
 
     print("Calculating field lines")
     # lines = maglib.lines(seeds=None)
 
-    base_bz = cutout2box(map_losma, x, y, res_km * u.km, [dy, dx])
-    base_ic = cutout2box(map_conti, x, y, res_km * u.km, [dy, dx])
-    bottom.create_dataset("base_bz", data=base_bz.data)
-    bottom.create_dataset("base_ic", data=base_ic.data)
+    bottom.create_dataset("base_bz", data=base_bz.data, dtype=dtype)
+    bottom.create_dataset("base_ic", data=base_ic.data, dtype=dtype)
 
     header_field = map_field.wcs.to_header()
-    field_frame = box_bx.center.heliographic_carrington.frame
-    lon, lat = field_frame.lon.value, field_frame.lat.value
 
     obs_time = Time(map_field.date)
     dsun_obs = header_field["DSUN_OBS"]
 
-    header = {"lon": lon, "lat": lat, "dsun_obs": dsun_obs, "obs_time": str(obs_time.iso)}
+    header = {"lon": lon, "lat": lat, "dsun_obs": dsun_obs, "obs_time": str(obs_time.iso),
+              "reprojection": reprojection}
     bottom.attrs.update(header)
 
     out_file.flush()
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+def standard_window(shape, z_axis=0, lateral=(0.1, 0.9), top=0.9):
+    """
+    Returns the index window used for model energies: ``lateral`` fractions of the horizontal axes and
+    the heights from the first layer above the bottom boundary up to ``top`` of the box.
+
+    :param shape: Shape of the cube.
+    :type shape: tuple of int
+    :param z_axis: Vertical axis of the cube.
+    :type z_axis: int, optional
+    :rtype: tuple of slice
+    """
+    window = []
+    for axis, n in enumerate(shape):
+        if axis == z_axis % len(shape):
+            window.append(slice(1, int(np.floor(top * n))))
+        else:
+            window.append(slice(int(np.floor(lateral[0] * n)), int(np.floor(lateral[1] * n))))
+    return tuple(window)
+
+
+def _b2_slab(bx, by, bz, index, out):
+    # each component is indexed once, so that a slab of an h5py dataset is read once
+    b = bx[index]
+    np.multiply(b, b, out=out)
+    for b in (by[index], bz[index]):
+        out += b * b
+    return out
+
+
+def _heights_first(b, z_axis):
+    # cubes with the heights on the first axis are only indexed slab by slab, so h5py datasets are not read whole
+    if z_axis == 0:
+        return b
+    return np.moveaxis(np.asarray(b), z_axis, 0)
+
+
+def magnetic_energy(bx, by, bz, dr, potential=None, z_axis=0, window=None, mask=None, nz_block=16):
+    """
+    Magnetic energy of a field cube with its height and column profiles, accumulated slab by slab,
+    so that no full-size temporary cube is created. With ``potential`` the potential field energy and
+    the free energy (field minus potential) are computed in the same pass.
+
+    :param bx: bx cube.
+    :type bx: numpy.ndarray
+    :param by: by cube.
+    :type by: numpy.ndarray
+    :param bz: bz cube.
+    :type bz: numpy.ndarray
+    :param dr: Voxel size in cm, a scalar or one value per axis.
+    :type dr: float or sequence of float
+    :param potential: (bx, by, bz) of the potential field on the same grid. With ``z_axis=0`` these (and the
+        field cubes) may be h5py datasets, which are then read slab by slab.
+    :type potential: tuple of numpy.ndarray, optional
+    :param z_axis: Vertical axis of the cubes, 0 for the (z, y, x) cubes of `ampp_field`.
+    :type z_axis: int, optional
+    :param window: Index window per axis (slices in array axis order), see `standard_window`. Defaults to the whole cube.
+    :type window: tuple of slice, optional
+    :param mask: Boolean mask of the voxels to include, either of the cube shape or of the horizontal plane
+        (the cube shape without ``z_axis``).
+    :type mask: numpy.ndarray, optional
+    :param nz_block: Number of height layers processed at once.
+    :type nz_block: int, optional
+    :return: dict(energy, height_profile, column_map) in erg (profiles over the window, heights along the
+        window of ``z_axis`` and columns in the remaining axis order), plus, with ``potential``,
+        ``potential_energy``, ``free_energy`` and the matching ``potential_*``/``free_*`` profiles.
+    :rtype: dict
+    """
+    ndim = np.ndim(bx)
+    z_axis = z_axis % ndim
+    window = tuple(slice(None) for _ in range(ndim)) if window is None else tuple(window)
+    fields = [tuple(_heights_first(b, z_axis) for b in (bx, by, bz))]
+    if potential is not None:
+        fields.append(tuple(_heights_first(b, z_axis) for b in potential))
+    z_window = window[z_axis]
+    xy_window = tuple(w for axis, w in enumerate(window) if axis != z_axis)
+
+    mask_3d = False
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        mask_3d = mask.ndim == ndim
+        if mask_3d:
+            mask = np.moveaxis(mask, z_axis, 0)[(z_window,) + xy_window]
+        else:
+            mask = mask[xy_window]
+
+    heights = range(*z_window.indices(fields[0][0].shape[0]))
+    shape_xy = tuple(len(range(*w.indices(n))) for w, n in zip(xy_window, fields[0][0].shape[1:]))
+    dv = float(np.prod(np.broadcast_to(np.asarray(dr, dtype=np.float64), (ndim,))))
+    scale = dv / (8 * np.pi)
+
+    height_profiles = [np.zeros(len(heights)) for _ in fields]
+    column_maps = [np.zeros(shape_xy) for _ in fields]
+    if len(heights) > 0:
+        step = heights.step
+        buffer = np.empty((min(nz_block, len(heights)),) + shape_xy)
+        for k in range(0, len(heights), nz_block):
+            k1 = min(k + nz_block, len(heights))
+            index = (slice(heights[k], heights[k1 - 1] + 1, step),) + xy_window
+            for f, (fx, fy, fz) in enumerate(fields):
+                b2 = _b2_slab(fx, fy, fz, index, buffer[:k1 - k])
+                if mask is not None:
+                    b2 *= mask[k:k1] if mask_3d else mask
+                height_profiles[f][k:k1] = b2.sum(axis=(1, 2)) * scale
+                column_maps[f] += b2.sum(axis=0) * scale
+
+    res = dict(energy=height_profiles[0].sum(), height_profile=height_profiles[0], column_map=column_maps[0])
+    if potential is not None:
+        res.update(potential_energy=height_profiles[1].sum(),
+                   potential_height_profile=height_profiles[1],
+                   potential_column_map=column_maps[1],
+                   free_energy=height_profiles[0].sum() - height_profiles[1].sum(),
+                   free_height_profile=height_profiles[0] - height_profiles[1],
+                   free_column_map=column_maps[0] - column_maps[1])
+    return res
@@ -0,0 +1,166 @@
+import os
+import pickle
+import numpy as np
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as fftw_fft
+except ImportError:
+    pyfftw = None
+    fftw_fft = None
+
+FFT_BACKENDS = ['numpy', 'scipy', 'pyfftw']
+
+
+def next_smooth_size(n, primes=(2, 3, 5)):
+    """
+    Returns the smallest integer >= n with no prime factors other than ``primes`` (5-smooth by default).
+
+    :param n: Minimal size.
+    :type n: int
+    :param primes: Allowed prime factors.
+    :type primes: tuple of int, optional
+    :rtype: int
+    """
+    m = max(int(n), 1)
+    while True:
+        k = m
+        for p in primes:
+            while k % p == 0:
+                k //= p
+        if k == 1:
+            return m
+        m += 1
+
+
+class FFTBackend:
+    """
+    Thin dispatcher over the FFT implementations used by the field extrapolation code.
+
+    'numpy' is the single-threaded `numpy.fft`, 'scipy' is `scipy.fft` with ``workers`` threads,
+    and 'pyfftw' uses the pyFFTW scipy-like interface with its plan cache enabled and
+    optional FFTW wisdom persisted to a file.
+
+    :param name: Backend name, one of FFT_BACKENDS. Defaults to 'numpy'.
+    :type name: str, optional
+    :param workers: Default number of threads (None means backend default, -1 means all cores).
+    :type workers: int, optional
+    :param wisdom_file: pyfftw only, file to load FFTW wisdom from and to save it to.
+    :type wisdom_file: str, optional
+    :param planner_effort: pyfftw only, FFTW planner effort. Defaults to 'FFTW_MEASURE'.
+    :type planner_effort: str, optional
+    """
+
+    def __init__(self, name='numpy', workers=None, wisdom_file=None, planner_effort='FFTW_MEASURE'):
+        if name not in FFT_BACKENDS:
+            raise ValueError(f"FFT backend {name} is unknown. name must be one of {FFT_BACKENDS}")
+        if name == 'scipy' and scipy_fft is None:
+            raise ImportError("FFT backend 'scipy' requires scipy to be installed")
+        if name == 'pyfftw' and pyfftw is None:
+            raise ImportError("FFT backend 'pyfftw' requires pyFFTW to be installed")
+
+        self.name = name
+        self.workers = workers
+        self.wisdom_file = wisdom_file
+        self.planner_effort = planner_effort
+
+        if name == 'pyfftw':
+            pyfftw.interfaces.cache.enable()
+            pyfftw.interfaces.cache.set_keepalive_time(60)
+            if wisdom_file is not None and os.path.isfile(wisdom_file):
+                self.load_wisdom(wisdom_file)
+
+    def __repr__(self):
+        return f"FFTBackend(name={self.name!r}, workers={self.workers})"
+
+    def _kwargs(self, workers):
+        workers = self.workers if workers is None else workers
+        if self.name == 'numpy':
+            return {}
+        if self.name == 'pyfftw':
+            kwargs = dict(planner_effort=self.planner_effort)
+            if workers is not None:
+                kwargs['workers'] = os.cpu_count() if workers < 0 else workers
+            return kwargs
+        return dict(workers=workers)
+
+    def _module(self):
+        return {'numpy': np.fft, 'scipy': scipy_fft, 'pyfftw': fftw_fft}[self.name]
+
+    def fft2(self, a, axes=(-2, -1), workers=None):
+        return self._module().fft2(a, axes=axes, **self._kwargs(workers))
+
+    def ifft2(self, a, axes=(-2, -1), workers=None):
+        return self._module().ifft2(a, axes=axes, **self._kwargs(workers))
+
+    def rfft2(self, a, axes=(-2, -1), workers=None):
+        return self._module().rfft2(a, axes=axes, **self._kwargs(workers))
+
+    def irfft2(self, a, s, axes=(-2, -1), workers=None):
+        return self._module().irfft2(a, s=s, axes=axes, **self._kwargs(workers))
+
+    def next_fast_len(self, n):
+        """
+        Returns the smallest size >= n for which this backend's transforms are fast.
+
+        :param n: Minimal size.
+        :type n: int
+        :rtype: int
+        """
+        if self.name == 'scipy':
+            return scipy_fft.next_fast_len(int(n))
+        if self.name == 'pyfftw':
+            return pyfftw.next_fast_len(int(n))
+        return next_smooth_size(n)
+
+    def load_wisdom(self, wisdom_file=None):
+        """
+        Imports FFTW wisdom previously saved with `save_wisdom`.
+
+        :param wisdom_file: Wisdom file, defaults to the file given at construction.
+        :type wisdom_file: str, optional
+        :return: True if the wisdom was imported.
+        :rtype: bool
+        """
+        wisdom_file = self.wisdom_file if wisdom_file is None else wisdom_file
+        if self.name != 'pyfftw' or wisdom_file is None:
+            return False
+        with open(wisdom_file, 'rb') as f:
+            pyfftw.import_wisdom(pickle.load(f))
+        return True
+
+    def save_wisdom(self, wisdom_file=None):
+        """
+        Exports the accumulated FFTW wisdom, so that later sessions skip the planning.
+
+        :param wisdom_file: Wisdom file, defaults to the file given at construction.
+        :type wisdom_file: str, optional
+        :return: True if the wisdom was written.
+        :rtype: bool
+        """
+        wisdom_file = self.wisdom_file if wisdom_file is None else wisdom_file
+        if self.name != 'pyfftw' or wisdom_file is None:
+            return False
+        with open(wisdom_file, 'wb') as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+        return True
+
+
+def get_fft_backend(backend='numpy', workers=None):
+    """
+    Returns an `FFTBackend` for a backend name, or the backend itself if an instance is passed.
+
+    :param backend: Backend name or instance.
+    :type backend: str or FFTBackend
+    :param workers: Default number of threads for a newly created backend.
+    :type workers: int, optional
+    :rtype: FFTBackend
+    """
+    if isinstance(backend, FFTBackend):
+        return backend
+    return FFTBackend(backend, workers=workers)
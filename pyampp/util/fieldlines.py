@@ -0,0 +1,323 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context, shared_memory
+
+import h5py
+import numpy as np
+
+try:
+    import pyvista
+except ImportError:
+    pyvista = None
+
+from pyampp.util.nlfff_job import default_wrapper_factory, supports_zero_copy
+
+# per-voxel (per-seed) outputs of MagFieldWrapper.lines merged by trace_lines_batched
+VOXEL_OUTPUTS = ("voxel_status", "phys_length", "av_field", "codes")
+
+# default cap of the tracing workers, each of them may hold its own copy of the field cube
+MAX_DEFAULT_WORKERS = 4
+
+_worker = {}
+
+
+def voxel_seeds(shape, start=0, stop=None):
+    """
+    Returns the seeds placed at voxel centers for the flat (C-order) voxel indices ``start:stop``
+    of a cube of ``shape``, in the (x, y, z) order of `MagFieldWrapper.lines`.
+
+    :param shape: Shape of the field cubes as loaded by `load_cube_vars`.
+    :type shape: tuple of int
+    :rtype: numpy.ndarray
+    """
+    stop = int(np.prod(shape)) if stop is None else stop
+    idx = np.unravel_index(np.arange(start, stop), shape)
+    return np.column_stack(idx[::-1]).astype(np.float64)
+
+
+def _load_shared_cube(shm, shape, dr, maglib):
+    cube = np.ndarray((3,) + tuple(shape), dtype=np.float64, buffer=shm.buf)
+    if supports_zero_copy(maglib):
+        # the in-repo wrapper uses the shared cube as is
+        maglib.load_cube_vars(cube[0], cube[1], cube[2], dr, copy=False)
+    else:
+        maglib.load_cube_vars(cube[0], cube[1], cube[2], dr)
+    return cube
+
+
+def _submit_bounded(pool, fn, tasks, window):
+    # keeps at most ``window`` tasks in flight, so that the arguments (the seeds) are built as the workers
+    # become free instead of all at once; results are returned in the task order
+    results, pending = [], {}
+    for i, args in enumerate(tasks):
+        results.append(None)
+        while len(pending) >= window:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                results[pending.pop(f)] = f.result()
+        pending[pool.submit(fn, *args)] = i
+    for f, i in pending.items():
+        results[i] = f.result()
+    return results
+
+
+class FieldLines:
+    """
+    Compact ragged store of traced field lines: the points of all lines concatenated into one float32
+    array, with line ``i`` at ``coords[offsets[i]:offsets[i + 1]]`` (CSR layout).
+
+    :param coords: (n_points, 4) line points as written by `MagFieldWrapper.lines` (x, y, z and the fourth column).
+    :type coords: numpy.ndarray
+    :param offsets: (n_lines + 1) start offsets of the lines in ``coords``.
+    :type offsets: numpy.ndarray
+    :param index: Optional per-line index, e.g. ``lines_index`` of `lines`.
+    :type index: numpy.ndarray, optional
+    """
+
+    def __init__(self, coords, offsets, index=None):
+        self.coords = np.ascontiguousarray(coords, dtype=np.float32)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.index = None if index is None else np.ascontiguousarray(index, dtype=np.int32)
+        if self.offsets.ndim != 1 or len(self.offsets) == 0 or self.offsets[-1] != len(self.coords):
+            raise ValueError(f"offsets must end with the number of points {len(self.coords)}")
+
+    @classmethod
+    def from_lines(cls, res):
+        """
+        Builds the store from the result of `MagFieldWrapper.lines`, keeping only the traced points.
+
+        :param res: Result of `lines` with ``max_length != 0``.
+        :type res: dict
+        :rtype: FieldLines
+        """
+        if np.int64(res['max_length']) == 0:
+            return cls(np.zeros((0, 4)), np.zeros(1))
+        n_lines = int(res['n_lines'])
+        start = np.asarray(res['lines_start'], dtype=np.int64)[:n_lines]
+        length = np.asarray(res['lines_length'], dtype=np.int64)[:n_lines]
+        offsets = np.zeros(n_lines + 1, dtype=np.int64)
+        np.cumsum(length, out=offsets[1:])
+        # gather the points line by line, which also drops gaps between lines in the buffer
+        points = np.repeat(start - offsets[:-1], length) + np.arange(offsets[-1])
+        index = res.get('lines_index')
+        if index is not None and np.ndim(index) > 0:
+            index = np.asarray(index)[:n_lines]
+        else:
+            index = None
+        return cls(np.asarray(res['coords'])[points], offsets, index)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Joins several stores, e.g. the batches of `trace_lines_batched`.
+
+        :param stores: Sequence of FieldLines.
+        :rtype: FieldLines
+        """
+        stores = list(stores)
+        if not stores:
+            return cls(np.zeros((0, 4)), np.zeros(1))
+        shifts = np.cumsum([0] + [len(s.coords) for s in stores[:-1]])
+        offsets = np.concatenate([[0]] + [s.offsets[1:] + shift for s, shift in zip(stores, shifts)])
+        index = None
+        if all(s.index is not None for s in stores):
+            index = np.concatenate([s.index for s in stores])
+        return cls(np.concatenate([s.coords for s in stores]), offsets, index)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"FieldLines(n_lines={len(self)}, n_points={self.n_points})"
+
+    @property
+    def n_points(self):
+        return len(self.coords)
+
+    @property
+    def lengths(self):
+        """
+        Number of points of every line.
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def points(self):
+        """
+        (n_points, 3) x, y, z of all points.
+        """
+        return self.coords[:, :3]
+
+    @property
+    def nbytes(self):
+        return self.coords.nbytes + self.offsets.nbytes + (0 if self.index is None else self.index.nbytes)
+
+    def save(self, filename):
+        """
+        Writes the store to ``.npz`` or, for ``.h5``/``.hdf5`` files, to HDF5.
+        """
+        arrays = dict(coords=self.coords, offsets=self.offsets)
+        if self.index is not None:
+            arrays['index'] = self.index
+        if str(filename).endswith(('.h5', '.hdf5')):
+            with h5py.File(filename, 'w') as f:
+                group = f.create_group('fieldlines')
+                for name, a in arrays.items():
+                    group.create_dataset(name, data=a)
+        else:
+            np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads a store written by `save`.
+
+        :rtype: FieldLines
+        """
+        if str(filename).endswith(('.h5', '.hdf5')):
+            with h5py.File(filename, 'r') as f:
+                group = f['fieldlines']
+                return cls(group['coords'][...], group['offsets'][...],
+                           group['index'][...] if 'index' in group else None)
+        with np.load(filename) as data:
+            return cls(data['coords'], data['offsets'], data['index'] if 'index' in data else None)
+
+    def to_pyvista(self):
+        """
+        Converts the lines to a `pyvista.PolyData` with one polyline cell per line and the fourth
+        coordinate column as the ``value`` point array.
+
+        :rtype: pyvista.PolyData
+        """
+        if pyvista is None:
+            raise ImportError("FieldLines.to_pyvista requires pyvista to be installed")
+        lengths = self.lengths
+        # cell array: [n_0, i_0 ... i_n0-1, n_1, ...], point ids interleaved with the line lengths
+        cells = np.empty(len(self) + self.n_points, dtype=np.int64)
+        heads = self.offsets[:-1] + np.arange(len(self))
+        cells[heads] = lengths
+        mask = np.ones(len(cells), dtype=bool)
+        mask[heads] = False
+        cells[mask] = np.arange(self.n_points)
+        poly = pyvista.PolyData(self.points.astype(np.float64), lines=cells)
+        poly.point_data['value'] = self.coords[:, 3]
+        return poly
+
+
+def _init_worker(shm_name, shape, dr, wrapper_factory):
+    _worker['shm'] = shared_memory.SharedMemory(name=shm_name)
+    _worker['maglib'] = wrapper_factory()
+    _worker['cube'] = _load_shared_cube(_worker['shm'], shape, dr, _worker['maglib'])
+
+
+def _trace_batch(seeds, lines_kwargs):
+    return _trace(_worker['maglib'], seeds, lines_kwargs)
+
+
+def _trace(maglib, seeds, lines_kwargs):
+    res = maglib.lines(seeds=seeds, **lines_kwargs)
+    out = {k: np.asarray(res[k]).ravel() for k in VOXEL_OUTPUTS}
+    out.update(n_lines=int(res['n_lines']), n_passed=int(res['n_passed']), non_passed=int(res['non_passed']))
+    if np.int64(res['max_length']) > 0:
+        out['lines'] = FieldLines.from_lines(res)
+        out['lines'].index = None  # lines_index is local to the batch
+    return out
+
+
+def trace_lines_batched(bx, by, bz, dr, seeds=None, batch_size=65536, max_coords=0, n_workers=None,
+                        wrapper_factory=None, reshape_3D=True, **lines_kwargs):
+    """
+    Traces field lines in bounded batches of seeds, optionally in parallel worker processes
+    sharing the field cube through shared memory.
+
+    `MagFieldWrapper.lines` without seeds sizes all its buffers by the number of voxels, and with
+    ``max_length < 0`` allocates coordinates for every voxel at once. Here the seeds (all voxel centers
+    if None) are split into batches of ``batch_size``, each traced with a fixed budget of ``max_coords``
+    line points, and the per-voxel outputs of the batches are merged back.
+
+    :param bx: bx cube, in the argument order of `MagFieldWrapper.load_cube_vars`.
+    :type bx: numpy.ndarray
+    :param by: by cube.
+    :type by: numpy.ndarray
+    :param bz: bz cube.
+    :type bz: numpy.ndarray
+    :param dr: Voxel size passed to `load_cube_vars`.
+    :type dr: float
+    :param seeds: (n, 3) seed coordinates, None traces from every voxel.
+    :type seeds: numpy.ndarray, optional
+    :param batch_size: Number of seeds per batch.
+    :type batch_size: int, optional
+    :param max_coords: Line point budget of every batch (``max_length`` of `lines`), 0 stores no coordinates.
+    :type max_coords: int, optional
+    :param n_workers: Number of worker processes, 0 traces in this process. Defaults to the number of CPUs,
+        at most MAX_DEFAULT_WORKERS.
+    :type n_workers: int, optional
+    :param wrapper_factory: Picklable callable returning a solver wrapper in every worker,
+        defaults to pyAMaFiL's MagFieldWrapper. A wrapper whose ``load_cube_vars`` has no ``copy`` argument
+        (pyAMaFiL's) keeps its own copy of the three cubes in every worker, on top of the shared one;
+        with `pyampp.util.nlfff_job.inplace_wrapper_factory` all workers use the shared cube.
+    :type wrapper_factory: callable, optional
+    :param reshape_3D: Reshape the per-voxel outputs to the cube shape when tracing from every voxel.
+    :type reshape_3D: bool, optional
+    :param lines_kwargs: Other keyword arguments of `MagFieldWrapper.lines`, e.g. ``chromo_level`` or ``n_processes``.
+    :return: dict with the merged per-voxel outputs (VOXEL_OUTPUTS), the summed ``n_lines``, ``n_passed``
+        and ``non_passed``, and, with ``max_coords > 0``, ``lines``: the traced lines of all batches as `FieldLines`.
+    :rtype: dict
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be positive, got {batch_size}")
+    shape = tuple(np.shape(bx))
+    wrapper_factory = default_wrapper_factory if wrapper_factory is None else wrapper_factory
+    n_workers = min(os.cpu_count(), MAX_DEFAULT_WORKERS) if n_workers is None else n_workers
+    lines_kwargs = dict(lines_kwargs, max_length=max_coords, reshape_3D=False)
+    lines_kwargs.setdefault('n_processes', 1 if n_workers > 0 else 0)
+
+    n_total = int(np.prod(shape)) if seeds is None else len(seeds)
+    bounds = [(k, min(k + batch_size, n_total)) for k in range(0, n_total, batch_size)]
+
+    def batch_seeds(k0, k1):
+        if seeds is None:
+            return voxel_seeds(shape, k0, k1)
+        return np.ascontiguousarray(seeds[k0:k1], dtype=np.float64)
+
+    shm = shared_memory.SharedMemory(create=True, size=3 * int(np.prod(shape)) * 8)
+    try:
+        cube = np.ndarray((3,) + shape, dtype=np.float64, buffer=shm.buf)
+        for i, b in enumerate((bx, by, bz)):
+            cube[i][...] = b
+        if n_workers > 0:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn'),
+                                     initializer=_init_worker,
+                                     initargs=(shm.name, shape, dr, wrapper_factory)) as pool:
+                tasks = ((batch_seeds(k0, k1), lines_kwargs) for k0, k1 in bounds)
+                results = _submit_bounded(pool, _trace_batch, tasks, 2 * n_workers)
+        else:
+            maglib = wrapper_factory()
+            _load_shared_cube(shm, shape, dr, maglib)
+            results = [_trace(maglib, batch_seeds(k0, k1), lines_kwargs) for k0, k1 in bounds]
+            del maglib
+        del cube
+    finally:
+        shm.close()
+        shm.unlink()
+
+    out = {}
+    for k in VOXEL_OUTPUTS:
+        merged = np.concatenate([r[k] for r in results]) if results else np.zeros(0)
+        if reshape_3D and seeds is None:
+            merged = merged.reshape(shape)
+        out[k] = merged
+    for k in ('n_lines', 'n_passed', 'non_passed'):
+        out[k] = sum(r[k] for r in results)
+    if max_coords > 0:
+        out['lines'] = FieldLines.concatenate(r['lines'] for r in results)
+    return out
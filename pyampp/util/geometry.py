@@ -0,0 +1,151 @@
+from collections import OrderedDict
+
+import astropy.units as u
+import numpy as np
+from sunpy.coordinates import HeliographicStonyhurst
+from sunpy.map import all_coordinates_from_map
+
+# pixel geometries of the last maps, field, inclination and azimuth of one observation share an entry
+_geometry_cache = OrderedDict()
+GEOMETRY_CACHE_SIZE = 2
+
+
+def _geometry_key(smap):
+    observer = smap.observer_coordinate
+    wcs = smap.wcs.wcs
+    return (tuple(smap.data.shape), tuple(wcs.ctype), tuple(wcs.crpix), tuple(wcs.crval), tuple(wcs.cdelt),
+            tuple(np.ravel(wcs.get_pc())), float(wcs.lonpole), float(wcs.latpole),
+            float(observer.lon.to_value(u.deg)), float(observer.lat.to_value(u.deg)),
+            float(observer.radius.to_value(u.m)), float(smap.rsun_meters.to_value(u.m)))
+
+
+def _native_to_celestial(theta, phi, alpha_p, delta_p, phi_p):
+    # native spherical -> celestial spherical rotation of Calabretta & Greisen (2002), radians
+    dphi = phi - phi_p
+    lat = np.arcsin(np.clip(np.sin(theta) * np.sin(delta_p) + np.cos(theta) * np.cos(delta_p) * np.cos(dphi), -1, 1))
+    lon = alpha_p + np.arctan2(-np.cos(theta) * np.sin(dphi),
+                               np.sin(theta) * np.cos(delta_p) - np.cos(theta) * np.sin(delta_p) * np.cos(dphi))
+    return lon, lat
+
+
+def _tan_line_of_sight(smap):
+    # pixel -> intermediate world coordinates -> gnomonic (TAN) native direction -> helioprojective direction.
+    # The native unit vector of a TAN pixel is (-y, x, 1) / sqrt(1 + x^2 + y^2); the native -> celestial
+    # rotation is a constant matrix, so no per-pixel trigonometry is needed. Returns the helioprojective
+    # unit vector (cos Ty cos Tx, cos Ty sin Tx, sin Ty).
+    wcs = smap.wcs.wcs
+    ny, nx = smap.data.shape
+    deg = [(1 * u.Unit(str(cu) or 'deg')).to_value(u.deg) for cu in wcs.cunit]
+    px = np.arange(nx, dtype=np.float64) + 1 - wcs.crpix[0]
+    py = np.arange(ny, dtype=np.float64)[:, np.newaxis] + 1 - wcs.crpix[1]
+    pc = wcs.get_pc()
+    x = np.deg2rad((pc[0, 0] * px + pc[0, 1] * py) * wcs.cdelt[0] * deg[0])
+    y = np.deg2rad((pc[1, 0] * px + pc[1, 1] * py) * wcs.cdelt[1] * deg[1])
+
+    alpha_p, delta_p = np.deg2rad(wcs.crval[0] * deg[0]), np.deg2rad(wcs.crval[1] * deg[1])
+    # celestial images of the native basis vectors (theta, phi) = (0, 0), (0, 90 deg), (90 deg, 0)
+    lon, lat = _native_to_celestial(np.array([0, 0, np.pi / 2]), np.array([0, np.pi / 2, 0]),
+                                    alpha_p, delta_p, np.deg2rad(wcs.lonpole))
+    rot = np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+    norm = 1 / np.sqrt(1 + x * x + y * y)
+    n1, n2, n3 = -y * norm, x * norm, norm
+    return [rot[i, 0] * n1 + rot[i, 1] * n2 + rot[i, 2] * n3 for i in range(3)]
+
+
+def _helioprojective_to_stonyhurst(los, observer, rsun):
+    # line of sight from the observer intersected with the solar sphere (Thompson 2006),
+    # then heliocentric cartesian -> Stonyhurst; off-disk pixels are NaN as in sunpy
+    d_obs = observer.radius.to_value(u.m)
+    b0 = observer.lat.to_value(u.rad)
+    l0 = observer.lon.to_value(u.rad)
+
+    cos_alpha, s_x, s_y = los
+    disc = rsun * rsun - d_obs * d_obs * (s_x * s_x + s_y * s_y)
+    with np.errstate(invalid='ignore'):
+        d = d_obs * cos_alpha - np.sqrt(disc)
+    d[disc < 0] = np.nan
+
+    x = d * s_x
+    y = d * s_y
+    z = d_obs - d * cos_alpha
+    del d
+
+    sinb, cosb = np.sin(b0), np.cos(b0)
+    lat = np.arcsin(np.clip((y * cosb + z * sinb) / rsun, -1, 1))
+    lon = np.arctan2(x, z * cosb - y * sinb)
+    lon += l0
+    with np.errstate(invalid='ignore'):
+        lon[lon > np.pi] -= 2 * np.pi
+        lon[lon <= -np.pi] += 2 * np.pi
+    lat[np.isnan(x)] = np.nan
+    return lon, lat
+
+
+def stonyhurst_lonlat(smap, cache=True):
+    """
+    Heliographic Stonyhurst longitude and latitude of every pixel of a helioprojective map, in radians.
+
+    For gnomonic (TAN) maps such as HMI full-disk frames the coordinates are computed in closed form
+    from the WCS keywords and the observer location, orders of magnitude faster than transforming
+    `all_coordinates_from_map` with astropy; other projections fall back to the astropy transform.
+    Results are cached per (observer, WCS, shape), so the field, inclination and azimuth segments
+    of one observation share a single computation.
+
+    :param smap: Helioprojective map.
+    :type smap: sunpy.map.GenericMap
+    :param cache: Use and fill the geometry cache.
+    :type cache: bool, optional
+    :return: (lon, lat) arrays of the map shape, NaN off the disk; read-only when cached.
+    :rtype: tuple of numpy.ndarray
+    """
+    key = _geometry_key(smap)
+    if cache and key in _geometry_cache:
+        _geometry_cache.move_to_end(key)
+        return _geometry_cache[key]
+
+    ctype = smap.wcs.wcs.ctype
+    if ctype[0].endswith('-TAN') and ctype[1].endswith('-TAN'):
+        lonlat = _helioprojective_to_stonyhurst(_tan_line_of_sight(smap), smap.observer_coordinate,
+                                                smap.rsun_meters.to_value(u.m))
+    else:
+        hgs = all_coordinates_from_map(smap).transform_to(HeliographicStonyhurst(obstime=smap.date))
+        lonlat = hgs.lon.to_value(u.rad), hgs.lat.to_value(u.rad)
+        lonlat = ((lonlat[0] + np.pi) % (2 * np.pi) - np.pi, lonlat[1])
+
+    if cache:
+        for a in lonlat:
+            a.setflags(write=False)
+        _geometry_cache[key] = lonlat
+        while len(_geometry_cache) > GEOMETRY_CACHE_SIZE:
+            _geometry_cache.popitem(last=False)
+    return lonlat
+
+
+def clear_geometry_cache():
+    """
+    Drops all cached pixel geometries.
+    """
+    _geometry_cache.clear()
+
+
+def geometry_residual(smap, step=16):
+    """
+    Compares `stonyhurst_lonlat` with the astropy transform on every ``step``-th pixel.
+
+    :param smap: Helioprojective map.
+    :type smap: sunpy.map.GenericMap
+    :param step: Subsampling of the pixel grid.
+    :type step: int, optional
+    :return: Largest great-circle distance between both results on the disk, in arcsec.
+    :rtype: float
+    """
+    lon, lat = stonyhurst_lonlat(smap)
+    lon, lat = lon[::step, ::step], lat[::step, ::step]
+    hgs = all_coordinates_from_map(smap)[::step, ::step].transform_to(HeliographicStonyhurst(obstime=smap.date))
+    ref_lon, ref_lat = hgs.lon.to_value(u.rad), hgs.lat.to_value(u.rad)
+    on_disk = np.isfinite(ref_lat) & np.isfinite(lat)
+    cos_dist = (np.sin(lat) * np.sin(ref_lat) + np.cos(lat) * np.cos(ref_lat) * np.cos(lon - ref_lon))[on_disk]
+    if cos_dist.size == 0:
+        return 0.0
+    return float(np.rad2deg(np.arccos(np.clip(cos_dist, -1, 1)).max()) * 3600)
@@ -0,0 +1,198 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from sunpy.map import Map
+
+from pyampp.util.geometry import stonyhurst_lonlat
+
+
+def _b2ptr_tile(field, inclination, azimuth, lon, lat, sinb, cosb, sinp, cosp, out, rows):
+    # Gary & Hagyard (1990) image -> heliographic transform of rows ``rows``, everything tile-sized
+    dtype = out.dtype
+    f = np.array(field[rows], dtype=dtype)
+    gamma = np.deg2rad(np.asarray(inclination[rows], dtype=dtype))
+    psi = np.deg2rad(np.asarray(azimuth[rows], dtype=dtype))
+    phi = np.asarray(lon[rows], dtype=dtype)
+    lam = np.asarray(lat[rows], dtype=dtype)
+
+    b_zeta = f * np.cos(gamma)
+    f *= np.sin(gamma)
+    b_xi = -f * np.sin(psi)
+    b_eta = f * np.cos(psi)
+    del f, gamma, psi
+
+    sinphi, cosphi = np.sin(phi), np.cos(phi)
+    sinlam, coslam = np.sin(lam), np.cos(lam)
+
+    # Bp = k31 b_xi + k32 b_eta + k33 b_zeta
+    np.multiply(cosp * cosphi - sinb * sinp * sinphi, b_xi, out=out[0, rows])
+    out[0, rows] += (sinb * cosp * sinphi + sinp * cosphi) * b_eta
+    out[0, rows] -= cosb * sinphi * b_zeta
+
+    # Br = coslam u + sinlam v, Bt = sinlam u - coslam v with the k1j and k2j rows factored into u and v
+    u = (sinb * sinp * cosphi + cosp * sinphi) * b_xi
+    u -= (sinb * cosp * cosphi - sinp * sinphi) * b_eta
+    u += cosb * cosphi * b_zeta
+    v = cosb * (cosp * b_eta - sinp * b_xi) + sinb * b_zeta
+    np.multiply(sinlam, u, out=out[1, rows])
+    out[1, rows] -= coslam * v
+    np.multiply(coslam, u, out=out[2, rows])
+    out[2, rows] += sinlam * v
+    return rows
+
+
+def b2ptr(field, inclination, azimuth, lon, lat, b0, p, out=None, tile_rows=64, workers=None):
+    """
+    Transforms an HMI field/inclination/azimuth vector magnetogram to the local heliographic
+    components (Bp, Bt, Br) in one fused pass over row tiles, so that the temporaries are tile-sized
+    and the tiles are spread over ``workers`` threads.
+
+    :param field: Field strength in G.
+    :type field: numpy.ndarray
+    :param inclination: Inclination in degrees.
+    :type inclination: numpy.ndarray
+    :param azimuth: Disambiguated azimuth in degrees.
+    :type azimuth: numpy.ndarray
+    :param lon: Stonyhurst longitude of the pixels in radians, see `stonyhurst_lonlat`.
+    :type lon: numpy.ndarray
+    :param lat: Stonyhurst latitude of the pixels in radians.
+    :type lat: numpy.ndarray
+    :param b0: Heliographic latitude of the disk center (CRLT_OBS) in radians.
+    :type b0: float
+    :param p: Position angle of the solar north pole (-CROTA2) in radians.
+    :type p: float
+    :param out: Output array of shape (3, ny, nx), defaults to a new float32 array.
+    :type out: numpy.ndarray, optional
+    :param tile_rows: Number of image rows per tile.
+    :type tile_rows: int, optional
+    :param workers: Number of threads, defaults to the number of CPUs.
+    :type workers: int, optional
+    :return: ``out`` holding Bp, Bt and Br.
+    :rtype: numpy.ndarray
+    """
+    ny, nx = np.shape(field)
+    for name, a in (('inclination', inclination), ('azimuth', azimuth), ('lon', lon), ('lat', lat)):
+        if np.shape(a) != (ny, nx):
+            raise ValueError(f"{name} has shape {np.shape(a)}, expected {(ny, nx)}")
+    if out is None:
+        out = np.empty((3, ny, nx), dtype=np.float32)
+    elif out.shape != (3, ny, nx):
+        raise ValueError(f"out has shape {out.shape}, expected {(3, ny, nx)}")
+
+    # python floats keep the tile arithmetic in the output precision
+    trig = tuple(float(t) for t in (np.sin(b0), np.cos(b0), np.sin(p), np.cos(p)))
+    tiles = [slice(j, min(j + tile_rows, ny)) for j in range(0, ny, tile_rows)]
+    workers = os.cpu_count() if workers is None else workers
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        list(pool.map(lambda rows: _b2ptr_tile(field, inclination, azimuth, lon, lat, *trig, out, rows), tiles))
+    return out
+
+
+def map_b2ptr(map_field, map_inclination, map_azimuth, out=None, **kwargs):
+    """
+    `b2ptr` of the segment maps of one HMI observation; the pixel geometry is taken from
+    `stonyhurst_lonlat` and the disk center latitude and roll from the field map header.
+
+    :return: (Bp, Bt, Br) array, see `b2ptr`.
+    :rtype: numpy.ndarray
+    """
+    lon, lat = stonyhurst_lonlat(map_field)
+    header = map_field.fits_header
+    return b2ptr(map_field.data, map_inclination.data, map_azimuth.data, lon, lat,
+                 np.deg2rad(header["crlt_obs"]), np.deg2rad(-header["crota2"]), out=out, **kwargs)
+
+
+def _image_hdu(hdul):
+    # first HDU holding a 2D image; HMI segments are RICE compressed in the first extension
+    for hdu in hdul:
+        if hdu.is_image and hdu.header.get('NAXIS', 0) == 2:
+            return hdu
+    raise ValueError(f"{hdul.filename()} has no 2D image")
+
+
+def read_map_header(path):
+    """
+    Reads only the header of a FITS image map, the data are not decompressed.
+
+    :param path: FITS file.
+    :type path: str or pathlib.Path
+    :return: Map of the file's WCS and metadata, with placeholder 1x1 data, for coordinate computations.
+    :rtype: sunpy.map.GenericMap
+    """
+    with fits.open(path) as hdul:
+        header = _image_hdu(hdul).header.copy()
+    return Map(np.zeros((1, 1), dtype=np.float32), header)
+
+
+def fov_pixel_bounds(header_map, bottom_left, top_right, shape, pad=0):
+    """
+    Pixel bounding box of the helioprojective rectangle spanned by ``bottom_left`` and ``top_right``.
+
+    The corners are taken by their Tx and Ty in the frame of ``header_map``, as in `GxBox.corr_fov_coords`,
+    and all four corners are projected, so rolled maps such as HMI (CROTA2 ~ 180) are handled.
+
+    :param header_map: Map providing the WCS, see `read_map_header`.
+    :type header_map: sunpy.map.GenericMap
+    :param bottom_left: Bottom left corner.
+    :type bottom_left: astropy.coordinates.SkyCoord
+    :param top_right: Top right corner.
+    :type top_right: astropy.coordinates.SkyCoord
+    :param shape: (ny, nx) of the full image, the box is clipped to it.
+    :type shape: tuple of int
+    :param pad: Margin in pixels added on each side.
+    :type pad: int, optional
+    :return: (y0, y1, x0, x1), half-open index ranges.
+    :rtype: tuple of int
+    """
+    tx = u.Quantity([bottom_left.Tx, top_right.Tx, bottom_left.Tx, top_right.Tx])
+    ty = u.Quantity([bottom_left.Ty, bottom_left.Ty, top_right.Ty, top_right.Ty])
+    px, py = header_map.wcs.world_to_pixel(SkyCoord(Tx=tx, Ty=ty, frame=header_map.coordinate_frame))
+    ny, nx = shape
+    x0 = int(np.clip(np.floor(np.min(px)) - pad, 0, nx))
+    x1 = int(np.clip(np.ceil(np.max(px)) + 1 + pad, 0, nx))
+    y0 = int(np.clip(np.floor(np.min(py)) - pad, 0, ny))
+    y1 = int(np.clip(np.ceil(np.max(py)) + 1 + pad, 0, ny))
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"field of view {bottom_left}, {top_right} does not overlap the image")
+    return y0, y1, x0, x1
+
+
+def read_map_section(path, bottom_left=None, top_right=None, pad=2):
+    """
+    Reads the part of a FITS image map that covers a field of view.
+
+    Only the image tiles intersecting the field of view are read and decompressed (astropy's
+    ``section`` access of compressed and plain image HDUs), so the cost of a cutout is proportional
+    to its size rather than to the full-disk frame. The returned map has its WCS reference pixel
+    shifted to the cutout; use ``submap`` on it for an exact crop.
+
+    :param path: FITS file.
+    :type path: str or pathlib.Path
+    :param bottom_left: Bottom left helioprojective corner, None reads the full image.
+    :type bottom_left: astropy.coordinates.SkyCoord, optional
+    :param top_right: Top right helioprojective corner.
+    :type top_right: astropy.coordinates.SkyCoord, optional
+    :param pad: Margin in pixels read on each side.
+    :type pad: int, optional
+    :rtype: sunpy.map.GenericMap
+    """
+    with fits.open(path) as hdul:
+        hdu = _image_hdu(hdul)
+        header = hdu.header.copy()
+        shape = (header['NAXIS2'], header['NAXIS1'])
+        if bottom_left is None:
+            y0, y1, x0, x1 = 0, shape[0], 0, shape[1]
+        else:
+            header_map = Map(np.zeros((1, 1), dtype=np.float32), header)
+            y0, y1, x0, x1 = fov_pixel_bounds(header_map, bottom_left, top_right, shape, pad=pad)
+        data = hdu.section[y0:y1, x0:x1]
+
+    header['CRPIX1'] -= x0
+    header['CRPIX2'] -= y0
+    header['NAXIS1'] = x1 - x0
+    header['NAXIS2'] = y1 - y0
+    return Map(data, header)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# bump when the content of cached kernels changes, so stale files on disk are not reused
+KERNEL_CACHE_VERSION = 1
+
+
+class KernelCache:
+    """
+    Least-recently-used cache of named numpy arrays keyed by a hashable geometry key, e.g. the padded
+    shape of a magnetogram. Cached arrays are read-only. With ``cache_dir`` every entry is also stored as
+    ``.npy`` files, so later processes working on the same geometry load the arrays instead of rebuilding them.
+
+    :param maxsize: Maximal number of entries kept in memory, 0 disables the in-memory cache.
+    :type maxsize: int, optional
+    :param cache_dir: Directory for the on-disk cache, None disables it.
+    :type cache_dir: str, optional
+    """
+
+    def __init__(self, maxsize=4, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return (f"KernelCache(maxsize={self.maxsize}, cache_dir={self.cache_dir!r}, entries={len(self)}, "
+                f"hits={self.hits}, misses={self.misses})")
+
+    def clear(self):
+        """
+        Drops all in-memory entries, files on disk are kept.
+        """
+        self._items.clear()
+
+    def get(self, key, builder):
+        """
+        Returns the arrays cached under ``key``, building them with ``builder()`` on a miss.
+
+        :param key: Hashable key, its repr identifies the entry on disk.
+        :param builder: Callable returning a dict of name -> numpy array.
+        :return: dict of read-only arrays.
+        :rtype: dict
+        """
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+
+        arrays = self._load(key)
+        if arrays is None:
+            self.misses += 1
+            arrays = builder()
+            self._save(key, arrays)
+        else:
+            self.hits += 1
+        for a in arrays.values():
+            a.setflags(write=False)
+
+        if self.maxsize > 0:
+            self._items[key] = arrays
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return arrays
+
+    def _prefix(self, key):
+        digest = hashlib.sha1(repr((KERNEL_CACHE_VERSION, key)).encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.cache_dir, f"kernel_{digest}")
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        index = self._prefix(key) + '.txt'
+        if not os.path.isfile(index):
+            return None
+        with open(index) as f:
+            names = f.read().split()
+        try:
+            return {name: np.load(f"{self._prefix(key)}_{name}.npy", mmap_mode='r') for name in names}
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, key, arrays):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        prefix = self._prefix(key)
+        # write to temporary files and rename, so concurrent processes never read partial files;
+        # the index is written last and marks the entry as complete
+        for name, a in arrays.items():
+            tmp = f"{prefix}_{name}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                np.save(f, a, allow_pickle=False)
+            os.replace(tmp, f"{prefix}_{name}.npy")
+        tmp = f"{prefix}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(arrays.keys()))
+        os.replace(tmp, prefix + '.txt')
+
+
+default_kernel_cache = KernelCache()
+
+
+def configure_kernel_cache(maxsize=None, cache_dir=None):
+    """
+    Changes the size and the on-disk directory of the default kernel cache shared by all `mf_lfff` instances.
+
+    :param maxsize: Maximal number of in-memory entries, unchanged if None.
+    :type maxsize: int, optional
+    :param cache_dir: Directory for ``.npy`` kernel files, unchanged if None.
+    :type cache_dir: str, optional
+    :return: The default cache.
+    :rtype: KernelCache
+    """
+    if maxsize is not None:
+        default_kernel_cache.maxsize = maxsize
+        while len(default_kernel_cache._items) > maxsize:
+            default_kernel_cache._items.popitem(last=False)
+    if cache_dir is not None:
+        default_kernel_cache.cache_dir = cache_dir
+    return default_kernel_cache
+
+
+def get_kernel_cache(kernel_cache=True):
+    """
+    Resolves the ``kernel_cache`` option of `mf_lfff`: True is the default cache, None or False
+    disables caching, a `KernelCache` instance is used as is.
+
+    :rtype: KernelCache
+    """
+    if isinstance(kernel_cache, KernelCache):
+        return kernel_cache
+    if kernel_cache:
+        return default_kernel_cache
+    return KernelCache(maxsize=0)
@@ -1,6 +1,9 @@
 import numpy as np
 import warnings
 
+from pyampp.util.fftbackend import get_fft_backend
+from pyampp.util.kernelcache import get_kernel_cache
+
 __author__     = "Alexey G. Stupishin"
 __email__      = "agstup@yandex.ru"
 __copyright__  = "SUNCAST project, 2024"
@@ -10,93 +13,351 @@ __version__    = "0.9.1"
 __maintainer__ = "Alexey G. Stupishin"
 __status__     = "beta"
 
+# precision mode -> (real dtype, complex dtype)
+PRECISION_DTYPES = dict(double = (np.float64, np.complex128)
+                      , single = (np.float32, np.complex64)
+                       )
+
+# working memory of one slab of lfff_slabs when nz_block is not given: the height factors, one
+# multiplied spectrum and one inverse transform, each nz_block padded complex planes deep
+LFFF_SLAB_BYTES = 32 * 2**20
+
+def default_nz_block(pad_size, cdtype = np.complex128, budget = LFFF_SLAB_BYTES):
+    # number of heights per batched slab that keeps the spectral work arrays within budget bytes
+    plane = int(np.prod(pad_size)) * np.dtype(cdtype).itemsize
+    return int(max(1, budget // (3 * plane)))
+
+def stretched_heights(z_top, dz_min = 1.0, ratio = 1.0, z_uniform = 0.0):
+    # heights (pixel units) from 0 to at least z_top: uniform steps dz_min up to z_uniform,
+    # then every step is ratio times the previous one (geometric stretching aloft);
+    # dz_min < 1 gives sub-pixel layers near the photosphere
+    if dz_min <= 0 or ratio < 1:
+        raise ValueError("dz_min must be positive and ratio must be >= 1")
+
+    z = [0.0]
+    dz = dz_min
+    while z[-1] < z_top:
+        if z[-1] >= z_uniform:
+            dz *= ratio
+        z.append(z[-1] + dz)
+        pass
+
+    return np.array(z, dtype = np.float64)
+
 class mf_lfff:
-    def __init__(self):
+    def __init__(self, real_fft = False, backend = 'numpy', workers = None, precision = 'double', kernel_cache = True):
+        # real_fft: real-to-complex transforms, only the non-negative half of the
+        #           spectrum along the second axis is stored and processed
+        # backend:  'numpy', 'scipy', 'pyfftw' or an FFTBackend instance (see fftbackend.py)
+        # workers:  default number of FFT threads, can be overridden per call
+        # precision: 'double' or 'single'; in single precision the per-layer spectra are complex64 and
+        #            the cube is float32, while the mean, the forward FFT and the spectral factors
+        #            are still accumulated in double and rounded once
+        # kernel_cache: True (shared default cache), False/None or a KernelCache (see kernelcache.py);
+        #               frequency grids and field-independent spectral kernels are reused by every
+        #               box with the same padded shape
+        if precision not in PRECISION_DTYPES:
+            raise ValueError(f"precision must be one of {list(PRECISION_DTYPES)}")
+        self.__real_fft = real_fft
+        self.__fft = get_fft_backend(backend, workers)
+        self.__precision = precision
+        self.__dtype, self.__cdtype = PRECISION_DTYPES[precision]
+        self.__cache = get_kernel_cache(kernel_cache)
         pass
 
-    def set_field(self, field2D, pad = (1, 1)):
+    @property
+    def kernel_cache(self):
+        return self.__cache
+
+    @property
+    def fft_backend(self):
+        return self.__fft
+
+    @property
+    def precision(self):
+        return self.__precision
+
+    @property
+    def dtype(self):
+        return self.__dtype
+
+    @property
+    def padded_shape(self):
+        return tuple(int(n) for n in self.__pad_size)
+
+    def set_field(self, field2D, pad = (1, 1), auto_pad = False):
         # prepare
         size = np.shape(field2D)
         pad_size = np.ceil(size * (1 + np.array(pad, dtype = np.float64, order = 'C'))).astype(int)
         pad_size_half = (pad_size+1) // 2
         pad_size = pad_size_half * 2
+        if auto_pad:
+            # grow each padded size to the next even size the FFT backend handles fast (5-smooth for numpy),
+            # the chosen shape is reported by padded_shape
+            for i in range(len(pad_size)):
+                n = self.__fft.next_fast_len(pad_size[i])
+                while n % 2:
+                    n = self.__fft.next_fast_len(n + 1)
+                pad_size[i] = n
+                pass
         field_pad = np.zeros(pad_size, dtype = np.float64, order = 'C')
         field_pad[:size[0], :size[1]] = field2D
         self.__field_av = np.mean(field_pad)
         field_pad -= self.__field_av
     
         # FFT2
-        self.__field_fft = np.fft.fft2(field_pad)
+        if self.__real_fft:
+            self.__field_fft = self.__fft.rfft2(field_pad)
+        else:
+            self.__field_fft = self.__fft.fft2(field_pad)
     
         # uv-domain coefficients
-        u_vect = np.concatenate((np.linspace(0, pad_size_half[0], num = pad_size_half[0], endpoint = False), -np.linspace(pad_size_half[0], 0, num = pad_size_half[0], endpoint = False))) / pad_size[0]
-        self.__u = np.tile(u_vect, (pad_size[1], 1)).transpose()
-        v_vect = np.concatenate((np.linspace(0, pad_size_half[1], num = pad_size_half[1], endpoint = False), -np.linspace(pad_size_half[1], 0, num = pad_size_half[1], endpoint = False))) / pad_size[1]
-        self.__v = np.tile(v_vect, (pad_size[0], 1))
-
-        self.__q = np.sqrt(self.__u**2 + self.__v**2)
+        grids = self.__cache.get(('grids', tuple(int(n) for n in pad_size), bool(self.__real_fft)), lambda: self.__grids(pad_size))
+        self.__u, self.__v, self.__q = grids['u'], grids['v'], grids['q']
 
         self.__size = size
+        self.__pad_size = pad_size
 
         pass
 
-    def lfff_at_z(self, z, alpha = 0, directive_cosines = (0, 0, 1)):
-        
-        if alpha == 0:
+    def __grids(self, pad_size):
+        pad_size_half = pad_size // 2
+        u_vect = np.concatenate((np.linspace(0, pad_size_half[0], num = pad_size_half[0], endpoint = False), -np.linspace(pad_size_half[0], 0, num = pad_size_half[0], endpoint = False))) / pad_size[0]
+        u = np.tile(u_vect, (pad_size[1], 1)).transpose()
+        v_vect = np.concatenate((np.linspace(0, pad_size_half[1], num = pad_size_half[1], endpoint = False), -np.linspace(pad_size_half[1], 0, num = pad_size_half[1], endpoint = False))) / pad_size[1]
+        v = np.tile(v_vect, (pad_size[0], 1))
+
+        if self.__real_fft:
+            # keep the Nyquist column with the same (negative) frequency as the full spectrum
+            u = u[:, :pad_size_half[1]+1].copy()
+            v = v[:, :pad_size_half[1]+1].copy()
+
+        return dict(u = u, v = v, q = np.sqrt(u**2 + v**2))
+
+    def __kernels(self, u, v, alpha, directive_cosines):
+        # height- and field-independent part of the solution:
+        #   G(z) = field_fft * invqv * exp(decay * z),  b_i(z) = ifft2(m_i * G(z)) (m_i is None means 1)
+        # alpha may also be an (n, 1, 1) array, then all kernels are stacked over the first axis
+        q = self.__q
+        if np.ndim(alpha) == 0 and alpha == 0:
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                invqv = 1 / (self.__u*directive_cosines[0] + self.__v*directive_cosines[1] + 1j*self.__q*directive_cosines[2])
+                invqv = 1 / (u*directive_cosines[0] + v*directive_cosines[1] + 1j*q*directive_cosines[2])
             invqv[np.isinf(invqv) | np.isnan(invqv)] = 0
 
-            G = self.__field_fft * invqv * np.exp(-2*np.pi*self.__q*z)
-
-            bx = (np.fft.ifft2(self.__u * G)).real
-            by = (np.fft.ifft2(self.__v * G)).real
-            bz = (np.fft.ifft2(1j*self.__q * G)).real + self.__field_av / directive_cosines[2]
+            decay = -2*np.pi*q
+            mults = (u, v, 1j*q)
             pass
         else:
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                k = np.sqrt(4*(np.pi*self.__q)**2 - alpha**2);
+                k = np.sqrt(4*(np.pi*q)**2 - alpha**2);
             k[k.imag != 0 | np.isinf(k) | np.isnan(k)] = 0
     
-            ukva = self.__u*k - self.__v*alpha
-            vkua = self.__v*k + self.__u*alpha
+            ukva = u*k - v*alpha
+            vkua = v*k + u*alpha
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                invqv = 1 / (-1j*(directive_cosines[0]*ukva + directive_cosines[1]*vkua)/(2*np.pi*self.__q**2) + directive_cosines[2])
+                invqv = 1 / (-1j*(directive_cosines[0]*ukva + directive_cosines[1]*vkua)/(2*np.pi*q**2) + directive_cosines[2])
             invqv[np.isinf(invqv) | np.isnan(invqv)] = 0
 
-            G = self.__field_fft * invqv * np.exp(-k*z)
+            decay = -k
 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                indq = 1 / (2*np.pi*self.__q**2);
+                indq = 1 / (2*np.pi*q**2);
             indq[np.isinf(indq) | np.isnan(indq)] = 0
     
-            bx = (np.fft.ifft2(-1j*ukva*indq * G)).real
-            by = (np.fft.ifft2(-1j*vkua*indq * G)).real
-            bz = (np.fft.ifft2(G) + self.__field_av / directive_cosines[2]).real
+            mults = (-1j*ukva*indq, -1j*vkua*indq, None)
+            pass
+
+        return invqv, decay, mults
+
+    def __factors(self, alpha = 0, directive_cosines = (0, 0, 1)):
+        F, decay, mults = self.__hermitian_factors(alpha, directive_cosines)
+        if self.__dtype == np.float64:
+            return F, decay, mults
+
+        def cast(x):
+            if x is None:
+                return None
+            return x.astype(self.__cdtype if np.iscomplexobj(x) else self.__dtype)
+
+        return cast(F), cast(decay), tuple(cast(m) for m in mults)
+
+    def __hermitian_factors(self, alpha = 0, directive_cosines = (0, 0, 1)):
+        # factors of the solution G(z) = F * exp(decay * z), b_i(z) = ifft2(m_i * G(z)); in the rfft mode
+        # F is None and m_i already include the field spectrum
+        if np.ndim(alpha) == 0:
+            key = ('kernels', self.padded_shape, bool(self.__real_fft), float(alpha), tuple(float(c) for c in directive_cosines))
+            kernels = self.__cache.get(key, lambda: self.__kernel_set(alpha, directive_cosines))
+        else:
+            kernels = self.__kernel_set(alpha, directive_cosines)
+
+        if not self.__real_fft:
+            return self.__field_fft * kernels['invqv'], kernels['decay'], (kernels['mx'], kernels['my'], kernels.get('mz'))
+
+        return None, kernels['decay'], tuple(kernels[name] * self.__field_fft for name in ('mx', 'my', 'mz'))
+
+    def __kernel_set(self, alpha, directive_cosines):
+        invqv, decay, mults = self.__kernels(self.__u, self.__v, alpha, directive_cosines)
+        if not self.__real_fft:
+            kernels = dict(invqv = invqv, decay = decay, mx = mults[0], my = mults[1])
+            if mults[2] is not None:
+                kernels.update(mz = mults[2])
+            return kernels
+
+        # irfft2 assumes a Hermitian spectrum, while the full path takes the real part of ifft2,
+        # i.e. projects onto the Hermitian part (S(u,v) + conj(S(-u,-v)))/2. The field spectrum is
+        # Hermitian and the decay depends on q only, so the projection reduces to the kernels
+        # (m_i * invqv + conj(m_i * invqv)(-u,-v)) / 2, built from the mirrored grids
+        # (the Nyquist frequencies map onto themselves).
+        u_m = -self.__u
+        u_m[self.__pad_size[0]//2, :] = self.__u[self.__pad_size[0]//2, :]
+        v_m = -self.__v
+        v_m[:, -1] = self.__v[:, -1]
+        invqv_m, _, mults_m = self.__kernels(u_m, v_m, alpha, directive_cosines)
+
+        kernels = dict(decay = decay)
+        for name, m, mm in zip(('mx', 'my', 'mz'), mults, mults_m):
+            kernels[name] = ((invqv if m is None else m * invqv) + np.conj(invqv_m if mm is None else mm * invqv_m)) / 2
+
+        return kernels
+
+    def __ifft2(self, spectrum, workers = None):
+        # real part of the inverse transform over the last two axes, cropped to the field size and copied,
+        # so that the padded (complex) transform is released as soon as this returns
+        if self.__real_fft:
+            b = self.__fft.irfft2(spectrum, s = self.__pad_size, axes = (-2, -1), workers = workers)
+        else:
+            b = self.__fft.ifft2(spectrum, axes = (-2, -1), workers = workers).real
+        return np.array(b[..., :self.__size[0], :self.__size[1]], dtype = self.__dtype)
+
+    def __layers(self, factors, z, directive_cosines, workers = None):
+        # all heights of z at once, inverse transforms batched over the (nz_block, Nx, Ny) stack
+        F, decay, mults = factors
+        G = np.exp(decay * z[:, np.newaxis, np.newaxis])
+        if F is not None:
+            G = F * G
+
+        # one multiplied spectrum at a time, each freed before the next component
+        b = []
+        for m in mults:
+            b.append(self.__ifft2(G if m is None else m * G, workers))
+        del G
+        b[2] += self.__field_av / directive_cosines[2]
+
+        return b
+
+    def lfff_at_z(self, z, alpha = 0, directive_cosines = (0, 0, 1), workers = None):
+        F, decay, mults = self.__factors(alpha, directive_cosines)
+
+        G = np.exp(decay*self.__dtype(z))
+        if F is not None:
+            G = F * G
+
+        bx, by, bz = [self.__ifft2(G if m is None else m * G, workers) for m in mults]
+        bz += self.__field_av / directive_cosines[2]
+
+        return dict(bx = bx, by = by, bz = bz)
+
+    def __heights(self, nz):
+        # nz is either the number of layers at integer heights 0..nz-1 or the array of heights
+        # itself (pixel units, strictly monotonic, non-uniform steps allowed)
+        if np.ndim(nz) == 0:
+            return np.arange(nz, dtype = self.__dtype)
+
+        z = np.asarray(nz, dtype = np.float64)
+        dz = np.diff(z)
+        if z.ndim != 1 or not (np.all(dz > 0) or np.all(dz < 0)):
+            raise ValueError("heights must be a strictly monotonic 1D array")
+
+        return z.astype(self.__dtype)
+
+    def cube_shape(self, nz, layout = 'xyz'):
+        # 'xyz': (Nx, Ny, nz) as returned by lfff_cube, 'zyx': (nz, Ny, Nx), heights first
+        if np.ndim(nz) != 0:
+            nz = len(nz)
+        if layout == 'xyz':
+            return (self.__size[0], self.__size[1], nz)
+        elif layout == 'zyx':
+            return (nz, self.__size[1], self.__size[0])
+        raise ValueError(f"layout must be 'xyz' or 'zyx', got {layout}")
+
+    def lfff_slabs(self, nz, alpha = 0, directive_cosines = (0, 0, 1), nz_block = None, workers = None):
+        # generator over height slabs k0:k1 of the heights given by nz (see __heights), yields (k0, k1, [bx, by, bz]) with (k1-k0, Nx, Ny) arrays;
+        # memory in use never exceeds a few nz_block-deep spectral stacks, nz_block = None sizes them by LFFF_SLAB_BYTES
+        z = self.__heights(nz)
+        factors = self.__factors(alpha, directive_cosines)
+        if nz_block is None:
+            nz_block = default_nz_block(self.__pad_size, self.__cdtype)
+
+        for k in range(0, len(z), nz_block):
+            yield k, min(k + nz_block, len(z)), self.__layers(factors, z[k:k+nz_block], directive_cosines, workers)
             pass
 
-        return dict(bx = bx[:self.__size[0], :self.__size[1]]
-                  , by = by[:self.__size[0], :self.__size[1]]
-                  , bz = bz[:self.__size[0], :self.__size[1]]
-                   )
-
-    def lfff_cube(self, nz, alpha = 0, directive_cosines = (0, 0, 1)):
-        bx = np.zeros((self.__size[0], self.__size[1], nz))        
-        by = np.zeros((self.__size[0], self.__size[1], nz))        
-        bz = np.zeros((self.__size[0], self.__size[1], nz))        
-
-        for k in range(0, nz):
-            res = self.lfff_at_z(k, alpha, directive_cosines)
-            bx[:,:,k] = res['bx']
-            by[:,:,k] = res['by']
-            bz[:,:,k] = res['bz']
+    def lfff_stream(self, out, nz, alpha = 0, directive_cosines = (0, 0, 1), nz_block = None, workers = None, layout = 'xyz'):
+        # writes the cube slab by slab into out['bx'], out['by'], out['bz'], which can be anything
+        # supporting slice assignment with shape cube_shape(nz, layout): numpy arrays, np.memmap
+        # (e.g. np.lib.format.open_memmap) or chunked h5py datasets
+        self.cube_shape(nz, layout)
+
+        for k0, k1, res in self.lfff_slabs(nz, alpha, directive_cosines, nz_block, workers):
+            for name, b in zip(('bx', 'by', 'bz'), res):
+                if layout == 'zyx':
+                    out[name][k0:k1, :, :] = b.transpose((0, 2, 1))
+                else:
+                    out[name][:, :, k0:k1] = b.transpose((1, 2, 0))
             pass
 
-        return dict(bx = bx
-                  , by = by
-                  , bz = bz
-                   )
\ No newline at end of file
+        return out
+
+    def lfff_cube(self, nz, alpha = 0, directive_cosines = (0, 0, 1), nz_block = None, workers = None, layout = 'xyz'):
+        # layout 'zyx' returns C-ordered (nz, Ny, Nx) cubes, i.e. the layout of the NLFFF solver input,
+        # which MagFieldWrapper.load_cube_vars(..., copy = False) takes without any copy in double precision
+        res = dict(bx = np.zeros(self.cube_shape(nz, layout), dtype = self.__dtype)
+                 , by = np.zeros(self.cube_shape(nz, layout), dtype = self.__dtype)
+                 , bz = np.zeros(self.cube_shape(nz, layout), dtype = self.__dtype)
+                  )
+
+        return self.lfff_stream(res, nz, alpha, directive_cosines, nz_block, workers, layout)
+
+    def lfff_alpha_sweep(self, alphas, bx = None, by = None, z = 0, directive_cosines = (0, 0, 1), alpha_block = 16, workers = None, return_fields = False):
+        # evaluates the field at height z for a whole vector of alphas, alpha_block of them per batched
+        # transform; the grids and the field spectrum from set_field are shared by all of them.
+        # With the observed transverse boundary (bx, by), given in the same axes as the set_field input,
+        # the misfit sum|Bt - Bt_obs|^2 / sum|Bt_obs|^2 over finite pixels is returned for every alpha
+        alphas = np.atleast_1d(np.asarray(alphas, dtype = np.float64))
+        misfit = np.full(alphas.shape, np.nan)
+        if return_fields:
+            bx_all = np.zeros((alphas.size, self.__size[0], self.__size[1]), dtype = self.__dtype)
+            by_all = np.zeros((alphas.size, self.__size[0], self.__size[1]), dtype = self.__dtype)
+
+        if bx is not None and by is not None:
+            mask = np.isfinite(bx) & np.isfinite(by)
+            bt_obs = np.sum(bx[mask]**2 + by[mask]**2)
+
+        for k in range(0, alphas.size, alpha_block):
+            F, decay, mults = self.__factors(alphas[k:k+alpha_block, np.newaxis, np.newaxis], directive_cosines)
+            G = np.exp(decay*self.__dtype(z))
+            if F is not None:
+                G = F * G
+
+            btx = self.__ifft2(mults[0] * G, workers)
+            bty = self.__ifft2(mults[1] * G, workers)
+
+            if bx is not None and by is not None:
+                misfit[k:k+alpha_block] = np.sum((btx[:, mask] - bx[mask])**2 + (bty[:, mask] - by[mask])**2, axis = 1, dtype = np.float64) / bt_obs
+            if return_fields:
+                bx_all[k:k+alpha_block] = btx
+                by_all[k:k+alpha_block] = bty
+            pass
+
+        res = dict(alpha = alphas
+                 , misfit = misfit
+                 , best_alpha = alphas[np.nanargmin(misfit)] if np.any(np.isfinite(misfit)) else None
+                  )
+        if return_fields:
+            res.update(bx = bx_all, by = by_all)
+
+        return res
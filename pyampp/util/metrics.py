@@ -0,0 +1,91 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# sums accumulated per block by force_free_metrics
+_SUMS = ("n", "n_j", "abs_j", "abs_j_sin", "sin", "abs_fi", "abs_div", "abs_b")
+
+
+def _block_sums(bx, by, bz, k0, k1):
+    # central differences on the interior voxels of heights k0:k1, unit voxel size
+    sx, sy, sz = (b[k0 - 1:k1 + 1] for b in (bx, by, bz))
+
+    def d(s, axis):
+        hi = [slice(1, -1)] * 3
+        lo = [slice(1, -1)] * 3
+        hi[axis] = slice(2, None)
+        lo[axis] = slice(None, -2)
+        return (s[tuple(hi)] - s[tuple(lo)]) * 0.5
+
+    c = (slice(1, -1),) * 3
+    b_x, b_y, b_z = (np.asarray(s[c], dtype=np.float64) for s in (sx, sy, sz))
+    j_x = d(sz, 1) - d(sy, 0)
+    j_y = d(sx, 0) - d(sz, 2)
+    j_z = d(sy, 2) - d(sx, 1)
+    div = d(sx, 2) + d(sy, 1) + d(sz, 0)
+
+    abs_b = np.sqrt(b_x * b_x + b_y * b_y + b_z * b_z)
+    abs_j = np.sqrt(j_x * j_x + j_y * j_y + j_z * j_z)
+    jxb_x = j_y * b_z - j_z * b_y
+    jxb_y = j_z * b_x - j_x * b_z
+    jxb_z = j_x * b_y - j_y * b_x
+    abs_jxb = np.sqrt(jxb_x * jxb_x + jxb_y * jxb_y + jxb_z * jxb_z)
+
+    valid = abs_b > 0
+    valid_j = valid & (abs_j > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sin = np.where(valid_j, abs_jxb / (abs_j * abs_b), 0.0)
+        abs_fi = np.where(valid, np.abs(div) / (6 * abs_b), 0.0)
+
+    return dict(n=np.count_nonzero(valid), n_j=np.count_nonzero(valid_j),
+                abs_j=abs_j[valid_j].sum(), abs_j_sin=(abs_j * sin)[valid_j].sum(), sin=sin.sum(),
+                abs_fi=abs_fi.sum(), abs_div=np.abs(div)[valid].sum(), abs_b=abs_b[valid].sum())
+
+
+def force_free_metrics(bx, by, bz, layout='zyx', nz_block=16, workers=None):
+    """
+    Standard force-free quality metrics of a field model, computed in one blocked pass over the
+    interior voxels (central differences, isotropic voxels) with ``workers`` threads:
+
+    * ``cw_sin``: current-weighted sine of the angle between J and B, sum(|J| sin) / sum(|J|),
+      and ``theta_j``, its angle in degrees;
+    * ``mean_sin``: mean |J x B| / (|J| |B|) over voxels with current;
+    * ``mean_abs_fi``: <|f_i|>, the mean fractional flux through the voxel faces, |div B| dV / (|B| A);
+    * ``norm_div``: normalised divergence <|div B|> dx / <|B|>.
+
+    :param bx: Physical x component of the field.
+    :type bx: numpy.ndarray
+    :param by: Physical y component.
+    :type by: numpy.ndarray
+    :param bz: Physical z (vertical) component.
+    :type bz: numpy.ndarray
+    :param layout: Axis order of the cubes, 'zyx' (cubes of `ampp_field`) or 'xyz'.
+    :type layout: str, optional
+    :param nz_block: Number of heights per block.
+    :type nz_block: int, optional
+    :param workers: Number of threads, defaults to the number of CPUs.
+    :type workers: int, optional
+    :rtype: dict
+    """
+    if layout not in ('zyx', 'xyz'):
+        raise ValueError(f"layout {layout} is unknown. layout must be 'zyx' or 'xyz'")
+    cubes = [np.asarray(b) for b in (bx, by, bz)]
+    if layout == 'xyz':
+        cubes = [b.transpose((2, 1, 0)) for b in cubes]
+    if min(cubes[0].shape) < 3:
+        raise ValueError(f"box of shape {cubes[0].shape} has no interior voxels")
+
+    nz = cubes[0].shape[0]
+    blocks = [(k, min(k + nz_block, nz - 1)) for k in range(1, nz - 1, nz_block)]
+    workers = os.cpu_count() if workers is None else workers
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        parts = list(pool.map(lambda kk: _block_sums(*cubes, *kk), blocks))
+    sums = {k: sum(p[k] for p in parts) for k in _SUMS}
+
+    cw_sin = float(sums["abs_j_sin"] / sums["abs_j"]) if sums["abs_j"] > 0 else 0.0
+    return dict(cw_sin=cw_sin,
+                theta_j=float(np.rad2deg(np.arcsin(min(cw_sin, 1.0)))),
+                mean_sin=float(sums["sin"] / sums["n_j"]) if sums["n_j"] > 0 else 0.0,
+                mean_abs_fi=float(sums["abs_fi"] / sums["n"]) if sums["n"] > 0 else 0.0,
+                norm_div=float(sums["abs_div"] / sums["abs_b"]) if sums["abs_b"] > 0 else 0.0)
@@ -0,0 +1,496 @@
+import hashlib
+import os
+import time
+
+import astropy.units as u
+import h5py
+import numpy as np
+from scipy import ndimage
+
+try:
+    from sunpy.sun.models import differential_rotation
+except ImportError:  # sunpy < 6.0
+    from sunpy.physics.differential_rotation import diff_rot
+
+    def differential_rotation(duration, latitude, *, model='howard', frame_time='sidereal'):
+        return diff_rot(duration, latitude, rot_type=model, frame_time=frame_time)
+
+from pyampp.util.nlfff_job import default_wrapper_factory, supports_iteration_limit, supports_zero_copy
+
+# the solver takes one voxel size, so the voxel sizes of a multigrid level along the three axes may differ
+# by at most this fraction
+MULTIGRID_ANISOTROPY = 0.1
+# smallest size of a multigrid level along any axis
+MULTIGRID_MIN_SIZE = 4
+
+
+def solution_as_input(res):
+    """
+    Returns the cubes of a `MagFieldWrapper.NLFFF` result in the argument order of
+    `MagFieldWrapper.load_cube_vars`, which swaps bx and by internally.
+
+    :param res: Result of `MagFieldWrapper.NLFFF`.
+    :type res: dict
+    :return: (bx, by, bz) to be passed to `load_cube_vars`.
+    :rtype: tuple
+    """
+    return res["by"], res["bx"], res["bz"]
+
+
+def resample_cube(b, shape, order=1):
+    """
+    Resamples a 3D cube to ``shape`` with spline interpolation, keeping the corner voxels in place.
+
+    :param b: Cube to resample.
+    :type b: numpy.ndarray
+    :param shape: Target shape.
+    :type shape: tuple of int
+    :param order: Spline order, defaults to 1 (trilinear).
+    :type order: int, optional
+    :rtype: numpy.ndarray
+    """
+    shape = tuple(int(n) for n in shape)
+    if tuple(b.shape) == shape:
+        return np.array(b, dtype=np.float64, order="C")
+    zoom = [(n_out - 1) / max(n_in - 1, 1) for n_in, n_out in zip(b.shape, shape)]
+    coords = np.meshgrid(*[np.arange(n) / z if z > 0 else np.zeros(n) for n, z in zip(shape, zoom)],
+                         indexing="ij", sparse=True)
+    coords = np.broadcast_arrays(*coords)
+    return ndimage.map_coordinates(np.asarray(b, dtype=np.float64), coords, order=order, mode="nearest")
+
+
+def inject_boundaries(b, b_ref):
+    """
+    Copies the six faces of ``b_ref`` into ``b`` in place, e.g. the observed bottom and the potential
+    lateral and top boundaries into an interpolated initial guess.
+
+    :param b: Cube to modify.
+    :type b: numpy.ndarray
+    :param b_ref: Cube of the same shape providing the boundary values.
+    :type b_ref: numpy.ndarray
+    :return: ``b``
+    :rtype: numpy.ndarray
+    """
+    for axis in range(b.ndim):
+        for i in (0, -1):
+            index = [slice(None)] * b.ndim
+            index[axis] = i
+            b[tuple(index)] = b_ref[tuple(index)]
+    return b
+
+
+def _level_grid(full_shape, factor):
+    # shape of a level downsampled by factor and its voxel size along every axis in full resolution voxels;
+    # the corner voxels are kept in place (see resample_cube)
+    shape = tuple(max(int(round((n - 1) / factor)) + 1, min(n, MULTIGRID_MIN_SIZE)) for n in full_shape)
+    spacing = tuple((n - 1) / max(m - 1, 1) for n, m in zip(full_shape, shape))
+    return shape, spacing
+
+
+class NLFFFCheckpoint:
+    """
+    HDF5 snapshot of an NLFFF run: the latest solution (as returned by `MagFieldWrapper.NLFFF`) in the
+    ``checkpoint`` group, with the run metadata (level and chunk index, factors, voxel size, energy, time
+    and a checksum of the input cubes) as its attributes. Snapshots are written to a temporary file and
+    renamed, so a job killed while writing leaves the previous snapshot intact.
+
+    :param path: Checkpoint file.
+    :type path: str
+    :param interval: Minimal time in seconds between two snapshots, the final solution is always saved.
+    :type interval: float, optional
+    """
+
+    def __init__(self, path, interval=0):
+        self.path = str(path)
+        self.interval = interval
+        self._t_last = None
+
+    def __repr__(self):
+        return f"NLFFFCheckpoint(path={self.path!r}, interval={self.interval})"
+
+    @staticmethod
+    def input_checksum(bx, by, bz, dr):
+        """
+        Returns a checksum of the input cubes and voxel size, which identifies the run a snapshot belongs to.
+        """
+        digest = hashlib.sha1(repr(float(dr)).encode("utf-8"))
+        for b in (bx, by, bz):
+            b = np.ascontiguousarray(b, dtype=np.float64)
+            digest.update(repr(b.shape).encode("utf-8"))
+            digest.update(b.data)
+        return digest.hexdigest()
+
+    def due(self, final=False):
+        """
+        True if a snapshot should be written now.
+        """
+        return final or self._t_last is None or time.time() - self._t_last >= self.interval
+
+    def save(self, res, **meta):
+        """
+        Writes a snapshot.
+
+        :param res: Solution as returned by `MagFieldWrapper.NLFFF`.
+        :type res: dict
+        :param meta: Metadata stored as attributes, e.g. stage index and energy.
+        """
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with h5py.File(tmp, "w") as f:
+            group = f.create_group("checkpoint")
+            for name in ("bx", "by", "bz"):
+                group.create_dataset(name, data=res[name])
+            group.attrs.update(meta)
+            group.attrs["saved"] = time.time()
+        os.replace(tmp, self.path)
+        self._t_last = time.time()
+
+    def load(self, checksum=None):
+        """
+        Reads the latest snapshot.
+
+        :param checksum: If given, snapshots of other inputs (see `input_checksum`) are ignored.
+        :type checksum: str, optional
+        :return: (solution dict, metadata dict), or None if there is no matching snapshot.
+        :rtype: tuple or None
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with h5py.File(self.path, "r") as f:
+            if "checkpoint" not in f:
+                return None
+            group = f["checkpoint"]
+            meta = dict(group.attrs)
+            if checksum is not None and meta.get("input_checksum") != checksum:
+                return None
+            res = {name: group[name][...] for name in ("bx", "by", "bz")}
+        return res, meta
+
+
+def _solve_chunks(maglib, b_init, dr, nlfff_kwargs, chunk_iterations=None, max_chunks=100, tol=1e-4,
+                  start_chunk=0, energy=None, on_chunk=None, copy=True):
+    # solves in chunks of ``chunk_iterations`` solver iterations, each continuing from the solution of the
+    # previous one, until the energy changes by less than ``tol`` (relative) between two chunks;
+    # on_chunk(res, chunk, energy, done) is called after every chunk. Wrappers without an iteration
+    # limit solve in a single chunk. Returns (res, energy, number of chunks solved).
+    if chunk_iterations is not None and supports_iteration_limit(maglib):
+        nlfff_kwargs = dict(nlfff_kwargs, max_iterations=chunk_iterations)
+        max_chunks = max(max_chunks, start_chunk + 1)
+    else:
+        max_chunks = start_chunk + 1
+    zero_copy = not copy and supports_zero_copy(maglib)
+    b = b_init
+    for chunk in range(start_chunk, max_chunks):
+        if zero_copy:
+            maglib.load_cube_vars(*b, dr, copy=False)
+        else:
+            maglib.load_cube_vars(*b, dr)
+        res = maglib.NLFFF(**nlfff_kwargs)
+        previous, energy = energy, maglib.energy
+        done = chunk == max_chunks - 1 or (previous is not None and abs(energy - previous) <= tol * abs(energy))
+        if on_chunk is not None:
+            on_chunk(res, chunk, energy, done)
+        if done:
+            return res, energy, chunk + 1 - start_chunk
+        b = solution_as_input(res)
+
+
+def multigrid_nlfff(bx, by, bz, dr, factors=(4, 2, 1), maglib=None, order=1, checkpoint=None, chunk_iterations=None,
+                    max_chunks=100, tol=1e-4, copy=True, **nlfff_kwargs):
+    """
+    Coarse-to-fine NLFFF solution. The initial (potential) cube is first solved on a box downsampled
+    by ``factors[0]``; each solution is interpolated to the next finer level, where the boundaries of
+    the initial cube are injected again, and is used as the initial guess there. The last factor
+    should be 1, so that the final solution has full resolution.
+
+    The solver takes one voxel size, so a level is solved with the geometric mean of its voxel sizes along
+    the three axes, and factors for which these differ by more than MULTIGRID_ANISOTROPY (e.g. when an axis
+    is clamped to MULTIGRID_MIN_SIZE voxels) are rejected before anything is solved.
+
+    With ``chunk_iterations`` every level is solved in chunks of that many solver iterations, each
+    continuing from the previous one, so that a checkpoint can be written during a long solve; this
+    needs a wrapper whose ``NLFFF`` accepts ``max_iterations`` (see `supports_iteration_limit`), other
+    wrappers solve every level in one call.
+
+    Cubes have the layout expected by `MagFieldWrapper.load_cube_vars`.
+
+    :param bx: Initial bx cube.
+    :type bx: numpy.ndarray
+    :param by: Initial by cube.
+    :type by: numpy.ndarray
+    :param bz: Initial bz cube.
+    :type bz: numpy.ndarray
+    :param dr: Full resolution voxel size passed to `load_cube_vars`.
+    :type dr: float
+    :param factors: Downsampling factor of every level, from coarse to fine. ``(1,)`` is the plain single-level solve.
+    :type factors: tuple of int, optional
+    :param maglib: Solver wrapper, defaults to a new pyAMaFiL MagFieldWrapper.
+    :param order: Spline order of the up- and downsampling, defaults to 1.
+    :type order: int, optional
+    :param checkpoint: Checkpoint (or its file path) the solution is saved to after every chunk (at most once
+        per its interval) and at the end of every level. If it holds a snapshot of the same input and
+        factors, the run resumes from it: after the saved level, or within it after the saved chunk.
+    :type checkpoint: NLFFFCheckpoint or str, optional
+    :param chunk_iterations: Solver iterations per chunk, None solves every level in one call.
+    :type chunk_iterations: int, optional
+    :param max_chunks: Maximal number of chunks per level.
+    :type max_chunks: int, optional
+    :param tol: A level is finished when its energy changes by less than ``tol`` (relative) between two chunks.
+    :type tol: float, optional
+    :param copy: False lets a zero-copy wrapper (see `supports_zero_copy`) solve in the input cubes of a
+        full resolution level, which are then overwritten.
+    :type copy: bool, optional
+    :param nlfff_kwargs: Keyword arguments of `MagFieldWrapper.NLFFF`.
+    :return: dict(bx, by, bz) as returned by `MagFieldWrapper.NLFFF`, plus ``energy`` (erg) and ``time`` (s)
+        of the whole run and ``levels``, a list of dict(factor, shape, dr, time, energy, chunks) for every level.
+    :rtype: dict
+    """
+    if len(factors) == 0 or any(f < 1 for f in factors):
+        raise ValueError(f"factors must be a non-empty sequence of integers >= 1, got {factors}")
+    if chunk_iterations is not None and chunk_iterations < 1:
+        raise ValueError(f"chunk_iterations must be positive, got {chunk_iterations}")
+
+    b_init = [np.asarray(b) for b in (bx, by, bz)]
+    full_shape = b_init[0].shape
+    grids = [_level_grid(full_shape, factor) for factor in factors]
+    for factor, (shape, spacing) in zip(factors, grids):
+        if max(spacing) > (1 + MULTIGRID_ANISOTROPY) * min(spacing):
+            raise ValueError(f"factor {factor} resamples the box {full_shape} to {shape}, the voxel sizes "
+                             f"{[round(s, 3) for s in spacing]} along the axes are not isotropic")
+    level_dr = [dr * float(np.prod(spacing)) ** (1 / len(spacing)) for shape, spacing in grids]
+    if maglib is None:
+        maglib = default_wrapper_factory()
+    levels = []
+    guess = None
+    resume = None
+    start = 0
+    checksum = None
+    t_total = time.perf_counter()
+
+    if checkpoint is not None:
+        if not isinstance(checkpoint, NLFFFCheckpoint):
+            checkpoint = NLFFFCheckpoint(checkpoint)
+        checksum = NLFFFCheckpoint.input_checksum(*b_init, dr)
+        snapshot = checkpoint.load(checksum)
+        if snapshot is not None and list(snapshot[1]["factors"]) == list(factors):
+            res, meta = snapshot
+            level = int(meta["level"])
+            levels = [dict(factor=factors[i], shape=grids[i][0], dr=level_dr[i], time=0.0, energy=None, chunks=0)
+                      for i in range(level + 1)]
+            levels[-1].update(energy=float(meta["energy"]), resumed=True)
+            if meta.get("level_done", True):
+                start = level + 1
+                guess = solution_as_input(res)
+            else:
+                # continue the interrupted level from its last saved chunk
+                start = level
+                resume = (solution_as_input(res), int(meta["chunk"]) + 1, float(meta["energy"]))
+                levels.pop()
+
+    for level in range(start, len(factors)):
+        factor = factors[level]
+        t0 = time.perf_counter()
+        shape = grids[level][0]
+        if resume is not None:
+            b_level, start_chunk, energy = resume
+            resume = None
+        else:
+            b_level = b_init if shape == full_shape else [resample_cube(b, shape, order) for b in b_init]
+            if guess is not None:
+                b_level = [inject_boundaries(resample_cube(g, shape, order), b) for g, b in zip(guess, b_level)]
+            start_chunk, energy = 0, None
+        final_level = level == len(factors) - 1
+
+        def save(res, chunk, energy, done):
+            if checkpoint is not None and checkpoint.due(done):
+                checkpoint.save(res, level=level, chunk=chunk, level_done=done, factors=list(factors), factor=factor,
+                                dr=dr, energy=energy, input_checksum=checksum, final=done and final_level)
+
+        res, energy, chunks = _solve_chunks(maglib, b_level, level_dr[level], nlfff_kwargs, chunk_iterations, max_chunks,
+                                            tol, start_chunk, energy, save, copy)
+        guess = solution_as_input(res)
+        levels.append(dict(factor=factor, shape=shape, dr=level_dr[level], time=time.perf_counter() - t0, energy=energy,
+                           chunks=chunks))
+        if start_chunk > 0:
+            levels[-1]["resumed"] = True
+
+    return dict(bx=res["bx"], by=res["by"], bz=res["bz"], energy=levels[-1]["energy"],
+                time=time.perf_counter() - t_total, levels=levels)
+
+
+def cea_row_latitudes(box_map):
+    """
+    Returns the latitudes of the pixel rows of a CEA box bottom (e.g. made by `cutout2box`), in degrees,
+    taken along the central column. The CEA grid of the box is oblique (its reference latitude is the
+    box center), so the rows are computed from the box WCS rather than from the cylindrical formula.
+
+    :param box_map: Box bottom map in heliographic coordinates.
+    :type box_map: sunpy.map.GenericMap
+    :rtype: numpy.ndarray
+    """
+    ny, nx = box_map.data.shape
+    rows = box_map.pixel_to_world(np.full(ny, (nx - 1) / 2) * u.pix, np.arange(ny) * u.pix)
+    return rows.lat.to_value(u.deg)
+
+
+def differential_rotation_shift(duration, latitude, scale, rot_type='howard'):
+    """
+    Returns the longitudinal displacement of surface features relative to the Carrington frame,
+    in CEA pixels, e.g. between two epochs of a box tracked at a fixed Carrington position.
+
+    :param duration: Time between the epochs.
+    :type duration: astropy.units.Quantity
+    :param latitude: Latitudes of the box rows, degrees.
+    :type latitude: numpy.ndarray
+    :param scale: CEA pixel scale, degrees per pixel.
+    :type scale: float
+    :param rot_type: Differential rotation model of `sunpy.sun.models.differential_rotation`.
+    :type rot_type: str, optional
+    :rtype: numpy.ndarray
+    """
+    latitude = np.asarray(latitude) * u.deg
+    dlon = (differential_rotation(duration, latitude, model=rot_type).to_value(u.deg)
+            - differential_rotation(duration, latitude, model='rigid').to_value(u.deg))
+    dlon = (dlon + 180) % 360 - 180
+    return dlon / scale
+
+
+def carrington_lon_shift(lon, lon_prev, scale):
+    """
+    Returns the displacement of the box center between two epochs in CEA pixels.
+
+    :param lon: Carrington longitude of the box center, degrees.
+    :type lon: float
+    :param lon_prev: Carrington longitude of the previous box center, degrees.
+    :type lon_prev: float
+    :param scale: CEA pixel scale, degrees per pixel.
+    :type scale: float
+    :rtype: float
+    """
+    return ((lon - lon_prev + 180) % 360 - 180) / scale
+
+
+def shift_rows(b, shift, order=1):
+    """
+    Shifts every (y) row of a (z, y, x) cube along x by ``shift[y]`` pixels, with linear interpolation.
+
+    :param b: Cube in (z, y, x) layout.
+    :type b: numpy.ndarray
+    :param shift: Shift of every row in pixels, positive towards larger x.
+    :type shift: numpy.ndarray
+    :param order: Spline order, defaults to 1.
+    :type order: int, optional
+    :rtype: numpy.ndarray
+    """
+    nz, ny, nx = b.shape
+    shift = np.broadcast_to(np.asarray(shift, dtype=np.float64), (ny,))
+    out = np.empty((nz, ny, nx), dtype=np.float64)
+    x = np.arange(nx, dtype=np.float64)
+    for j in range(ny):
+        out[:, j, :] = ndimage.map_coordinates(np.asarray(b[:, j, :], dtype=np.float64),
+                                               np.meshgrid(np.arange(nz), x - shift[j], indexing="ij"),
+                                               order=order, mode="nearest")
+    return out
+
+
+def warm_start_guess(b_prev, b_init, shift=None):
+    """
+    Builds the initial guess of a warm-started solution: the previous solution, optionally shifted
+    by `shift_rows`, with the six faces (new bottom boundary, potential sides and top) taken from the
+    new initial cube.
+
+    :param b_prev: Previous solution, one component in (z, y, x) layout.
+    :type b_prev: numpy.ndarray
+    :param b_init: New initial (potential with the observed bottom) cube of the same component.
+    :type b_init: numpy.ndarray
+    :param shift: Per-row shift of the previous solution in pixels, None for no rotation.
+    :type shift: numpy.ndarray, optional
+    :rtype: numpy.ndarray
+    """
+    if np.shape(b_prev) != np.shape(b_init):
+        raise ValueError(f"previous solution of shape {np.shape(b_prev)} does not match the box {np.shape(b_init)}")
+    guess = shift_rows(b_prev, shift) if shift is not None else np.array(b_prev, dtype=np.float64, order="C")
+    return inject_boundaries(guess, b_init)
+
+
+class WarmStartNLFFF:
+    """
+    NLFFF solutions of a time series of the same box. Every epoch after the first is started from the
+    previous solution, differentially rotated to the new epoch, with the new boundaries injected
+    (see `warm_start_guess`), instead of from the potential field.
+
+    The solver library does not report its iteration count, so the savings are recorded as wall time:
+    every entry of ``history`` holds the time of the step, the time of the last cold (potential
+    started) solution scaled to the same number of voxels, and their ratio ``speedup``.
+
+    Cubes have the (z, y, x) layout of `MagFieldWrapper.load_cube_vars` as used in `ampp_field`.
+
+    :param maglib: Solver wrapper, defaults to a new pyAMaFiL MagFieldWrapper.
+    :param rot_type: Differential rotation model, see `differential_rotation_shift`.
+    :type rot_type: str, optional
+    """
+
+    def __init__(self, maglib=None, rot_type='howard'):
+        self.maglib = default_wrapper_factory() if maglib is None else maglib
+        self.rot_type = rot_type
+        self.history = []
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous solution, the next step is solved from the potential field.
+        """
+        self.previous = None
+        self.previous_time = None
+        self.previous_lon = None
+        self.cold_time_per_voxel = None
+
+    def step(self, bx, by, bz, dr, obs_time=None, latitude=None, scale=None, center_lon=None, **nlfff_kwargs):
+        """
+        Solves the next epoch.
+
+        :param bx: Initial bx cube of the epoch.
+        :param by: Initial by cube of the epoch.
+        :param bz: Initial bz cube of the epoch.
+        :param dr: Voxel size passed to `load_cube_vars`.
+        :type dr: float
+        :param obs_time: Time of the epoch, needed for the differential rotation.
+        :type obs_time: astropy.time.Time, optional
+        :param latitude: Latitudes of the box rows in degrees, see `cea_row_latitudes`.
+        :type latitude: numpy.ndarray, optional
+        :param scale: CEA pixel scale in degrees per pixel.
+        :type scale: float, optional
+        :param center_lon: Carrington longitude of the box center in degrees, if the box is re-centered
+            between epochs. None means a box fixed in Carrington coordinates.
+        :type center_lon: float, optional
+        :param nlfff_kwargs: Keyword arguments of `MagFieldWrapper.NLFFF`.
+        :return: dict(bx, by, bz) as returned by `MagFieldWrapper.NLFFF`, plus the ``history`` entry of the step.
+        :rtype: dict
+        """
+        b_init = (bx, by, bz)
+        warm = self.previous is not None and np.shape(self.previous[0]) == np.shape(bx)
+        shift = None
+        if warm:
+            if obs_time is not None and self.previous_time is not None and latitude is not None and scale is not None:
+                shift = differential_rotation_shift((obs_time - self.previous_time).to(u.s), latitude, scale,
+                                                    rot_type=self.rot_type)
+                if center_lon is not None and self.previous_lon is not None:
+                    shift = shift - carrington_lon_shift(center_lon, self.previous_lon, scale)
+            b_init = [warm_start_guess(p, b, shift) for p, b in zip(self.previous, b_init)]
+
+        t0 = time.perf_counter()
+        self.maglib.load_cube_vars(*b_init, dr)
+        res = self.maglib.NLFFF(**nlfff_kwargs)
+        t_solve = time.perf_counter() - t0
+
+        n_voxels = int(np.prod(np.shape(bx)))
+        if not warm:
+            self.cold_time_per_voxel = t_solve / n_voxels
+        cold_time = self.cold_time_per_voxel * n_voxels
+        entry = dict(warm=warm, time=t_solve, cold_time=cold_time, speedup=cold_time / t_solve,
+                     energy=self.maglib.energy, shift=None if shift is None else float(np.mean(shift)))
+        self.history.append(entry)
+
+        self.previous = [np.array(b, dtype=np.float64) for b in solution_as_input(res)]
+        self.previous_time = obs_time
+        self.previous_lon = center_lon
+        return dict(bx=res["bx"], by=res["by"], bz=res["bz"], **entry)
@@ -0,0 +1,344 @@
+import importlib.util
+import inspect
+import multiprocessing as mp
+import os
+import sys
+import time
+import traceback
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+
+NLFFF_JOB_STATES = ['pending', 'running', 'done', 'failed', 'cancelled']
+
+# environment variable overriding the location of the solver library of the in-repo MagFieldWrapper
+MAGFIELD_LIB_ENV = 'PYAMPP_MAGFIELD_LIB'
+# solver library shipped with pyAMaFiL, with the shared library suffix of the platform
+MAGFIELD_LIB_NAME = 'WWNLFFFReconstruction'
+MAGFIELD_LIB_SUFFIX = {'win32': '.dll', 'darwin': '.dylib'}.get(sys.platform, '.so')
+
+
+def default_wrapper_factory():
+    """
+    Creates the NLFFF solver wrapper used by the pipeline (pyAMaFiL's MagFieldWrapper).
+    """
+    from pyAMaFiL.mag_field_wrapper import MagFieldWrapper
+    return MagFieldWrapper()
+
+
+def magfield_library_path():
+    """
+    Locates the shared library of the NLFFF solver: the path in the PYAMPP_MAGFIELD_LIB environment
+    variable, otherwise the WWNLFFFReconstruction library of the current platform shipped with the
+    installed pyAMaFiL package (the library pyAMaFiL's own wrapper loads).
+
+    :return: Path of the shared library.
+    :rtype: str
+    :raises ImportError: If the library is missing, or if several candidates are found.
+    """
+    path = os.environ.get(MAGFIELD_LIB_ENV)
+    if path:
+        if not os.path.isfile(path):
+            raise ImportError(f"{MAGFIELD_LIB_ENV}={path} is not a file")
+        return path
+    spec = importlib.util.find_spec('pyAMaFiL')
+    folders = [] if spec is None else list(spec.submodule_search_locations or [])
+    pattern = f"{MAGFIELD_LIB_NAME}*{MAGFIELD_LIB_SUFFIX}"
+    libs = sorted({str(lib) for folder in folders for lib in Path(folder).rglob(pattern)})
+    if not libs:
+        raise ImportError(f"NLFFF solver library {pattern} not found, install pyAMaFiL or set {MAGFIELD_LIB_ENV}")
+    if len(libs) > 1:
+        raise ImportError(f"several NLFFF solver libraries found ({', '.join(libs)}), "
+                          f"select one with {MAGFIELD_LIB_ENV}")
+    return libs[0]
+
+
+def inplace_wrapper_factory():
+    """
+    Creates the in-repo `MagFieldWrapper` on the solver library of `magfield_library_path`. Unlike
+    pyAMaFiL's wrapper it loads C-ordered float64 cubes without copying them (``copy=False``).
+    """
+    from pyampp.util.MagFieldWrapper import MagFieldWrapper
+    return MagFieldWrapper(magfield_library_path())
+
+
+def preferred_wrapper_factory():
+    """
+    Creates the in-repo zero-copy `MagFieldWrapper` if the solver library is located unambiguously by
+    `magfield_library_path`, and pyAMaFiL's wrapper (which copies the cubes) otherwise.
+    """
+    try:
+        return inplace_wrapper_factory()
+    except ImportError as e:
+        print(f"NLFFF: {e}; using pyAMaFiL's MagFieldWrapper, which copies the cubes")
+        return default_wrapper_factory()
+
+
+def supports_zero_copy(maglib):
+    """
+    Tells whether the ``load_cube_vars`` of a solver wrapper accepts ``copy=False``.
+
+    :param maglib: Solver wrapper.
+    :rtype: bool
+    """
+    return _accepts(maglib.load_cube_vars, 'copy')
+
+
+def supports_iteration_limit(maglib):
+    """
+    Tells whether the ``NLFFF`` of a solver wrapper accepts ``max_iterations``, so that a solution can
+    be computed in bounded chunks (see `pyampp.util.nlfff.checkpointed_nlfff`).
+
+    :param maglib: Solver wrapper.
+    :rtype: bool
+    """
+    return _accepts(maglib.NLFFF, 'max_iterations')
+
+
+def _accepts(func, name):
+    try:
+        return name in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _nlfff_worker(shm_name, shape, dr, nlfff_kwargs, wrapper_factory, conn):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        cube = np.ndarray((3,) + tuple(shape), dtype=np.float64, buffer=shm.buf)
+        maglib = wrapper_factory()
+        if supports_zero_copy(maglib):
+            maglib.load_cube_vars(cube[0], cube[1], cube[2], dr, copy=False)
+        else:
+            maglib.load_cube_vars(cube[0], cube[1], cube[2], dr)
+        conn.send(('running', time.time(), None))
+        res = maglib.NLFFF(**nlfff_kwargs)
+        energy = maglib.energy
+        # a zero-copy wrapper solves in the shared cube itself and only permutes the components
+        layout = [next((i for i in range(3) if np.may_share_memory(res[k], cube[i])), None)
+                  for k in ("bx", "by", "bz")]
+        if None in layout or len(set(layout)) < 3:
+            for i, k in enumerate(("bx", "by", "bz")):
+                cube[i][...] = res[k]
+            layout = [0, 1, 2]
+        del cube, res
+        conn.send(('done', time.time(), dict(energy=float(energy), layout=layout)))
+    except BaseException:
+        conn.send(('failed', time.time(), traceback.format_exc()))
+    finally:
+        shm.close()
+        conn.close()
+
+
+class NLFFFJob:
+    """
+    Runs `MagFieldWrapper.NLFFF` in a separate process, so that the caller (e.g. the Qt event loop)
+    stays responsive. The input cubes are handed over and the solution is returned through shared memory.
+
+    The solver core is a single blocking call without a progress callback, so the reported progress
+    is the job state and the elapsed wall time. Cancelling terminates the worker process, which is
+    the only way to interrupt the solver cleanly.
+
+    Input arrays have the layout expected by `MagFieldWrapper.load_cube_vars`, `result` returns the
+    dict that `MagFieldWrapper.NLFFF` would return.
+
+    :param bx: Initial bx cube.
+    :type bx: numpy.ndarray
+    :param by: Initial by cube.
+    :type by: numpy.ndarray
+    :param bz: Initial bz cube.
+    :type bz: numpy.ndarray
+    :param dr: Voxel size passed to `load_cube_vars`.
+    :type dr: float
+    :param wrapper_factory: Picklable callable returning a solver wrapper in the worker,
+        e.g. ``functools.partial(pyampp.util.MagFieldWrapper.MagFieldWrapper, lib_path)``.
+        Defaults to pyAMaFiL's MagFieldWrapper; with `inplace_wrapper_factory` the worker solves in the
+        shared memory without a further copy of the cubes.
+    :type wrapper_factory: callable, optional
+    :param callback: Called as ``callback(job)`` by `poll` whenever the state changes.
+    :type callback: callable, optional
+    :param start_method: multiprocessing start method, defaults to 'spawn' which is safe with Qt.
+    :type start_method: str, optional
+    :param nlfff_kwargs: Keyword arguments of `MagFieldWrapper.NLFFF`.
+
+    Example
+    -------
+    >>> job = NLFFFJob(bx, by, bz, dr).start()
+    >>> while not job.finished:
+    ...     print(job.status())
+    ...     time.sleep(1)
+    >>> res = job.result()
+    """
+
+    def __init__(self, bx, by, bz, dr, wrapper_factory=None, callback=None, start_method='spawn', **nlfff_kwargs):
+        shape = np.shape(bx)
+        if np.shape(by) != shape or np.shape(bz) != shape:
+            raise ValueError(f"bx, by and bz must have the same shape, got {np.shape(bx)}, {np.shape(by)}, {np.shape(bz)}")
+        self.shape = tuple(int(n) for n in shape)
+        self.dr = dr
+        self.wrapper_factory = default_wrapper_factory if wrapper_factory is None else wrapper_factory
+        self.callback = callback
+        self.nlfff_kwargs = nlfff_kwargs
+        self.state = 'pending'
+        self.error = None
+        self.info = {}
+        self.t_start = None
+        self.t_end = None
+
+        self._ctx = mp.get_context(start_method)
+        self._shm = shared_memory.SharedMemory(create=True, size=3 * int(np.prod(self.shape)) * 8)
+        self._cube = np.ndarray((3,) + self.shape, dtype=np.float64, buffer=self._shm.buf)
+        for i, b in enumerate((bx, by, bz)):
+            self._cube[i][...] = b
+        self._process = None
+        self._conn = None
+        self._result = None
+        self._layout = [0, 1, 2]
+
+    def __repr__(self):
+        return f"NLFFFJob(shape={self.shape}, state={self.state!r}, elapsed={self.elapsed:.1f} s)"
+
+    def __del__(self):
+        self._release()
+
+    @property
+    def finished(self):
+        """
+        True once the job is done, failed or was cancelled. Polls the worker.
+        """
+        self.poll()
+        return self.state in ('done', 'failed', 'cancelled')
+
+    @property
+    def elapsed(self):
+        """
+        Wall time in seconds since the job was started.
+        """
+        if self.t_start is None:
+            return 0.0
+        return (time.time() if self.t_end is None else self.t_end) - self.t_start
+
+    def start(self):
+        """
+        Starts the worker process.
+
+        :return: The job itself.
+        :rtype: NLFFFJob
+        """
+        if self._process is not None:
+            raise ValueError(f"NLFFF job is already {self.state}")
+        self._conn, child_conn = self._ctx.Pipe(duplex=False)
+        self._process = self._ctx.Process(target=_nlfff_worker,
+                                          args=(self._shm.name, self.shape, self.dr, self.nlfff_kwargs,
+                                                self.wrapper_factory, child_conn),
+                                          daemon=True)
+        self.t_start = time.time()
+        self._process.start()
+        child_conn.close()
+        return self
+
+    def poll(self):
+        """
+        Reads state updates sent by the worker without blocking.
+
+        :return: Current state, one of NLFFF_JOB_STATES.
+        :rtype: str
+        """
+        if self._process is None or self.state in ('done', 'failed', 'cancelled'):
+            return self.state
+        changed = False
+        try:
+            while self._conn.poll():
+                state, t, payload = self._conn.recv()
+                self.state = state
+                changed = True
+                if state == 'done':
+                    self._layout = payload.pop('layout', [0, 1, 2])
+                    self.info = payload
+                elif state == 'failed':
+                    self.error = payload
+                if state in ('done', 'failed'):
+                    self.t_end = t
+        except EOFError:
+            pass
+        if self.state in ('pending', 'running') and not self._process.is_alive():
+            self.state = 'failed'
+            self.error = f"NLFFF worker exited with code {self._process.exitcode}"
+            self.t_end = time.time()
+            changed = True
+        if self.state in ('done', 'failed'):
+            self._process.join()
+        if changed and self.callback is not None:
+            self.callback(self)
+        return self.state
+
+    def status(self):
+        """
+        Returns a snapshot of the job progress.
+
+        :rtype: dict
+        """
+        self.poll()
+        return dict(state=self.state, elapsed=self.elapsed, error=self.error, **self.info)
+
+    def wait(self, timeout=None, interval=0.2):
+        """
+        Blocks until the job is finished or ``timeout`` seconds have passed.
+
+        :return: True if the job is finished.
+        :rtype: bool
+        """
+        t0 = time.time()
+        while not self.finished:
+            if timeout is not None and time.time() - t0 > timeout:
+                return False
+            time.sleep(interval)
+        return True
+
+    def cancel(self):
+        """
+        Terminates the solver and releases the shared memory. Does nothing for finished jobs.
+
+        :return: True if the job was cancelled.
+        :rtype: bool
+        """
+        if self.finished:
+            return False
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+        self.state = 'cancelled'
+        self.t_end = time.time()
+        self._release()
+        if self.callback is not None:
+            self.callback(self)
+        return True
+
+    def result(self, timeout=None):
+        """
+        Waits for the job and returns the solution.
+
+        :return: dict(bx, by, bz) as returned by `MagFieldWrapper.NLFFF`.
+        :rtype: dict
+        """
+        if self._result is not None:
+            return self._result
+        if self._process is None:
+            raise ValueError("NLFFF job was not started")
+        if not self.wait(timeout):
+            raise TimeoutError(f"NLFFF job is still {self.state} after {timeout} s")
+        if self.state != 'done':
+            raise RuntimeError(f"NLFFF job {self.state}: {self.error}")
+        self._result = {k: self._cube[i].copy() for k, i in zip(("bx", "by", "bz"), self._layout)}
+        self._release()
+        return self._result
+
+    def _release(self):
+        shm = getattr(self, '_shm', None)
+        if shm is None:
+            return
+        self._cube = None
+        self._shm = None
+        shm.close()
+        shm.unlink()
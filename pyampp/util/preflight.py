@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# Preflight estimate of peak memory and runtime of the LFFF, NLFFF and field line tracing stages
+# of a box, calibrated by a small benchmark on the local machine.
+#
+#   python -m pyampp.util.preflight --calibrate
+#   python -m pyampp.util.preflight --dims 400 400 300 --max-length -1 --memory-limit 64G
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+from pyampp.util.config import get_base_directory
+from pyampp.util.lff import PRECISION_DTYPES, default_nz_block
+
+STAGES = ('lfff', 'nlfff', 'lines')
+
+# conservative defaults used until calibrate() has been run on the machine; every stage is modelled as
+# a fixed overhead plus a coefficient times its work measure
+DEFAULT_CALIBRATION = dict(
+    lfff_time=2.0e-9,          # s per (padded plane point * log2(plane points)) per transform
+    lfff_overhead=0.0,         # s
+    nlfff_time=2.0e-7,         # s per voxel**(4/3)
+    nlfff_overhead=0.0,        # s
+    nlfff_workspace=12.0,      # solver work arrays, in float64 cubes
+    nlfff_workspace_bytes=0,   # fixed part of the solver work arrays
+    lines_time=5.0e-8,         # s per traced line step
+    lines_overhead=0.0,        # s
+    baseline_bytes=300 * 2 ** 20,
+)
+
+# stages whose peak memory is fitted by calibrate(); the peaks of the other stages are model-only, i.e.
+# sums of the arrays they allocate, while the runtimes of all stages are calibrated
+MEMORY_CALIBRATED_STAGES = ('nlfff',)
+
+# box sizes of the calibration benchmark, two sizes fix the coefficient and the overhead of each stage
+CALIBRATION_SIZES = (32, 48)
+
+
+def default_calibration_file():
+    """
+    Returns the file the local calibration is stored in.
+    """
+    return os.path.join(get_base_directory(), 'preflight.json')
+
+
+def load_calibration(path=None):
+    """
+    Returns the calibration stored by `calibrate`, or DEFAULT_CALIBRATION if there is none.
+
+    :param path: Calibration file, defaults to `default_calibration_file`.
+    :type path: str, optional
+    :rtype: dict
+    """
+    path = default_calibration_file() if path is None else path
+    calibration = dict(DEFAULT_CALIBRATION, calibrated=False)
+    if os.path.isfile(path):
+        with open(path) as f:
+            calibration.update(json.load(f))
+    return calibration
+
+
+def estimate_resources(box_dims, precision='double', seeds=None, max_length=0, nz_block=None, calibration=None):
+    """
+    Predicts peak memory and runtime of the modelling stages of a box.
+
+    :param box_dims: Box size in voxels, (nx, ny, nz).
+    :type box_dims: sequence of int
+    :param precision: Precision mode of the potential extrapolation, see `mf_lfff`.
+    :type precision: str, optional
+    :param seeds: Number of field line seeds, None traces from every voxel.
+    :type seeds: int, optional
+    :param max_length: ``max_length`` option of `MagFieldWrapper.lines`, < 0 sizes the coordinates by `est_max_coords`.
+    :type max_length: int, optional
+    :param nz_block: Number of heights per slab of the potential extrapolation, defaults to `default_nz_block`.
+    :type nz_block: int, optional
+    :param calibration: Calibration dict, defaults to `load_calibration`.
+    :type calibration: dict, optional
+    :return: dict of stage -> dict(peak_bytes, runtime_s, peak_calibrated), plus ``peak_bytes`` and ``runtime_s``
+        of the whole run. ``peak_calibrated`` is False for peaks that are model-only, see MEMORY_CALIBRATED_STAGES.
+    :rtype: dict
+    """
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(f"precision {precision} is unknown. precision must be one of {list(PRECISION_DTYPES)}")
+    cal = load_calibration() if calibration is None else calibration
+    nx, ny, nz = (int(n) for n in box_dims)
+    n_vox = nx * ny * nz
+    real_size = np.dtype(PRECISION_DTYPES[precision][0]).itemsize
+    complex_size = np.dtype(PRECISION_DTYPES[precision][1]).itemsize
+    cube = n_vox * 8
+
+    # padded spectral plane (default pad of one box size on each side), cached kernels and the three
+    # nz_block-deep spectral work arrays of a slab
+    plane = (2 * nx) * (2 * ny)
+    if nz_block is None:
+        nz_block = default_nz_block((2 * nx, 2 * ny), PRECISION_DTYPES[precision][1])
+    lfff_bytes = 3 * n_vox * real_size + 8 * plane * 16 + 3 * min(nz_block, nz) * plane * complex_size
+    lfff_time = cal['lfff_overhead'] + cal['lfff_time'] * _lfff_work(nx, ny, nz)
+
+    # potential cubes held by the caller, the wrapper's float64 copies and the solver work arrays
+    nlfff_bytes = 3 * n_vox * real_size + 3 * cube + cal['nlfff_workspace_bytes'] + cal['nlfff_workspace'] * cube
+    nlfff_time = cal['nlfff_overhead'] + cal['nlfff_time'] * n_vox ** (4 / 3)
+
+    n_total = n_vox if seeds is None else int(seeds)
+    line_length = np.linalg.norm((nx, ny, nz))
+    if max_length < 0:
+        max_length = int(np.ceil(line_length * n_total))
+    # six int32 and two float64 per-seed arrays, plus lines_start, lines_length and lines_index with coordinates
+    per_seed = 6 * 4 + 2 * 8 + (16 if max_length else 0)
+    lines_bytes = 3 * cube + n_total * per_seed + max_length * 4 * 8
+    lines_time = cal['lines_overhead'] + cal['lines_time'] * n_total * line_length
+
+    res = dict(lfff=dict(peak_bytes=lfff_bytes, runtime_s=lfff_time),
+               nlfff=dict(peak_bytes=nlfff_bytes, runtime_s=nlfff_time),
+               lines=dict(peak_bytes=lines_bytes, runtime_s=lines_time))
+    calibrated = bool(cal.get('calibrated', False))
+    for stage in STAGES:
+        res[stage]['peak_bytes'] = int(res[stage]['peak_bytes'] + cal['baseline_bytes'])
+        res[stage]['peak_calibrated'] = (calibrated and stage in MEMORY_CALIBRATED_STAGES
+                                         and stage in cal.get('stages', STAGES))
+    res['peak_bytes'] = max(res[stage]['peak_bytes'] for stage in STAGES)
+    res['runtime_s'] = sum(res[stage]['runtime_s'] for stage in STAGES)
+    res['calibrated'] = calibrated
+    return res
+
+
+def _lfff_work(nx, ny, nz):
+    # three transforms per height of the padded plane
+    plane = (2 * nx) * (2 * ny)
+    return 3 * nz * plane * np.log2(plane)
+
+
+def _linear_fit(x, y):
+    # slope and intercept of the line through the first and last point, the intercept kept non-negative
+    slope = (y[-1] - y[0]) / (x[-1] - x[0])
+    intercept = y[0] - slope * x[0]
+    if intercept < 0:
+        slope, intercept = y[-1] / x[-1], 0.0
+    return max(float(slope), 0.0), float(intercept)
+
+
+def _peak_rss():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _benchmark(stage, size, wrapper_factory):
+    # returns the wall time, the peak RSS increase and the number of float64 cubes of the input and its
+    # copies in the wrapper included in that increase
+    from pyampp.util.lff import mf_lfff
+    rng = np.random.default_rng(0)
+    base = _peak_rss()
+    t0 = time.perf_counter()
+    if stage == 'lfff':
+        maglib_lff = mf_lfff()
+        maglib_lff.set_field(rng.normal(scale=300, size=(size, size)))
+        maglib_lff.lfff_cube(size)
+        held = 0
+    else:
+        from pyampp.util.nlfff_job import default_wrapper_factory, supports_zero_copy
+        maglib = (wrapper_factory or default_wrapper_factory)()
+        b = [rng.normal(scale=100, size=(size, size, size)) for _ in range(3)]
+        if supports_zero_copy(maglib):
+            maglib.load_cube_vars(*b, 1.0, copy=False)
+            held = 3
+        else:
+            maglib.load_cube_vars(*b, 1.0)
+            held = 6
+        t0 = time.perf_counter()
+        if stage == 'nlfff':
+            maglib.NLFFF()
+        else:
+            maglib.lines(seeds=rng.random((size * size, 3)) * (size - 1))
+    return time.perf_counter() - t0, _peak_rss() - base, held
+
+
+def calibrate(sizes=CALIBRATION_SIZES, wrapper_factory=None, path=None):
+    """
+    Runs small LFFF, NLFFF and tracing benchmarks, each stage and size in a fresh process so that its
+    peak memory can be measured, fits the coefficients and overheads of `estimate_resources` through
+    the smallest and largest size and stores them.
+
+    :param sizes: Benchmark box sizes in voxels, at least two different ones.
+    :type sizes: sequence of int, optional
+    :param wrapper_factory: Picklable callable returning the solver wrapper, defaults to pyAMaFiL's MagFieldWrapper.
+    :type wrapper_factory: callable, optional
+    :param path: Calibration file, defaults to `default_calibration_file`.
+    :type path: str, optional
+    :return: The calibration.
+    :rtype: dict
+    """
+    path = default_calibration_file() if path is None else path
+    sizes = sorted(int(n) for n in sizes)
+    if len(sizes) < 2 or sizes[0] == sizes[-1]:
+        raise ValueError(f"sizes must hold at least two different box sizes, got {sizes}")
+    cal = dict(DEFAULT_CALIBRATION)
+    measured = {}
+    for stage in STAGES:
+        try:
+            runs = []
+            for size in (sizes[0], sizes[-1]):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    runs.append(pool.submit(_benchmark, stage, size, wrapper_factory).result())
+            measured[stage] = runs
+        except ImportError as e:
+            print(f"preflight: {stage} not calibrated, {e}")
+
+    def fit(stage, work):
+        return _linear_fit([work(n) for n in (sizes[0], sizes[-1])], [run[0] for run in measured[stage]])
+
+    if 'lfff' in measured:
+        cal['lfff_time'], cal['lfff_overhead'] = fit('lfff', lambda n: _lfff_work(n, n, n))
+    if 'nlfff' in measured:
+        cal['nlfff_time'], cal['nlfff_overhead'] = fit('nlfff', lambda n: n ** 4)
+        # the input cubes and the wrapper's copies of them are accounted for separately
+        workspace = [rss - held * n ** 3 * 8 for (t, rss, held), n in zip(measured['nlfff'], (sizes[0], sizes[-1]))]
+        cal['nlfff_workspace'], cal['nlfff_workspace_bytes'] = _linear_fit([n ** 3 * 8 for n in (sizes[0], sizes[-1])],
+                                                                           workspace)
+    if 'lines' in measured:
+        cal['lines_time'], cal['lines_overhead'] = fit('lines', lambda n: n * n * np.linalg.norm((n,) * 3))
+    cal.update(calibrated=True, sizes=[sizes[0], sizes[-1]], stages=sorted(measured))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(cal, f, indent=2)
+    return cal
+
+
+def parse_bytes(text):
+    """
+    Parses sizes like '64G', '512M' or '1000000' to bytes.
+    """
+    units = dict(K=2 ** 10, M=2 ** 20, G=2 ** 30, T=2 ** 40)
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate peak memory and runtime of a pyAMPP box.")
+    parser.add_argument('--dims', type=int, nargs=3, metavar=('NX', 'NY', 'NZ'), help='Box size in voxels')
+    parser.add_argument('--precision', default='double', choices=list(PRECISION_DTYPES),
+                        help='Precision of the potential extrapolation and stored cubes')
+    parser.add_argument('--seeds', type=int, default=None, help='Number of field line seeds (default: every voxel)')
+    parser.add_argument('--max-length', type=int, default=0,
+                        help='max_length option of lines(); -1 sizes the coordinate buffer by est_max_coords')
+    parser.add_argument('--memory-limit', default=None, help='Exit with status 2 if the peak exceeds this, e.g. 64G')
+    parser.add_argument('--calibrate', action='store_true', help='Run the local calibration benchmark first')
+    parser.add_argument('--calibration-sizes', type=int, nargs=2, default=list(CALIBRATION_SIZES),
+                        help='Two box sizes of the calibration benchmark')
+    parser.add_argument('--json', action='store_true', help='Print the estimate as JSON')
+    args = parser.parse_args()
+
+    if args.calibrate:
+        cal = calibrate(sizes=args.calibration_sizes)
+        print(f"calibration stored in {default_calibration_file()}: stages {cal['stages']}")
+    if args.dims is None:
+        if not args.calibrate:
+            parser.error('--dims is required')
+        return
+
+    est = estimate_resources(args.dims, precision=args.precision, seeds=args.seeds, max_length=args.max_length)
+    if args.json:
+        print(json.dumps(est, indent=2))
+    else:
+        if not est['calibrated']:
+            print("not calibrated on this machine, run with --calibrate for better estimates")
+        print(f"{'stage':>8} {'peak, GiB':>10} {'time, s':>10}")
+        for stage in STAGES:
+            mark = ' ' if est[stage]['peak_calibrated'] else '*'
+            print(f"{stage:>8} {est[stage]['peak_bytes'] / 2 ** 30:10.2f}{mark}{est[stage]['runtime_s']:10.1f}")
+        print(f"{'total':>8} {est['peak_bytes'] / 2 ** 30:10.2f} {est['runtime_s']:10.1f}")
+        print("* model-only peak: sum of the allocated arrays, not fitted to measured memory")
+
+    if args.memory_limit is not None and est['peak_bytes'] > parse_bytes(args.memory_limit):
+        print(f"peak memory {est['peak_bytes'] / 2 ** 30:.2f} GiB exceeds the limit {args.memory_limit}")
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
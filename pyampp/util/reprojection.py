@@ -0,0 +1,225 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+from astropy.wcs import WCS
+from astropy.wcs.utils import pixel_to_pixel
+from reproject import reproject_adaptive, reproject_exact
+from scipy import ndimage
+from sunpy.map import Map
+
+REPROJECT_ALGORITHMS = ('interpolation', 'adaptive', 'exact')
+
+# reprojection methods of the box bottoms, fastest first: spline interpolation for interactive browsing,
+# the adaptive anti-aliased resampling (DeForest 2004) and exact flux-conserving overlap for production
+REPROJECT_METHODS = dict(
+    bilinear=dict(algorithm='interpolation', order=1),
+    bicubic=dict(algorithm='interpolation', order=3),
+    adaptive=dict(algorithm='adaptive'),
+    exact=dict(algorithm='exact'),
+)
+
+# source pixel coordinates of the target pixel centres, per (source WCS, target header) pair
+_mapping_cache = OrderedDict()
+MAPPING_CACHE_SIZE = 4
+
+
+def _wcs_key(wcs, shape):
+    return tuple(shape), wcs.to_header_string(relax=True)
+
+
+def clear_mapping_cache():
+    """
+    Drops all cached pixel mappings.
+    """
+    _mapping_cache.clear()
+
+
+def pixel_mapping(source_wcs, source_shape, target_wcs, cache=True):
+    """
+    Source pixel coordinates of every target pixel centre, computed once per (source WCS, target WCS)
+    pair and cached, so that maps of the same observation on the same grid share one transform.
+
+    :param source_wcs: WCS of the input maps.
+    :type source_wcs: astropy.wcs.WCS
+    :param source_shape: (ny, nx) of the input maps.
+    :type source_shape: tuple of int
+    :param target_wcs: WCS of the output grid, with its array shape set.
+    :type target_wcs: astropy.wcs.WCS
+    :param cache: Use and fill the mapping cache.
+    :type cache: bool, optional
+    :return: (y, x) source pixel coordinates of the target shape, NaN where the target pixel has no
+        counterpart (e.g. off the solar disk); read-only when cached.
+    :rtype: tuple of numpy.ndarray
+    """
+    key = _wcs_key(source_wcs, source_shape) + _wcs_key(target_wcs, target_wcs.array_shape)
+    if cache and key in _mapping_cache:
+        _mapping_cache.move_to_end(key)
+        return _mapping_cache[key]
+
+    ny, nx = target_wcs.array_shape
+    x_out, y_out = np.meshgrid(np.arange(nx, dtype=np.float64), np.arange(ny, dtype=np.float64))
+    x_in, y_in = pixel_to_pixel(target_wcs, source_wcs, x_out, y_out)
+    mapping = np.asarray(y_in, dtype=np.float64), np.asarray(x_in, dtype=np.float64)
+
+    if cache:
+        for a in mapping:
+            a.setflags(write=False)
+        _mapping_cache[key] = mapping
+        while len(_mapping_cache) > MAPPING_CACHE_SIZE:
+            _mapping_cache.popitem(last=False)
+    return mapping
+
+
+def _interpolate_stack(stack, mapping, order):
+    y_in, x_in = mapping
+    ny, nx = stack.shape[-2:]
+    # pixels are valid out to their edges, as in reproject_interp
+    with np.errstate(invalid='ignore'):
+        outside = ~((x_in >= -0.5) & (x_in <= nx - 0.5) & (y_in >= -0.5) & (y_in <= ny - 0.5))
+    coords = np.array([np.where(outside, 0, y_in), np.where(outside, 0, x_in)])
+    out = np.empty((len(stack),) + y_in.shape)
+    for i, channel in enumerate(stack):
+        channel = np.asarray(channel, dtype=np.float64)
+        nan = np.isnan(channel)
+        if nan.any():
+            # the spline prefilter would spread NaNs (off-disk pixels) over whole rows, so interpolate
+            # zero-filled data and blank the pixels that touch a NaN under bilinear weights
+            channel = np.where(nan, 0.0, channel)
+            touched = ndimage.map_coordinates(nan.astype(np.float64), coords, order=1, mode='nearest') > 0
+        ndimage.map_coordinates(channel, coords, output=out[i], order=order, mode='nearest')
+        out[i][outside] = np.nan
+        if nan.any():
+            out[i][touched] = np.nan
+    return out
+
+
+def reproject_stack(stack, source_wcs, target_wcs, algorithm='adaptive', order=1, **reproject_kwargs):
+    """
+    Reprojects N arrays sharing one source grid onto a target grid in a single pass.
+
+    With 'interpolation' the pixel mapping of `pixel_mapping` is reused across calls; 'adaptive' and
+    'exact' hand the whole (N, ny, nx) stack to reproject, which broadcasts one coordinate transform
+    over the leading axis.
+
+    :param stack: Input arrays, shape (N, ny, nx).
+    :type stack: numpy.ndarray or sequence of numpy.ndarray
+    :param source_wcs: Celestial WCS of the input arrays.
+    :type source_wcs: astropy.wcs.WCS
+    :param target_wcs: WCS of the output grid, with its array shape set.
+    :type target_wcs: astropy.wcs.WCS
+    :param algorithm: One of REPROJECT_ALGORITHMS.
+    :type algorithm: str, optional
+    :param order: Spline order of 'interpolation', 1 (bilinear) or 3 (bicubic).
+    :type order: int, optional
+    :param reproject_kwargs: Passed on to reproject_adaptive or reproject_exact.
+    :return: Output arrays, shape (N,) + target shape.
+    :rtype: numpy.ndarray
+    """
+    if algorithm not in REPROJECT_ALGORITHMS:
+        raise ValueError(f"algorithm {algorithm} is unknown. algorithm must be one of {REPROJECT_ALGORITHMS}")
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    shape_out = tuple(target_wcs.array_shape)
+
+    if algorithm == 'interpolation':
+        return _interpolate_stack(stack, pixel_mapping(source_wcs, stack.shape[-2:], target_wcs), order)
+    if algorithm == 'adaptive':
+        reproject_kwargs.setdefault('roundtrip_coords', False)
+        return reproject_adaptive((stack, source_wcs), target_wcs, shape_out=shape_out, return_footprint=False,
+                                  **reproject_kwargs)
+    return reproject_exact((stack, source_wcs), target_wcs, shape_out=shape_out, return_footprint=False,
+                           **reproject_kwargs)
+
+
+def reproject_maps(maps, target_header, method='adaptive', **kwargs):
+    """
+    Multi-channel counterpart of ``GenericMap.reproject_to``: maps on the same grid (e.g. the Bp, Bt and
+    Br maps of one HMI observation) are stacked and reprojected together, see `reproject_stack`.
+
+    :param maps: Input maps, maps on different grids are reprojected in separate groups.
+    :type maps: sequence of sunpy.map.GenericMap
+    :param target_header: Header of the target grid, e.g. the CEA box bottom.
+    :type target_header: dict or astropy.wcs.WCS
+    :param method: One of REPROJECT_METHODS, 'bilinear' or 'bicubic' interpolation, 'adaptive' or 'exact'.
+    :type method: str, optional
+    :param kwargs: Passed on to `reproject_stack`.
+    :return: Reprojected maps in the input order.
+    :rtype: list of sunpy.map.GenericMap
+    """
+    if method not in REPROJECT_METHODS:
+        raise ValueError(f"method {method} is unknown. method must be one of {list(REPROJECT_METHODS)}")
+    target_wcs = target_header if isinstance(target_header, WCS) else WCS(target_header)
+    if target_wcs.array_shape is None:
+        raise ValueError("target_header must define the array shape (NAXIS1, NAXIS2)")
+
+    groups = OrderedDict()
+    for i, smap in enumerate(maps):
+        groups.setdefault(_wcs_key(smap.wcs, smap.data.shape), []).append(i)
+
+    out = [None] * len(maps)
+    header = target_wcs.to_header()
+    for indices in groups.values():
+        source = maps[indices[0]]
+        stack = reproject_stack([maps[i].data for i in indices], source.wcs, target_wcs,
+                                **REPROJECT_METHODS[method], **kwargs)
+        for i, data in zip(indices, stack):
+            out[i] = Map(data, header, plot_settings=maps[i].plot_settings)
+    return out
+
+
+def benchmark_reprojection(maps, target_header, methods=None, reference='exact', repeat=1):
+    """
+    Wall time and accuracy of the reprojection methods on a reference box bottom.
+
+    The vector maps are reprojected with every method (cold mapping cache, best of ``repeat`` runs) and
+    compared with the ``reference`` method through the box integrals that matter for the models: the
+    net and unsigned flux of the last map (Br / Bz) and the energy proxy sum(B^2) over all maps, plus
+    the largest pixel difference.
+
+    :param maps: Input maps on one grid, e.g. (Bp, Bt, Br).
+    :type maps: sequence of sunpy.map.GenericMap
+    :param target_header: Header of the box bottom.
+    :type target_header: dict or astropy.wcs.WCS
+    :param methods: Methods to compare, defaults to all of REPROJECT_METHODS.
+    :type methods: sequence of str, optional
+    :param reference: Method the others are compared with.
+    :type reference: str, optional
+    :param repeat: Number of runs per method.
+    :type repeat: int, optional
+    :return: dict of method -> dict(time_s, net_flux, unsigned_flux, energy, rel_net_flux, rel_unsigned_flux,
+        rel_energy, max_abs_diff); sums are over the pixels valid for all methods, in input units per pixel.
+    :rtype: dict
+    """
+    methods = list(REPROJECT_METHODS) if methods is None else list(methods)
+    if reference not in methods:
+        methods.append(reference)
+    stacks, times = {}, {}
+    for method in methods:
+        best = np.inf
+        for _ in range(repeat):
+            clear_mapping_cache()
+            t0 = time.perf_counter()
+            out = reproject_maps(maps, target_header, method=method)
+            best = min(best, time.perf_counter() - t0)
+        stacks[method] = np.array([m.data for m in out])
+        times[method] = best
+
+    valid = np.all([np.isfinite(stack).all(axis=0) for stack in stacks.values()], axis=0)
+
+    def integrals(stack):
+        bz = stack[-1][valid]
+        return dict(net_flux=float(bz.sum()), unsigned_flux=float(np.abs(bz).sum()),
+                    energy=float((stack[:, valid] ** 2).sum()))
+
+    ref = integrals(stacks[reference])
+    report = {}
+    for method in methods:
+        res = dict(time_s=times[method], **integrals(stacks[method]))
+        for k in ('net_flux', 'unsigned_flux', 'energy'):
+            res[f"rel_{k}"] = (res[k] - ref[k]) / abs(ref[k]) if ref[k] != 0 else 0.0
+        res['max_abs_diff'] = float(np.abs(stacks[method][:, valid] - stacks[reference][:, valid]).max()) \
+            if valid.any() else 0.0
+        report[method] = res
+    return report